@@ -60,17 +60,23 @@ def epochtime(t):
 
 def insert_blog_post(cnx, name, version, title, body, publish_time, 
                      version_time, version_comment, version_author, 
-                     author, categories):
+                     author, categories, is_current):
     """ Insert the post into the FullBlog tables """
     cur = cnx.cursor()
     try:
         cur.execute("INSERT INTO fullblog_posts "
                     "(name, version, title, body, publish_time, version_time, "
-                    "version_comment, version_author, author, categories) "
-                    "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
+                    "version_comment, version_author, author, categories, "
+                    "is_current) "
+                    "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
                     (name, version, title, body, epochtime(publish_time),
                     epochtime(version_time), version_comment, version_author,
-                    author, categories))
+                    author, categories, int(is_current)))
+        if is_current:
+            for category in set(split_tags(categories)):
+                cur.execute("INSERT INTO fullblog_post_categories "
+                            "(name, category) VALUES (%s, %s)",
+                            (name, category))
     except Exception, e:
         print("Unable to insert %s into the FullBlog: %s" % (name, e))
         raise
@@ -158,7 +164,7 @@ def Main(opts):
                 insert_blog_post(cnx, name, version, title, body,
                                  publish_time, version_time, 
                                  version_comment, version_author, author,
-                                 categories)
+                                 categories, version == page.version)
                 reparent_blog_attachments(env, resource.id, name)
                 continue
             cnx.commit()
@@ -16,6 +16,9 @@ How to use:
   `[fullblog] draft_category = draft, Draft`
 - If it is a draft, only the author can access the post for viewing or
   changes. All other access is blocked.
+- Draft posts are kept in memory (refreshed whenever the blog generation
+  changes, also by other processes), so checking permissions does not load
+  the posts.
 - It will also prevent:
   - Anonymous users saving drafts (that will be chaotic).
   - Saving as draft where author is not the same as the username (as further
@@ -29,17 +32,24 @@ License: BSD
 from trac.config import ListOption
 from trac.core import *
 from trac.perm import IPermissionPolicy
-from tracfullblog.api import IBlogManipulator
-from tracfullblog.model import BlogPost, _parse_categories
+from tracfullblog.api import IBlogChangeListener, IBlogManipulator, \
+                             IBlogPermissionPolicy
+from tracfullblog.core import FullBlogCore
+from tracfullblog.model import _parse_categories
 
 class BlogDraftPlugin(Component):
     
-    implements(IPermissionPolicy, IBlogManipulator)
+    implements(IPermissionPolicy, IBlogManipulator, IBlogChangeListener,
+               IBlogPermissionPolicy)
     
     draft = ListOption('fullblog', 'draft_categories', default='draft, Draft',
         doc="""List of categories to be considered as draft blog posts,
         only available to the author.""")
     
+    def __init__(self):
+        # (generation, dict of draft post name -> author), loaded when needed
+        self._drafts = (None, None)
+
     # IPermissionPolicy method
     
     def check_permission(self, action, username, resource, perm):
@@ -49,13 +59,51 @@ class BlogDraftPlugin(Component):
         if not resource:
             return
         if resource.realm == 'blog' and resource.id:
-            the_post = BlogPost(self.env, resource.id, resource.version)
-            author = self.config.getbool('trac', 'ignore_auth_case') \
-                          and the_post.author.lower() or the_post.author
-            for category in the_post.category_list:
-                if category in self.draft and author != username:
-                    # Block all access regardless
-                    return False
+            if resource.version:
+                # A specific version - could have been a draft back then
+                rows = self._query("SELECT author, categories "
+                                   "FROM fullblog_posts WHERE name=%s "
+                                   "AND version=%s",
+                                   (resource.id, resource.version))
+                if not rows or not [category for category in
+                        _parse_categories(rows[0][1] or '')
+                        if category in self.draft]:
+                    return
+                author = self._normalize_author(rows[0][0])
+            else:
+                author = self._get_drafts().get(resource.id)
+            if author is not None and author != username:
+                # Block all access regardless
+                return False
+
+    # IBlogPermissionPolicy methods
+
+    def get_restricted_blog_posts(self):
+        return self._get_drafts().keys()
+
+    def check_blog_permissions(self, action, username, names):
+        drafts = self._get_drafts()
+        decisions = {}
+        for name in names:
+            if name in drafts and drafts[name] != username:
+                decisions[name] = False
+            else:
+                decisions[name] = None
+        return decisions
+
+    # IBlogChangeListener methods
+
+    def blog_post_changed(self, postname, version):
+        self._drafts = (None, None)
+
+    def blog_post_deleted(self, postname, version, fields):
+        self._drafts = (None, None)
+
+    def blog_comment_added(self, postname, number):
+        pass
+
+    def blog_comment_deleted(self, postname, number, fields):
+        pass
 
     # IBlogManipulator methods
 
@@ -74,3 +122,36 @@ class BlogDraftPlugin(Component):
 
     def validate_blog_comment(self, req, postname, fields):
         return []
+
+    # Internal methods
+
+    def _get_drafts(self):
+        """ Returns the dict of current draft post name -> author,
+        looked up in the category index for each blog generation. """
+        generation = FullBlogCore(self.env).get_generation()
+        cached_generation, drafts = self._drafts
+        if drafts is None or generation is None \
+                or generation != cached_generation:
+            drafts = {}
+            if self.draft:
+                rows = self._query("SELECT DISTINCT p.name, p.author "
+                        "FROM fullblog_posts p INNER JOIN "
+                        "fullblog_post_categories c ON c.name=p.name "
+                        "WHERE p.is_current=1 AND c.category IN (%s)"
+                        % ", ".join(["%s"] * len(self.draft)),
+                        tuple(self.draft))
+                for name, author in rows:
+                    drafts[name] = self._normalize_author(author)
+            self._drafts = (generation, drafts)
+        return drafts
+
+    def _query(self, sql, args):
+        if hasattr(self.env, 'db_query'):
+            return self.env.db_query(sql, args)
+        cursor = self.env.get_db_cnx().cursor()
+        cursor.execute(sql, args)
+        return cursor.fetchall()
+
+    def _normalize_author(self, author):
+        return self.config.getbool('trac', 'ignore_auth_case') \
+                    and author.lower() or author
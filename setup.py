@@ -27,6 +27,7 @@ setup(name='TracFullBlogPlugin',
             'tracfullblog.core = tracfullblog.core',
             'tracfullblog.db = tracfullblog.db',
             'tracfullblog.macros = tracfullblog.macros',
+            'tracfullblog.search = tracfullblog.search',
             'tracfullblog.spamfilter = tracfullblog.spamfilter[spamfilter]',
             'tracfullblog.tags = tracfullblog.tags[tags]',
             'tracfullblog.web_ui = tracfullblog.web_ui']},
@@ -57,3 +57,24 @@ class IBlogManipulator(Interface):
         Must return a list of `(field, message)` tuples, one for each problem
         detected. `field` can be `None` to indicate an overall problem with the
         comment. Therefore, a return value of `[]` means everything is OK."""
+
+class IBlogPermissionPolicy(Interface):
+    """Extension point interface for permission policies that restrict access
+    to individual blog posts.
+
+    Computing aggregates like the sidebar counts would otherwise need a
+    permission check for every blog post whenever an unknown permission
+    policy is active. Policies implementing this interface tell which
+    posts they may restrict, and only those posts will be checked."""
+
+    def get_restricted_blog_posts():
+        """Return a collection of names of blog posts that the policy may
+        deny access to. For any other blog post the policy must not make
+        a decision for actions in the 'blog' realm."""
+
+    def check_blog_permissions(action, username, names):
+        """Optional: Return a dict of post name -> decision for checking
+        `action` on the current version of many posts at once, with decisions
+        like from `IPermissionPolicy.check_permission()` (True, False or None).
+        Only called with names of restricted posts. If not implemented, each
+        post is checked using `check_permission()`."""
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+Caching support for the plugin.
+
+The caches used by the plugin go through a small backend interface
+(`CacheBackend`), with these implementations:
+ * `LRUCache` - in-memory cache for each process (default).
+ * `FileCache` - SQLite file shared by the processes on a host.
+ * `MemcachedCache` - memcached servers shared by several hosts (needs the
+   `python-memcached` package).
+
+License: BSD
+
+(c) 2007 ::: www.CodeResort.com - BV Network AS (simon-code@bvnetwork.no)
+"""
+
+import cPickle
+import time
+from collections import OrderedDict
+from hashlib import md5
+from threading import Lock
+
+from trac.core import TracError
+
+__all__ = ['CacheBackend', 'CacheView', 'LRUCache', 'FileCache',
+           'MemcachedCache']
+
+
+class CacheBackend(object):
+    """ Interface for cache backends. Values stored in shared backends
+    must be pickleable, and keys need a stable `repr()`. """
+
+    def get(self, key, default=None):
+        """ Returns the value stored for `key`, or `default`. """
+        raise NotImplementedError
+
+    def set(self, key, value):
+        """ Stores `value` for `key`, possibly evicting other items. """
+        raise NotImplementedError
+
+    def delete(self, key):
+        """ Removes any value stored for `key`. """
+        raise NotImplementedError
+
+    def clear(self):
+        """ Removes all values. """
+        raise NotImplementedError
+
+    def get_for_generation(self, key, generation):
+        """ Returns the value stored by set_for_generation() for the same
+        blog `generation`, or None if missing or stored for another one. """
+        cached = self.get(key)
+        if cached is not None and generation is not None \
+                and cached[0] == generation:
+            return cached[1]
+        return None
+
+    def set_for_generation(self, key, value, generation):
+        """ Stores `value` for `key`, valid for the blog `generation` only. """
+        self.set(key, (generation, value))
+
+
+class CacheView(CacheBackend):
+    """ Cache using a shared backend for a named part of the plugin data,
+    with keys prefixed by the name. """
+
+    def __init__(self, backend, name):
+        self.backend = backend
+        self.name = name
+
+    def get(self, key, default=None):
+        return self.backend.get((self.name, key), default)
+
+    def set(self, key, value):
+        self.backend.set((self.name, key), value)
+
+    def delete(self, key):
+        self.backend.delete((self.name, key))
+
+    def clear(self):
+        self.backend.clear()
+
+
+class LRUCache(CacheBackend):
+    """ A thread-safe dictionary-like cache holding at most `size` items,
+    evicting the least recently used items when full. """
+
+    def __init__(self, size=1000):
+        self.size = size
+        self._items = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            if not key in self._items:
+                return default
+            # Move to end as most recently used
+            value = self._items.pop(key)
+            self._items[key] = value
+            return value
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        self._lock.acquire()
+        try:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            self._items.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._items.clear()
+        finally:
+            self._lock.release()
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+
+def _hash_key(key):
+    return md5(repr(key)).hexdigest()
+
+
+class FileCache(CacheBackend):
+    """ Cache stored in an SQLite database file, that can be shared by
+    all processes on a host using the same file. When holding more than
+    `size` items, the items written longest ago are evicted. Database
+    errors are logged to `log` (if given), and treated as cache misses. """
+
+    # Number of writes between checks for items to evict
+    prune_interval = 100
+
+    def __init__(self, path, size=10000, timeout=10, log=None):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.log = log
+        self._writes = 0
+        self._initialized = False
+
+    def get(self, key, default=None):
+        rows = self._execute("SELECT value FROM fullblog_cache WHERE key=?",
+                             (_hash_key(key),))
+        if not rows:
+            return default
+        return cPickle.loads(str(rows[0][0]))
+
+    def set(self, key, value):
+        self._execute("INSERT OR REPLACE INTO fullblog_cache "
+                      "(key, value, time) VALUES (?, ?, ?)",
+                      (_hash_key(key),
+                       buffer(cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)),
+                       time.time()))
+        self._writes += 1
+        if self._writes % self.prune_interval == 0:
+            self.prune()
+
+    def delete(self, key):
+        self._execute("DELETE FROM fullblog_cache WHERE key=?",
+                      (_hash_key(key),))
+
+    def clear(self):
+        self._execute("DELETE FROM fullblog_cache")
+
+    def prune(self):
+        """ Evicts the oldest items if there are more than `size` items. """
+        self._execute("DELETE FROM fullblog_cache WHERE key IN ("
+                      "SELECT key FROM fullblog_cache "
+                      "ORDER BY time DESC, rowid DESC LIMIT -1 OFFSET ?)",
+                      (self.size,))
+
+    def __len__(self):
+        return self._execute("SELECT count(*) FROM fullblog_cache")[0][0]
+
+    def _execute(self, sql, args=()):
+        """ Executes a statement using a new connection, as the connection
+        can not be shared by threads. Returns the rows of a query. """
+        import sqlite3
+        try:
+            cnx = sqlite3.connect(self.path, timeout=self.timeout)
+            try:
+                if not self._initialized:
+                    cnx.execute("CREATE TABLE IF NOT EXISTS fullblog_cache "
+                                "(key text PRIMARY KEY, value blob, "
+                                "time real)")
+                    self._initialized = True
+                rows = cnx.execute(sql, args).fetchall()
+                cnx.commit()
+                return rows
+            finally:
+                cnx.close()
+        except sqlite3.Error, e:
+            if self.log:
+                self.log.warning("FullBlog: Cache file %s failed: %s",
+                                 self.path, e)
+            return []
+
+
+class MemcachedCache(CacheBackend):
+    """ Cache stored on memcached servers (list of 'host:port'), that can
+    be shared by several hosts. Keys are prefixed by `prefix`, so
+    environments sharing the servers need distinct prefixes. Eviction is
+    left to the servers. Values the servers refuse to store (like items
+    over the size limit) are logged to `log` (if given). """
+
+    def __init__(self, servers, prefix='fullblog', client=None, log=None):
+        if client is None:
+            try:
+                import memcache
+            except ImportError:
+                raise TracError("The memcached cache backend requires the "
+                                "'python-memcached' package.")
+            client = memcache.Client(servers)
+        self.client = client
+        self.prefix = prefix
+        self.log = log
+
+    def get(self, key, default=None):
+        value = self.client.get(self._key(key))
+        if value is None:
+            return default
+        return value
+
+    def set(self, key, value):
+        if not self.client.set(self._key(key), value) and self.log:
+            self.log.warning("FullBlog: Storing %r in memcached failed "
+                             "(too large or no server).", key)
+
+    def delete(self, key):
+        self.client.delete(self._key(key))
+
+    def clear(self):
+        # Other environments may use the same servers, so all items can not
+        # be flushed - the items are left to be evicted by the servers
+        pass
+
+    def _key(self, key):
+        return '%s:%s' % (self.prefix, _hash_key(key))
@@ -10,23 +10,32 @@ License: BSD
 (c) 2007 ::: www.CodeResort.com - BV Network AS (simon-code@bvnetwork.no)
 """
 
-from time import strftime
+import os
+from collections import OrderedDict
+from hashlib import md5
+from threading import Lock, local
+from time import strftime, time
 
 from genshi.builder import tag
 
 from trac.attachment import ILegacyAttachmentPolicyDelegate
 from trac.core import *
-from trac.config import Option
-from trac.perm import IPermissionRequestor
-from trac.resource import IResourceManager
+from trac.config import IntOption, ListOption, Option
+from trac.perm import IPermissionRequestor, PermissionSystem
+from trac.resource import IResourceManager, Resource
 from trac.util.compat import sorted, set
 from trac.util.text import unicode_unquote
-from trac.util.datefmt import to_datetime, utc
+from trac.util.datefmt import to_datetime, to_timestamp, utc
+from trac.util.html import Markup
+from trac.web.api import IRequestFilter
 from trac.wiki.api import IWikiSyntaxProvider
+from trac.wiki.formatter import format_to
 
 # Relative imports (same package)
-from api import IBlogChangeListener, IBlogManipulator
-from model import BlogPost, get_blog_resources, get_blog_posts
+from api import IBlogChangeListener, IBlogManipulator, IBlogPermissionPolicy
+from cache import CacheView, FileCache, LRUCache, MemcachedCache
+from model import BlogPost, get_blog_categories, get_blog_last_modified, \
+        get_blog_posts, _get_generation, _select_blog_posts
 from util import parse_period
 
 class FullBlogCore(Component):
@@ -37,9 +46,11 @@ class FullBlogCore(Component):
     
     listeners = ExtensionPoint(IBlogChangeListener)
     manipulators = ExtensionPoint(IBlogManipulator)
+    permission_policies = ExtensionPoint(IBlogPermissionPolicy)
     
     implements(IPermissionRequestor, IWikiSyntaxProvider, IResourceManager,
-            ILegacyAttachmentPolicyDelegate)
+            ILegacyAttachmentPolicyDelegate, IBlogChangeListener,
+            IRequestFilter)
 
     # Options
 
@@ -49,15 +60,98 @@ class FullBlogCore(Component):
         %m=month, %d=day, %H=hour, %M=minute, %S=second, $USER.
         Example template string: `%Y/%m/%d/my_topic`""")
 
+    render_cache_size = IntOption('fullblog', 'render_cache_size', 500,
+        """Number of blog posts to keep rendered HTML for, covering both
+        post body and comments. Use 0 to disable the render cache.""")
+
+    render_cache_ttl = IntOption('fullblog', 'render_cache_ttl', 600,
+        """Number of seconds to reuse rendered HTML for. Links to tickets
+        and wiki pages in the HTML (like to missing pages and closed
+        tickets) are updated after this time. Use 0 to reuse rendered HTML
+        until the post changes.""")
+
+    cache_backend = Option('fullblog', 'cache_backend', 'memory',
+        """Where to keep cached blog data like rendered HTML, sidebar
+        statistics and previous/next posts: `memory` (for each process),
+        `file` (shared by processes on the host, see `cache_file`) or
+        `memcached` (shared by hosts, see `cache_servers`).""")
+
+    cache_file = Option('fullblog', 'cache_file', 'fullblog_cache.db',
+        """SQLite file for the `file` cache backend (relative to the
+        environment directory). The cached data is kept between restarts.
+        """)
+
+    cache_servers = ListOption('fullblog', 'cache_servers', '127.0.0.1:11211',
+        doc="""List of memcached servers (`host:port`) for the `memcached`
+        cache backend. Requires the `python-memcached` package.""")
+
+    cache_prefix = Option('fullblog', 'cache_prefix', 'fullblog',
+        """Prefix for keys stored by the `memcached` cache backend. Use
+        a distinct prefix for each environment sharing the servers.""")
+
+    neutral_permission_policies = ListOption('fullblog',
+        'neutral_permission_policies', 'DefaultPermissionPolicy, '
+        'LegacyAttachmentPolicy, ReadonlyWikiPolicy, DefaultWikiPolicy, '
+        'DefaultTicketPolicy',
+        doc="""List of permission policies that make the same decision for
+        all blog posts. Other policies that do not implement
+        `IBlogPermissionPolicy` are asked about each post, which is slow
+        for large blogs.""")
+
     # Constants
 
     reserved_names = ['create', 'view', 'edit', 'delete',
                     'archive', 'category', 'author']
 
+    # Number of neighbour posts fetched in each direction for prev/next
+    neighbour_posts = 5
+
+    # Max. number of renderings kept for each post (flavours, users, ...),
+    # the least recently used are evicted
+    renderings_per_post = 50
+
+    # Max. number of posts with cached prev/next or feed times, and of cached
+    # stats periods
+    prev_next_cache_size = 1000
+    stats_cache_size = 100
+
     def __init__(self):
         if hasattr(self.env, 'systeminfo'):        # removed Trac ~+1.3
             self.env.systeminfo.append(('FullBlog',
                 __import__('tracfullblog', ['__version__']).__version__))
+        # Caches are valid for a given blog generation, read once per request
+        self._request_local = local()
+        # Caches by name, created with the configured backend when needed
+        self._caches = {}
+        self._caches_lock = Lock()
+
+    # IBlogChangeListener methods
+
+    def blog_post_changed(self, postname, version):
+        self._changed(postname)
+
+    def blog_post_deleted(self, postname, version, fields):
+        self._changed(postname)
+
+    def blog_comment_added(self, postname, number):
+        self._changed(postname)
+
+    def blog_comment_deleted(self, postname, number, fields):
+        self._changed(postname)
+
+    # IRequestFilter methods
+
+    def pre_process_request(self, req, handler):
+        # All state is replaced, as post_process_request() is skipped for
+        # requests ending early (redirects, 304 responses, ...)
+        self._request_local.__dict__.clear()
+        self._request_local.in_request = True
+        self.forget_generation()
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        self._request_local.__dict__.clear()
+        return template, data, content_type
 
     # IPermissionRequestor method
     
@@ -114,8 +208,20 @@ class FullBlogCore(Component):
             return 'Blog: '+bp.title
 
     def resource_exists(self, resource):
-        bp = BlogPost(self.env, resource.id)
-        return len(bp.versions)
+        sql = "SELECT name FROM fullblog_posts WHERE name=%s"
+        args = (resource.id,)
+        if resource.version:
+            sql += " AND version=%s"
+            args += (resource.version,)
+        else:
+            sql += " AND is_current=1"
+        if hasattr(self.env, 'db_query'):
+            return bool(self.env.db_query(sql, args))
+        else:
+            db = self.env.get_db_cnx()
+            cursor = db.cursor()
+            cursor.execute(sql, args)
+            return bool(cursor.fetchall())
 
     # IWikiSyntaxProvider methods
 
@@ -179,23 +285,138 @@ class FullBlogCore(Component):
             db.commit()
         return True
     
+    def get_visible_posts(self, perm, limit=0, before=None, **criteria):
+        """ Returns a page of posts (BlogPost instances) that can be viewed
+        with the given permission cache. Posts are fetched in chunks until
+        the page is full, so that posts filtered out by permissions do not
+        cause short pages.
+        * Use `limit` for page size (0 for all posts) and `before` as
+          (publish_time, name) cursor for where the page starts.
+        * Other keyword arguments are passed on to BlogPost.select()
+          as selection criteria.
+        Returns a (posts, more) tuple where 'more' is True if further posts
+        exist after the returned page. """
+        chunk_size = limit and limit + 1 or 0
+        posts = list(self.iter_visible_posts(perm, chunk_size, before,
+                                             chunk_size, **criteria))
+        if limit and len(posts) > limit:
+            return posts[:limit], True
+        return posts, False
+
+    def iter_visible_posts(self, perm, limit=0, before=None, chunk_size=20,
+                           **criteria):
+        """ Generates up to `limit` posts (all if 0) that can be viewed with
+        the given permission cache, in the same order and using the same
+        arguments as get_visible_posts(). Posts are fetched lazily in chunks
+        of `chunk_size` (0 for all at once) as the generator is consumed. """
+        if limit and chunk_size:
+            chunk_size = min(limit, chunk_size)
+        count = 0
+        while True:
+            chunk = BlogPost.select(self.env, limit=chunk_size, before=before,
+                                    **criteria)
+            permitted = set(self.filter_permitted(perm,
+                                        [bp.name for bp in chunk]))
+            for bp in chunk:
+                if not bp.name in permitted:
+                    continue
+                yield bp
+                count += 1
+                if limit and count == limit:
+                    return
+            if not chunk_size or len(chunk) < chunk_size:
+                return
+            before = (chunk[-1].publish_time, chunk[-1].name)
+
+    def get_page_cursor(self, perm, count, before=None, newer=False,
+                        **criteria):
+        """ Returns the (publish_time, name) cursor of the post `count`
+        viewable posts away from the `before` cursor, going to older posts
+        (or to newer posts if `newer`). Returns None if there are fewer
+        posts. Only the post metadata is read, for finding where a page
+        starts without loading the posts of the pages in between. Other
+        keyword arguments are selection criteria as for
+        get_visible_posts(). """
+        while count > 0:
+            chunk_size = count
+            rows = _select_blog_posts(self.env, ['publish_time', 'name'],
+                        limit=chunk_size, before=before, reverse=newer,
+                        **criteria)
+            permitted = set(self.filter_permitted(perm,
+                                        [name for t, name in rows]))
+            for post_time, name in rows:
+                before = (to_datetime(post_time, utc), name)
+                if name in permitted:
+                    count -= 1
+                    if not count:
+                        return before
+            if len(rows) < chunk_size:
+                return None
+        return before
+
+    def get_last_modified(self, post_name='', comments=False):
+        """ Returns (last_modified, generation) for all posts, or just
+        `post_name` if set: The time of the most recent version (or
+        comment, when `comments` is True) as returned by
+        get_blog_last_modified(), and the blog generation. The time is
+        cached until the blog changes, so checking if a feed has changed
+        does not read all post versions. """
+        generation = self.get_generation()
+        cache = self._get_cache('last_modified')
+        key = (post_name, comments)
+        last_time = cache.get_for_generation(key, generation)
+        if last_time is None:
+            last_modified = get_blog_last_modified(self.env, post_name,
+                                                   comments)[0]
+            # Cached as timestamp (or 0), as shared backends need to pickle it
+            last_time = last_modified and to_timestamp(last_modified) or 0
+            cache.set_for_generation(key, last_time, generation)
+        return last_time and to_datetime(last_time, utc) or None, generation
+
     def get_prev_next_posts(self, perm, post_name):
         """ Returns the name of the next and previous posts when compared with
-        input 'post_name'. """
-        prev = next = marker = ''
-        found = False
-        for post in get_blog_resources(self.env):
-            if not 'BLOG_VIEW' in perm(post):
-                continue
-            if post.id == post_name:
-                next = marker
-                found = True
-                continue
-            if found:
-                prev = post.id
-                break
-            marker = post.id
-        return prev, next
+        input 'post_name'. The nearest posts are fetched and cached for each
+        post, and only further posts are fetched if all of them are filtered
+        out by permissions. """
+        generation = self.get_generation()
+        cache = self._get_cache('prev_next')
+        cached = cache.get_for_generation(post_name, generation)
+        if cached is None:
+            rows = _select_blog_posts(self.env, ['publish_time'],
+                                      names=[post_name])
+            if not rows:
+                return '', ''
+            cursor = (to_datetime(rows[0][0], utc), post_name)
+            # Cached with timestamps, as shared backends need to pickle it
+            cached = [[(to_timestamp(post_time), name) for post_time, name
+                       in self._get_neighbour_posts(cursor, newer)]
+                      for newer in (False, True)]
+            cache.set_for_generation(post_name, cached, generation)
+        older, newer = [[(to_datetime(post_time, utc), name)
+                         for post_time, name in neighbours]
+                        for neighbours in cached]
+        return (self._first_visible_post(perm, older, False),
+                self._first_visible_post(perm, newer, True))
+
+    def get_generation(self):
+        """ Returns the blog generation - a value in the `system` table that
+        changes with every change to blog posts or comments, by any process.
+        Cached data that depends on the blog is kept with the generation it
+        was read for, and is only used while the generation is the same.
+        The value is read at most once per request. """
+        generation = getattr(self._request_local, 'generation', None)
+        if generation is None:
+            generation = _get_generation(self.env)
+            if getattr(self._request_local, 'in_request', False):
+                self._request_local.generation = generation
+        return generation
+
+    def forget_generation(self):
+        """ Makes the next get_generation() read the value again, like
+        after changes made by the current request. Permission decisions
+        remembered for the request are forgotten too. """
+        self._request_local.generation = None
+        self._request_local.decisions = {}
 
     # CRUD methods that support input verification and listener and manipulator APIs
     
@@ -304,33 +525,304 @@ class FullBlogCore(Component):
         * Use 'from_dt' and 'to_dt' (datetime objects) to restrict search to
         posts with a publish_time within the intervals (None means ignore).
         * If user and perm is provided, the list is also filtered for permissions.
-        * Note also that it only fetches from most recent version. """
-        blog_posts = get_blog_posts(self.env, from_dt=from_dt, to_dt=to_dt)
+        * Note also that it only fetches from most recent version.
+        The counts for all posts are cached until the blog changes, and only
+        posts that may be restricted by permission policies are checked. """
+        generation = self.get_generation()
+        cache = self._get_cache('stats')
+        stats = cache.get_for_generation((from_dt, to_dt), generation)
+        if stats is None:
+            stats = self._get_post_stats(from_dt, to_dt) + (None,)
+            cache.set_for_generation((from_dt, to_dt),
+                                     self._get_cached_stats(stats),
+                                     generation)
+        m_dict, a_dict, c_dict, total, post_stats, details = stats
+        if user and perm:
+            # Check permissions, and remove counts for posts not allowed
+            m_dict, a_dict, c_dict = m_dict.copy(), a_dict.copy(), c_dict.copy()
+            restricted = self._get_restricted_posts()
+            if details is not None and (restricted is None
+                                        or not details.issuperset(restricted)):
+                # Not all the posts to check are in the cached stats
+                post_stats = self._get_post_stats(from_dt, to_dt)[4]
+            if restricted is None:
+                restricted = post_stats.keys()
+            restricted = [name for name in restricted if name in post_stats]
+            permitted = set(self.filter_permitted(perm, restricted))
+            for name in restricted:
+                if name in permitted:
+                    continue
+                month, author, categories = post_stats[name]
+                m_dict[month] -= 1
+                a_dict[author] -= 1
+                for category in categories:
+                    c_dict[category] -= 1
+                total -= 1
+        return ([(m, m_dict[m]) for m in sorted(m_dict.keys(), reverse=True)
+                    if m_dict[m]],
+                [(a, a_dict[a]) for a in sorted(a_dict.keys()) if a_dict[a]],
+                [(c, c_dict[c]) for c in sorted(c_dict.keys()) if c_dict[c]],
+                total)
+
+    def filter_permitted(self, perm, names, action='BLOG_VIEW'):
+        """ Returns the post `names` (current versions) that `action` is
+        permitted for with the given permission cache, in the same order.
+        The posts are checked in one batch, and decisions are remembered for
+        the rest of the request. Same as checking `action in perm(resource)`
+        for each post, but only blog permission policies are asked about
+        the posts they restrict, and for many posts at once if they
+        implement `IBlogPermissionPolicy.check_blog_permissions()`. """
+        if getattr(self._request_local, 'in_request', False):
+            remembered = getattr(self._request_local, 'decisions', None)
+            if remembered is None:
+                remembered = self._request_local.decisions = {}
+        else:
+            remembered = {}
+        decisions = {}
+        unknown = set()
+        for name in names:
+            key = (perm.username, action, name)
+            if key in remembered:
+                decisions[name] = remembered[key]
+            else:
+                unknown.add(name)
+        if unknown:
+            found = self._check_permissions(perm, action, unknown)
+            for name, decision in found.iteritems():
+                remembered[(perm.username, action, name)] = decision
+            decisions.update(found)
+        return [name for name in names if decisions[name]]
+
+    def render_wiki(self, context, obj, text, flavor=None, cache=True):
+        """ Renders wiki `text` belonging to a blog post or comment `obj`
+        like `format_to()`, reusing earlier renderings from the render cache.
+        Renderings are kept per post, keyed by post version or comment number,
+        the rendering hints of the context, the user, locale and timezone of
+        the request and the text itself, for `render_cache_ttl` seconds.
+        Use `cache=False` for previews, as unsaved text is not cached (nor
+        posts and comments not yet saved). """
+        if hasattr(obj, 'post_name'): # BlogComment
+            name, key = obj.post_name, ('comment', obj.number)
+        else:
+            name, key = obj.name, ('post', obj.version)
+        if not text or not cache or not key[1] \
+                or self.render_cache_size <= 0:
+            return format_to(self.env, flavor, context, text)
+        if hasattr(context, 'get_hint'):
+            hints = (flavor or context.get_hint('wiki_flavor', 'html'),
+                     context.get_hint('absurls', False),
+                     context.get_hint('shorten_lines', False),
+                     context.get_hint('preserve_newlines', False))
+        else:
+            hints = (flavor,)
+        req = getattr(context, 'req', None)
+        tz = getattr(req, 'tz', None)
+        key += hints + (getattr(context.href, 'base', None),
+                        context.perm and context.perm.username or None,
+                        str(getattr(req, 'locale', None)),
+                        getattr(tz, 'zone', None) or repr(tz),
+                        md5(text.encode('utf-8')).hexdigest())
+        renderings = self._get_renderings(name)
+        now = time()
+        cached = renderings.get(key)
+        if cached is not None and (self.render_cache_ttl <= 0
+                                   or cached[0] > now - self.render_cache_ttl):
+            if renderings.keys().index(key) < len(renderings) // 2:
+                # Only moved when among the least recently used, so that
+                # using the renderings does not always write to the cache
+                renderings = OrderedDict(renderings)
+                renderings[key] = renderings.pop(key)
+                self._set_renderings(name, renderings)
+            return Markup(cached[1])
+        html = unicode(format_to(self.env, flavor, context, text))
+        renderings = OrderedDict(renderings)
+        renderings.pop(key, None)
+        renderings[key] = (now, html)
+        while len(renderings) > self.renderings_per_post:
+            renderings.popitem(last=False)
+        self._set_renderings(name, renderings)
+        return Markup(html)
+
+    # Internal methods
+
+    def _changed(self, postname=None):
+        """ Invalidates cached content following a change to the blog.
+        Caches in other processes see the new generation instead. """
+        self.forget_generation()
+        if postname and self.render_cache_size > 0:
+            self._get_cache('render').delete(postname)
+
+    def _get_renderings(self, name):
+        """ Returns the cached renderings for a post, as an ordered dict of
+        key -> (time, html) with the most recently used last. """
+        return self._get_cache('render').get(name) or OrderedDict()
+
+    def _set_renderings(self, name, renderings):
+        self._get_cache('render').set(name, renderings)
+
+    def _get_cache(self, name):
+        """ Returns the cache for a named part of the blog data ('render',
+        'prev_next', 'last_modified' or 'stats'), using the configured cache
+        backend. """
+        cache = self._caches.get(name)
+        if cache is None:
+            self._caches_lock.acquire()
+            try:
+                if not name in self._caches:
+                    self._caches[name] = self._create_cache(name)
+                cache = self._caches[name]
+            finally:
+                self._caches_lock.release()
+        return cache
+
+    def _create_cache(self, name):
+        sizes = {'render': max(self.render_cache_size, 0),
+                 'prev_next': self.prev_next_cache_size,
+                 'last_modified': self.prev_next_cache_size,
+                 'stats': self.stats_cache_size}
+        backend = self.cache_backend
+        if not backend in ('file', 'memcached'):
+            if backend != 'memory':
+                self.log.warning("FullBlog: Unknown cache backend %r, "
+                                 "using 'memory'.", backend)
+            return LRUCache(sizes[name])
+        # One shared backend instance for all the caches
+        shared = self._caches.get(None)
+        if shared is None:
+            if backend == 'file':
+                shared = FileCache(os.path.join(self.env.path,
+                                                self.cache_file),
+                                   size=sum(sizes.values()), log=self.log)
+            else:
+                shared = MemcachedCache(self.cache_servers, self.cache_prefix,
+                                        log=self.log)
+            self._caches[None] = shared
+        return CacheView(shared, name)
+
+    def _get_neighbour_posts(self, cursor, newer):
+        """ Returns a list of (publish_time, name) for the nearest older or
+        newer posts compared to the (publish_time, name) cursor. """
+        return [(to_datetime(post_time, utc), name) for post_time, name
+                in _select_blog_posts(self.env, ['publish_time', 'name'],
+                        limit=self.neighbour_posts, before=cursor,
+                        reverse=newer)]
+
+    def _first_visible_post(self, perm, neighbours, newer):
+        """ Returns the name of the first post in the list of neighbours
+        that can be viewed, fetching further posts as needed. """
+        while neighbours:
+            permitted = set(self.filter_permitted(perm,
+                                        [name for t, name in neighbours]))
+            for post_time, name in neighbours:
+                if name in permitted:
+                    return name
+            if len(neighbours) < self.neighbour_posts:
+                break
+            neighbours = self._get_neighbour_posts(neighbours[-1], newer)
+        return ''
+
+    def _get_cached_stats(self, stats):
+        """ Returns the stats to cache. Shared backends send the stats over
+        the wire on each use, so only the counts and the details of posts
+        that may be restricted are kept - `details` is the set of names
+        these are kept for (None if all posts are kept). """
+        if not self.cache_backend in ('file', 'memcached'):
+            return stats
+        m_dict, a_dict, c_dict, total, post_stats, details = stats
+        details = set(self._get_restricted_posts() or ())
+        post_stats = dict([(name, post_stats[name]) for name in details
+                           if name in post_stats])
+        return m_dict, a_dict, c_dict, total, post_stats, details
+
+    def _get_post_stats(self, from_dt=None, to_dt=None):
+        """ Counts posts per month, author and category, fetching only the
+        metadata needed. Returns (m_dict, a_dict, c_dict, total, post_stats),
+        where post_stats holds the (month, author, categories) used for
+        counting each post name. """
         a_dict = {}
         c_dict = {}
         m_dict = {}
-        total = 0
-        for post in blog_posts:
-            if user and perm:
-                # Check permissions
-                bp = BlogPost(self.env, post[0], post[1])
-                if not 'BLOG_VIEW' in perm(bp.resource):
-                    continue # Skip this post
-            post_time = post[2]
-            m_dict[(post_time.year, post_time.month)] = m_dict.get(
-                    (post_time.year, post_time.month), 0) + 1
-            author = post[3]
+        post_stats = {}
+        for name, post_time, author in _select_blog_posts(self.env,
+                    ['name', 'publish_time', 'author'],
+                    from_dt=from_dt, to_dt=to_dt):
+            post_time = to_datetime(post_time, utc)
+            month = (post_time.year, post_time.month)
+            m_dict[month] = m_dict.get(month, 0) + 1
             a_dict[author] = a_dict.get(author, 0) + 1
-            categories = post[6] # a list
-            for category in set(categories):
+            post_stats[name] = (month, author, [])
+        # Categories from the category index
+        for name, category in get_blog_categories(self.env):
+            if name in post_stats:
                 c_dict[category] = c_dict.get(category, 0) + 1
-            total += 1
-        return ([(m, m_dict.get(m, 0)) for m in sorted(m_dict.keys(), reverse=True)],
-                [(a, a_dict.get(a, 0)) for a in sorted(a_dict.keys())],
-                [(c, c_dict.get(c, 0)) for c in sorted(c_dict.keys())],
-                total)
+                post_stats[name][2].append(category)
+        return m_dict, a_dict, c_dict, len(post_stats), post_stats
 
-    # Internal methods
+    def _check_permissions(self, perm, action, names):
+        """ Returns a dict of name -> True/False for checking `action` on
+        the current version of posts, by asking the permission policies in
+        order like the permission system does. """
+        blog_realm = Resource('blog')
+        blog_policies = list(self.permission_policies)
+        decisions = {}
+        undecided = set(names)
+        for policy in PermissionSystem(self.env).policies:
+            if not undecided:
+                break
+            if policy in blog_policies:
+                # Only asked about the posts it restricts
+                restricted = undecided.intersection(
+                                    policy.get_restricted_blog_posts())
+                if not restricted:
+                    continue
+                if hasattr(policy, 'check_blog_permissions'):
+                    found = policy.check_blog_permissions(action,
+                                    perm.username, list(restricted))
+                else:
+                    found = {}
+                    for name in restricted:
+                        resource = blog_realm(id=name)
+                        found[name] = policy.check_permission(action,
+                                    perm.username, resource, perm(resource))
+                for name, decision in found.iteritems():
+                    if decision is not None and name in undecided:
+                        decisions[name] = decision
+                        undecided.remove(name)
+            elif self._is_neutral(policy):
+                # Makes the same decision for all posts
+                resource = blog_realm(id=iter(undecided).next())
+                decision = policy.check_permission(action, perm.username,
+                                    resource, perm(resource))
+                if decision is not None:
+                    for name in undecided:
+                        decisions[name] = decision
+                    undecided.clear()
+            else:
+                # Unknown policy - check the regular way
+                for name in undecided:
+                    decisions[name] = action in perm(blog_realm(id=name))
+                undecided.clear()
+        for name in undecided:
+            decisions[name] = False
+        return decisions
+
+    def _get_restricted_posts(self):
+        """ Returns the set of post names that active permission policies
+        may deny access to, or None if an unknown policy could deny access
+        to any post. """
+        blog_policies = list(self.permission_policies)
+        restricted = set()
+        for policy in PermissionSystem(self.env).policies:
+            if policy in blog_policies:
+                restricted.update(policy.get_restricted_blog_posts())
+            elif not self._is_neutral(policy):
+                return None
+        return restricted
+
+    def _is_neutral(self, policy):
+        """ Returns True if the permission policy is configured to make the
+        same decision for all blog posts. """
+        return policy.__class__.__name__ in self.neutral_permission_policies
     
     def _get_default_postname(self, user=''):
         """ Parses and returns the setting for default_postname. """
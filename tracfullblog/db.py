@@ -14,7 +14,7 @@ from trac.env import IEnvironmentSetupParticipant
 __all__ = ['FullBlogSetup']
 
 # Database version identifier for upgrades.
-db_version = 2
+db_version = 6
 
 # Database schema
 schema = [
@@ -30,7 +30,9 @@ schema = [
         Column('version_author'),
         Column('author'),
         Column('categories'),
-        Index(['version_time'])],
+        Column('is_current', type='int'),
+        Index(['version_time']),
+        Index(['is_current', 'publish_time'])],
     # Blog comments
     Table('fullblog_comments', key=('name', 'number'))[
         Column('name'),
@@ -39,6 +41,18 @@ schema = [
         Column('author'),
         Column('time', type='int'),
         Index(['time'])],
+    # Categories of current blog post versions
+    Table('fullblog_post_categories', key=('name', 'category'))[
+        Column('name'),
+        Column('category'),
+        Index(['category'])],
+    # Full-text search index of current posts (number 0) and comments
+    Table('fullblog_search_terms', key=('term', 'name', 'number'))[
+        Column('term'),
+        Column('name'),
+        Column('number', type='int'),
+        Column('weight', type='int'),
+        Index(['name', 'number'])],
 ]
 
 # Create tables
@@ -63,6 +77,7 @@ def create_tables(env, db):
     cursor.execute("INSERT into system values ('fullblog_version', %s)",
                         str(db_version))
     cursor.execute("INSERT into system values ('fullblog_infotext', '')")
+    cursor.execute("INSERT into system values ('fullblog_generation', '1')")
 
 # Upgrades
 
@@ -74,8 +89,58 @@ def add_timeline_time_indexes(env, db):
     cursor.execute(
         "CREATE INDEX fullblog_posts_version_time_idx ON fullblog_posts (version_time)")
 
+def add_current_version_flag(env, db):
+    """ Add a flag marking the current (most recent) version of each post,
+    so that current posts can be found without a max(version) self-join. """
+    cursor = db.cursor()
+    cursor.execute("ALTER TABLE fullblog_posts ADD COLUMN is_current integer")
+    cursor.execute("UPDATE fullblog_posts SET is_current=0")
+    cursor.execute("SELECT name, max(version) FROM fullblog_posts GROUP BY name")
+    current = list(cursor)
+    cursor.executemany("UPDATE fullblog_posts SET is_current=1 "
+                       "WHERE name=%s AND version=%s", current)
+    cursor.execute("CREATE INDEX fullblog_posts_is_current_publish_time_idx "
+                   "ON fullblog_posts (is_current, publish_time)")
+
+def add_category_index(env, db):
+    """ Add a table indexing the categories of current blog posts,
+    populated from the existing posts. """
+    from tracfullblog.model import _parse_categories
+    cursor = db.cursor()
+    for table in schema:
+        if table.name == 'fullblog_post_categories':
+            for stmt in to_sql(env, table):
+                cursor.execute(stmt)
+    cursor.execute("SELECT name, categories FROM fullblog_posts "
+                   "WHERE is_current=1")
+    rows = []
+    for name, categories in list(cursor):
+        rows.extend([(name, category) for category
+                     in set(_parse_categories(categories or ''))])
+    cursor.executemany("INSERT INTO fullblog_post_categories (name, category) "
+                       "VALUES (%s, %s)", rows)
+
+def add_search_index(env, db):
+    """ Add the table for the optional full-text search index. It is
+    populated by `trac-admin <env> fullblog reindex` when enabled. """
+    cursor = db.cursor()
+    for table in schema:
+        if table.name == 'fullblog_search_terms':
+            for stmt in to_sql(env, table):
+                cursor.execute(stmt)
+
+def add_generation(env, db):
+    """ Add the blog generation, changed on every change to blog posts
+    so that processes can tell when their cached post data is stale. """
+    cursor = db.cursor()
+    cursor.execute("INSERT into system values ('fullblog_generation', '1')")
+
 upgrade_map = {
-        2: add_timeline_time_indexes
+        2: add_timeline_time_indexes,
+        3: add_current_version_flag,
+        4: add_category_index,
+        5: add_search_index,
+        6: add_generation
     }
 
 # Component that deals with database setup
@@ -107,11 +172,11 @@ class FullBlogSetup(Component):
         else:
             if hasattr(self.env, 'db_transaction'):
                 with self.env.db_transaction as db:
-                    self._do_upgrades(db)
+                    self._do_upgrades(db, current_ver)
             else:
-                self._do_upgrades(db)
+                self._do_upgrades(db, current_ver)
 
-    def _do_upgrades(self, db):
+    def _do_upgrades(self, db, current_ver):
         while current_ver+1 <= db_version:
             upgrade_map[current_ver+1](self.env, db)
             current_ver += 1
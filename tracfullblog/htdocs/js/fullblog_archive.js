@@ -0,0 +1,16 @@
+/*
+** Collapsible blog archive - the posts of a month are loaded when the
+** month is expanded for the first time.
+*/
+
+jQuery(document).ready(function($) {
+  $("#content a.blog-archive-toggle").click(function() {
+    var month = $(this).closest("div.blog-archive-month");
+    var posts = month.children("div.blog-archive-posts");
+    if (month.hasClass("collapsed") && !posts.children().length) {
+      posts.load(this.href);
+    }
+    month.toggleClass("collapsed");
+    return false;
+  });
+});
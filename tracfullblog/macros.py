@@ -14,7 +14,8 @@ from trac.web.chrome import add_stylesheet, Chrome
 from trac.wiki.api import parse_args
 from trac.wiki.macros import WikiMacroBase
 
-from model import get_blog_posts, BlogPost
+from core import FullBlogCore
+from model import get_blog_posts
 from util import parse_period
 
 class BlogListMacro(WikiMacroBase):
@@ -74,25 +75,25 @@ class BlogListMacro(WikiMacroBase):
         max_size = int(args_dict.get('max_size', 0))
         show_meta = args_dict.get('meta', '') != 'off' and True or False
 
-        # Get blog posts
-        all_posts = get_blog_posts(self.env, author=author, category=category,
-                        from_dt=from_dt, to_dt=to_dt)
-
-        # Trim posts against permissions and count
+        # Get blog posts trimmed against permissions - instances are only
+        # needed for full rendering
+        blog_core = FullBlogCore(self.env)
         post_list = []
         post_instances = []
         if format in ['float', 'full']:
             recent = recent or self.env.config.getint('fullblog', 'num_items_front')
-        recent = recent or len(all_posts)
-        count = 0
-        for post in all_posts:
-            if count == recent:
-                break
-            bp = BlogPost(self.env, post[0])
-            if 'BLOG_VIEW' in formatter.req.perm(bp.resource):
-                count += 1
-                post_instances.append(bp)
-                post_list.append(post)
+            post_instances, more = blog_core.get_visible_posts(
+                        formatter.req.perm, limit=recent, author=author,
+                        category=category, from_dt=from_dt, to_dt=to_dt)
+        else:
+            all_posts = get_blog_posts(self.env, author=author,
+                        category=category, from_dt=from_dt, to_dt=to_dt,
+                        with_body=False)
+            permitted = set(blog_core.filter_permitted(formatter.req.perm,
+                        [post[0] for post in all_posts]))
+            post_list = [post for post in all_posts if post[0] in permitted]
+            if recent:
+                post_list = post_list[:recent]
 
         # Rendering
         add_stylesheet(formatter.req, 'tracfullblog/css/fullblog.css')
@@ -126,8 +127,10 @@ class BlogListMacro(WikiMacroBase):
         """ Renters full blog posts. """
         out = tag.div(class_="blog")
         out.append(tag.div(heading, class_="blog-list-title"))
+        render_wiki = FullBlogCore(self.env).render_wiki
         for post in post_instances:
             data = {'post': post,
+                    'blog_wiki_to_html': render_wiki,
                     'blog_personal_blog': self.config.getbool(
                                                 'fullblog', 'personal_blog'),
                     'list_mode': True,
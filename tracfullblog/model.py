@@ -12,6 +12,7 @@ License: BSD
 import datetime
 
 from trac.attachment import Attachment
+from trac.core import Component
 from trac.resource import Resource
 from trac.search import search_to_sql
 from trac.util.datefmt import to_datetime, to_timestamp, utc
@@ -23,11 +24,15 @@ except ImportError:
     # 0.12 compat - sorted and set should already be part of Python 2.4
     from operator import itemgetter
 
+from cache import LRUCache
 
-__all__ = ['BlogComment', 'BlogPost',
+__all__ = ['BlogComment', 'BlogPost', 'BlogPostCache',
            'search_blog_posts', 'search_blog_comments',
-           'get_blog_posts', 'get_blog_comments',
-           'group_posts_by_month', 'get_blog_resources']
+           'get_blog_posts', 'get_blog_comments', 'get_blog_categories',
+           'get_blog_comment_counts', 'get_blog_last_modified',
+           'get_blog_post_titles',
+           'group_posts_by_month',
+           'get_blog_resources']
 
 # Public functions
 
@@ -48,11 +53,8 @@ def search_blog_posts(env, terms):
         search_clause, args = search_to_sql(db, columns, terms)
     sql = "SELECT bp1.name, bp1.version, bp1.publish_time, bp1.author, " \
                "bp1.title, bp1.body " \
-               "FROM fullblog_posts bp1," \
-               "(SELECT name, max(version) AS ver " \
-               "FROM fullblog_posts GROUP BY name) bp2 " \
-               "WHERE bp1.version = bp2.ver AND bp1.name = bp2.name " \
-               "AND " + search_clause
+               "FROM fullblog_posts bp1 " \
+               "WHERE bp1.is_current=1 AND " + search_clause
     # perform search
     if hasattr(env, 'db_query'):
         cursor = env.db_query(sql, args)
@@ -92,7 +94,7 @@ def search_blog_comments(env, terms):
             for row in cursor]
 
 def get_blog_posts(env, category='', author='', from_dt=None, to_dt=None,
-        all_versions=False):
+        all_versions=False, limit=0, before=None, with_body=True):
     """ Utility method to fetch one or more posts from the database.
 
     Needs one or more selection criteria (empty will not restrict search):
@@ -101,68 +103,34 @@ def get_blog_posts(env, category='', author='', from_dt=None, to_dt=None,
      * from_dt - posted on or after the given time (datetime)
      * to_dt - posted on or before the given time (datetime)
      * all_versions - if all versions are needed, like for timeline display
+
+    For fetching a page of posts at a time:
+     * limit - max number of posts to return (0 for all)
+     * before - (publish_time, name) of the last post from previous page,
+       to only return posts following it in the list
     
     Note: For datetime criteria the 'publish_time' is the default field searched,
     but if all_versions is requested the 'version_time' is used instead.
+
+    Use with_body=False for listings that only need the metadata, to not
+    read the body of posts (returned as None).
     
     Returns a list of tuples of the form:
         (name, version, time, author, title, body, category_list)
-    Use 'name' and 'version' to instantiate BlogPost objects."""
-
-    # Get db.like() text for reuse
-    if hasattr(env, 'db_query'):
-        with env.db_query as db:
-            db_like = db.like()
-    else:
-        db = env.get_db_cnx()
-        db_like = db.like()
-
-    # Build SQL with list of WHERE restrictions
-    time_field = 'bp1.publish_time'
-    join_operation = ",(SELECT name, max(version) AS ver " \
-                     "FROM fullblog_posts GROUP BY name) bp2 " \
-                     "WHERE bp1.version = bp2.ver AND bp1.name = bp2.name "
-    where_clause = ""
-    args = None
-    if all_versions:
-        time_field = 'bp1.version_time'
-        join_operation = ""
-    clauses = [category and ("bp1.categories "+db_like, "%"+category+"%"),
-            author and ("bp1.author=%s", author) or None,
-            from_dt and (time_field+">%s", to_timestamp(from_dt)) or None,
-            to_dt and (time_field+"<%s", to_timestamp(to_dt)) or None]
-    clauses = [arg for arg in clauses if arg]  # Ignore the None values
-    if clauses:
-        where_start = "AND "
-        if not join_operation:
-            where_start = "WHERE "
-        where_clause = where_start + " AND ".join([arg[0] for arg in clauses])
-        args = tuple([arg[1] for arg in clauses])
-    sql = "SELECT bp1.name, bp1.version, bp1.publish_time, bp1.author, " \
-               "bp1.title, bp1.body, bp1.categories " \
-               "FROM fullblog_posts bp1 " \
-               + join_operation + where_clause \
-               + " ORDER BY bp1.publish_time DESC"
-
-    # Execute SQL
-    if hasattr(env, 'db_query'):
-        with env.db_query as db:
-            cursor = env.db_query(sql, args)
-    else:
-        db = env.get_db_cnx()
-        cursor = db.cursor()
-        cursor.execute(sql, args)
+    Use 'name' and 'version' to instantiate BlogPost objects, or use
+    BlogPost.select() to get fully populated instances in one go."""
 
-    # Return the rows
+    columns = ['name', 'version', 'publish_time', 'author', 'title',
+               'categories']
+    if with_body:
+        columns.append('body')
     blog_posts = []
-    for row in cursor:
-        # Extra check needed to weed out almost-matches where requested
-        # category is a substring of another (searched using LIKE)
-        categories = _parse_categories(row[6])
-        if category and category not in categories:
-            continue
+    for row in _select_blog_posts(env, columns, category=category,
+                    author=author, from_dt=from_dt, to_dt=to_dt,
+                    all_versions=all_versions, limit=limit, before=before):
         blog_posts.append((row[0], row[1], to_datetime(row[2], utc), row[3],
-                row[4], row[5], categories))
+                row[4], with_body and row[6] or None,
+                _parse_categories(row[5])))
     return blog_posts
 
 def get_blog_comments(env, post_name='', from_dt=None, to_dt=None):
@@ -200,13 +168,66 @@ def get_blog_comments(env, post_name='', from_dt=None, to_dt=None):
     return [(row[0], row[1], row[2], row[3], to_datetime(row[4], utc))
             for row in cursor]
 
+def get_blog_categories(env, names=None):
+    """ Returns a list of (post_name, category) tuples for the categories of
+    current posts, optionally restricted to a list of post `names`. """
+    if names is None:
+        return _query(env, "SELECT name, category "
+                           "FROM fullblog_post_categories")
+    categories = []
+    for chunk in _chunks(names):
+        categories.extend(_query(env, "SELECT name, category "
+                "FROM fullblog_post_categories WHERE name IN (%s)"
+                % ", ".join(["%s"] * len(chunk)), tuple(chunk)))
+    return categories
+
+def get_blog_comment_counts(env, names):
+    """ Returns a dict with the number of comments for each of the post
+    `names`, without loading the comments. """
+    counts = dict([(name, 0) for name in names])
+    for chunk in _chunks(names):
+        sql = "SELECT name, count(*) FROM fullblog_comments " \
+              "WHERE name IN (%s) GROUP BY name" \
+              % ", ".join(["%s"] * len(chunk))
+        for name, count in _query(env, sql, tuple(chunk)):
+            counts[name] = count
+    return counts
+
+def get_blog_post_titles(env, names):
+    """ Returns a dict with the title of the current version for each of
+    the post `names` that exist. """
+    titles = {}
+    for chunk in _chunks(names):
+        sql = "SELECT name, title FROM fullblog_posts " \
+              "WHERE is_current=1 AND name IN (%s)" \
+              % ", ".join(["%s"] * len(chunk))
+        titles.update(_query(env, sql, tuple(chunk)))
+    return titles
+
+def get_blog_last_modified(env, post_name='', comments=False):
+    """ Returns a (last_modified, versions, comments) tuple summarizing
+    changes to all posts, or just `post_name` if set, without loading any
+    post content: The time of the most recent version (or comment, when
+    `comments` is True) and the number of post versions and comments.
+    The numbers change with deletions that do not move the time.
+    last_modified is None if there are no posts. """
+    where, args = post_name and (" WHERE name=%s", (post_name,)) or ('', ())
+    last_time, num_versions = _query(env, "SELECT max(version_time), "
+            "count(*) FROM fullblog_posts" + where, args)[0]
+    num_comments = 0
+    if comments:
+        comment_time, num_comments = _query(env, "SELECT max(time), "
+                "count(*) FROM fullblog_comments" + where, args)[0]
+        last_time = max(last_time, comment_time)
+    if last_time is None:
+        return None, 0, 0
+    return to_datetime(last_time, utc), num_versions, num_comments
+
 def get_blog_resources(env):
     """ Returns a list of resource instances of existing blog posts (current
     version). The list is ordered by publish_time (newest first). """
-    sql = "SELECT bp1.name FROM fullblog_posts bp1, " \
-          "(SELECT name, max(version) AS ver FROM fullblog_posts " \
-          "GROUP BY name) bp2 WHERE bp1.name = bp2.name AND " \
-          "bp1.version = ver ORDER BY bp1.publish_time DESC"
+    sql = "SELECT bp1.name FROM fullblog_posts bp1 " \
+          "WHERE bp1.is_current=1 ORDER BY bp1.publish_time DESC, bp1.name"
     if hasattr(env, 'db_query'):
         cursor = env.db_query(sql)
     else:
@@ -248,8 +269,250 @@ def group_posts_by_month(posts):
             grouped_list.append((current_period, posts_per_month))
     return grouped_list
 
+# Caching of post metadata
+
+class BlogPostCache(Component):
+    """ Process-wide cache of blog post metadata, used when loading posts.
+
+    The list of versions for each post, and the fields of post versions
+    (except the deferred body and version comment) by name, version and
+    version time, are cached together with the blog generation (see
+    `FullBlogCore.get_generation()`), so that changes made by other
+    processes are noticed. The version time alone is not enough for the
+    fields, as a deleted version can be saved again within a second. """
+
+    # Max. number of posts (versions lists) and post versions kept
+    size = 1000
+
+    def __init__(self):
+        self.fields = LRUCache(self.size)
+        self.versions = LRUCache(self.size)
+
+    def get_versions(self, name):
+        """ Returns the list of (version, version_time) for a post, from
+        the cache if still valid for the current blog generation. """
+        from tracfullblog.core import FullBlogCore
+        generation = FullBlogCore(self.env).get_generation()
+        cached = self.versions.get(name)
+        if cached is not None and generation is not None \
+                and cached[0] == generation:
+            return cached[1]
+        versions = _fetch_versions(self.env, name)
+        self.versions.set(name, (generation, versions))
+        return versions
+
+    def get_fields(self, key):
+        """ Returns the cached fields of a post version, if still valid for
+        the current blog generation. """
+        from tracfullblog.core import FullBlogCore
+        return self.fields.get_for_generation(key,
+                                    FullBlogCore(self.env).get_generation())
+
+    def set_fields(self, key, fields):
+        """ Caches the fields of a post version for the blog generation. """
+        from tracfullblog.core import FullBlogCore
+        self.fields.set_for_generation(key, fields,
+                                    FullBlogCore(self.env).get_generation())
+
+    def invalidate(self, name):
+        """ Forgets the versions of a post changed by this process. """
+        from tracfullblog.core import FullBlogCore
+        self.versions.delete(name)
+        FullBlogCore(self.env).forget_generation()
+
 # Internal functions
-    
+
+# Max number of arguments to pass in one 'IN (...)' clause
+_IN_CHUNK_SIZE = 500
+
+def _query(env, sql, args=None):
+    """ Executes a SELECT and returns the rows as a list. """
+    if hasattr(env, 'db_query'):
+        return list(env.db_query(sql, args))
+    else:
+        db = env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute(sql, args)
+        return cursor.fetchall()
+
+def _transaction(env, do_execute):
+    """ Calls `do_execute(cursor)` inside a transaction, committing if
+    no errors occur. Returns the value returned by do_execute(). """
+    if hasattr(env, 'db_transaction'):
+        with env.db_transaction as db:
+            return do_execute(db.cursor())
+    else:
+        db = env.get_db_cnx()
+        try:
+            result = do_execute(db.cursor())
+            db.commit()
+            return result
+        except:
+            db.rollback()
+            raise
+
+def _retry_transaction(env, do_execute, retries=5):
+    """ Calls `do_execute(cursor)` inside a transaction like _transaction(),
+    but retries the transaction if it fails on an integrity error - like
+    when a concurrent transaction has inserted a row using the same key. """
+    if hasattr(env, 'db_exc'):
+        integrity_error = env.db_exc.IntegrityError
+    else:
+        integrity_error = Exception
+    for attempt in range(retries):
+        try:
+            return _transaction(env, do_execute)
+        except integrity_error, e:
+            if attempt == retries - 1:
+                raise
+            env.log.debug("FullBlog: Retrying transaction after "
+                          "integrity error: %s" % e)
+
+def _update_category_index(cursor, name, categories):
+    """ Replaces the indexed categories for the post with the categories
+    of the current version. """
+    cursor.execute("DELETE FROM fullblog_post_categories WHERE name=%s",
+                   (name,))
+    cursor.executemany("INSERT INTO fullblog_post_categories "
+                       "(name, category) VALUES (%s, %s)",
+                       [(name, category) for category
+                        in set(_parse_categories(categories or ''))])
+
+def _fetch_versions(env, name):
+    """ Returns a sorted list of (version, version_time) for a post. """
+    return sorted([(version, version_time) for version, version_time
+                   in _query(env, "SELECT version, version_time "
+                             "FROM fullblog_posts WHERE name=%s", (name,))])
+
+def _get_generation(env):
+    """ Returns the current blog generation, or None if not available. """
+    rows = _query(env, "SELECT value FROM system "
+                  "WHERE name='fullblog_generation'")
+    return rows and rows[0][0] or None
+
+def _cast_int(env, column):
+    """ Returns a clause casting `column` to an integer, using the cast of
+    the database connector (MySQL has no `CAST(... AS integer)`). """
+    if hasattr(env, 'db_query'):
+        with env.db_query as db:
+            return db.cast(column, 'int')
+    db = env.get_db_cnx()
+    if hasattr(db, 'cast'):
+        return db.cast(column, 'int')
+    # 0.11 compat - connectors without cast()
+    return 'CAST(%s AS integer)' % column
+
+def _bump_generation(env, cursor):
+    """ Increments the blog generation as part of a transaction changing
+    posts or comments. The increment is done by the database, so that
+    concurrent changes always give distinct generations. """
+    cursor.execute("UPDATE system SET value=%s+1 "
+                   "WHERE name='fullblog_generation'"
+                   % _cast_int(env, 'value'))
+
+def _chunks(items, size=_IN_CHUNK_SIZE):
+    """ Splits a list into smaller lists suitable for 'IN (...)' clauses. """
+    items = list(items)
+    return [items[i:i+size] for i in range(0, len(items), size)]
+
+def _select_blog_posts(env, columns, category='', author='', from_dt=None,
+        to_dt=None, all_versions=False, names=None, limit=0, before=None,
+        reverse=False):
+    """ Returns the raw rows for the (bp1.) `columns` requested using the
+    same criteria as get_blog_posts(). Use `names` to restrict the search
+    to a list of post names. Rows are ordered by publish_time, newest first,
+    and then by name.
+    Use `limit` to restrict the number of rows returned, and `before` as a
+    (publish_time, name) cursor to only return rows ordered after the cursor.
+    Use `reverse` to get rows in opposite order (oldest first).
+    Category criteria is looked up in the category index, except for
+    all_versions where the parsed 'categories' value is verified, weeding out
+    almost-matches where requested category is a substring of another
+    (searched using LIKE). """
+    # Get db.like() text for reuse
+    if hasattr(env, 'db_query'):
+        with env.db_query as db:
+            db_like = db.like()
+    else:
+        db = env.get_db_cnx()
+        db_like = db.like()
+
+    # Build SQL with list of WHERE restrictions
+    time_field = 'bp1.publish_time'
+    current_clause = "WHERE bp1.is_current=1 "
+    if all_versions:
+        time_field = 'bp1.version_time'
+        current_clause = ""
+    if all_versions:
+        # Only current categories are indexed, so search the text
+        category_clause = category and ("bp1.categories "+db_like,
+                                        "%"+category+"%")
+    else:
+        category_clause = category and ("bp1.name IN (SELECT name "
+                "FROM fullblog_post_categories WHERE category=%s)", category)
+    clauses = [category_clause,
+            author and ("bp1.author=%s", author) or None,
+            from_dt and (time_field+">%s", to_timestamp(from_dt)) or None,
+            to_dt and (time_field+"<%s", to_timestamp(to_dt)) or None]
+    clauses = [arg for arg in clauses if arg]  # Ignore the None values
+    select_columns = list(columns)
+    for column in ['name', 'publish_time', 'categories']:
+        if not column in select_columns:
+            select_columns.append(column)
+    name_index = select_columns.index('name')
+    time_index = select_columns.index('publish_time')
+    cat_index = select_columns.index('categories')
+    sql = "SELECT " + ", ".join(['bp1.' + c for c in select_columns]) + \
+          " FROM fullblog_posts bp1 " + current_clause
+
+    def fetch(chunk, before):
+        where = [arg[0] for arg in clauses]
+        args = [arg[1] for arg in clauses]
+        if chunk is not None:
+            where.append("bp1.name IN (%s)" % ", ".join(["%s"] * len(chunk)))
+            args.extend(chunk)
+        if before and reverse:
+            where.append("(bp1.publish_time>%s OR "
+                         "(bp1.publish_time=%s AND bp1.name<%s))")
+            args.extend([before[0], before[0], before[1]])
+        elif before:
+            where.append("(bp1.publish_time<%s OR "
+                         "(bp1.publish_time=%s AND bp1.name>%s))")
+            args.extend([before[0], before[0], before[1]])
+        where_clause = ""
+        if where:
+            where_clause = (current_clause and "AND " or "WHERE ") \
+                           + " AND ".join(where)
+        return _query(env, sql + where_clause
+                    + (reverse and " ORDER BY bp1.publish_time, bp1.name DESC"
+                        or " ORDER BY bp1.publish_time DESC, bp1.name")
+                    + (limit and " LIMIT %d" % limit or ""),
+                    tuple(args) or None)
+
+    if before:
+        before = (to_timestamp(before[0]), before[1])
+    rows = []
+    for chunk in names is None and [None] or _chunks(names):
+        chunk_before = before
+        while True:
+            found = fetch(chunk, chunk_before)
+            if category and all_versions:
+                rows.extend([row for row in found
+                        if category in _parse_categories(row[cat_index])])
+            else:
+                rows.extend(found)
+            if not limit or len(found) < limit or len(rows) >= limit:
+                break
+            # Category almost-matches removed - fetch more to fill the limit
+            chunk_before = (found[-1][time_index], found[-1][name_index])
+    if names is not None and len(names) > _IN_CHUNK_SIZE:
+        # Merge ordering of the chunks
+        rows.sort(key=itemgetter(name_index), reverse=reverse)
+        rows.sort(key=itemgetter(time_index), reverse=not reverse)
+    if limit:
+        rows = rows[:limit]
+    return [row[:len(columns)] for row in rows]
+
 def _parse_categories(categories, sep=' '):
     """ Parses the string containing categories separated by sep.
     Internal method, used in case we want to change split strategy later. """
@@ -279,6 +542,23 @@ class BlogComment(object):
         if number:
             self._load_comment(number)
     
+    @classmethod
+    def select(cls, env, post_name='', from_dt=None, to_dt=None):
+        """ Returns a list of BlogComment instances built from a single
+        query, using the same criteria as get_blog_comments(). The list is
+        sorted by post name and comment number. """
+        comments = []
+        for name, number, comment, author, time in sorted(
+                get_blog_comments(env, post_name=post_name, from_dt=from_dt,
+                                  to_dt=to_dt), key=itemgetter(0, 1)):
+            bc = cls(env, name)
+            bc.number = number
+            bc.comment = comment
+            bc.author = author
+            bc.time = time
+            comments.append(bc)
+        return comments
+
     def create(self, comment='', author='', verify_only=False):
         """ Creates a comment in the database.
         Comment and author needs to be set either by passing values
@@ -310,19 +590,24 @@ class BlogComment(object):
         if warnings or verify_only:
             return warnings
         # No problems (we think), try to save.
-        self.env.log.debug("Creating blog comment number %d for %r" % (
-                number, self.post_name))
-        sql = "INSERT INTO fullblog_comments VALUES (%s, %s, %s, %s, %s)"
-        args = (self.post_name, number, comment, author,
-                to_timestamp(self.time))
-        if hasattr(self.env, 'db_transaction'):
-            self.env.db_transaction(sql, args)
-        else:
-            db = self.env.get_db_cnx()
-            cursor = db.cursor()
-            cursor.execute(sql, args)
-            db.commit()
-        self._load_comment(number)
+        time = to_timestamp(self.time)
+        def do_create(cursor):
+            # Number from inside the transaction, retried if taken meanwhile
+            cursor.execute("SELECT max(number) FROM fullblog_comments "
+                           "WHERE name=%s", (self.post_name,))
+            number = (cursor.fetchone()[0] or 0) + 1
+            self.env.log.debug("Creating blog comment number %d for %r" % (
+                    number, self.post_name))
+            cursor.execute("INSERT INTO fullblog_comments "
+                           "(name, number, comment, author, time) "
+                           "VALUES (%s, %s, %s, %s, %s)",
+                           (self.post_name, number, comment, author, time))
+            _bump_generation(self.env, cursor)
+            return number
+        self.number = _retry_transaction(self.env, do_create)
+        self.comment = comment
+        self.author = author
+        self.time = to_datetime(time, utc)
         return warnings
     
     def delete(self):
@@ -330,15 +615,12 @@ class BlogComment(object):
             return False
         self.env.log.debug("Deleting blog comment number %d for %r" % (
                 self.number, self.post_name))
-        sql = "DELETE FROM fullblog_comments WHERE name=%s AND number=%s"
-        args = (self.post_name, self.number)
-        if hasattr(self.env, 'db_transaction'):
-            self.env.db_transaction(sql, args)
-        else:
-            db = self.env.get_db_cnx()
-            cursor = db.cursor()
-            cursor.execute(sql, args)
-            db.commit()
+        def do_delete(cursor):
+            cursor.execute("DELETE FROM fullblog_comments "
+                           "WHERE name=%s AND number=%s",
+                           (self.post_name, self.number))
+            _bump_generation(self.env, cursor)
+        _transaction(self.env, do_delete)
         return True
 
     # Internal methods
@@ -368,24 +650,30 @@ class BlogComment(object):
     def _next_comment_number(self):
         """ Function that returns the next available comment number.
         If no blog post exists (can't attach comment), it returns 0. """
-        sql = "SELECT number FROM fullblog_comments WHERE name=%s"
-        args = (self.post_name,)
-        if hasattr(self.env, 'db_query'):
-            cursor = self.env.db_query(sql, args)
-        else:
-            db = self.env.get_db_cnx()
-            cursor = db.cursor()
-            cursor.execute(sql, args)
-        comments = sorted([row[0] for row in cursor])
-        if comments:
-            return comments[-1] + 1 # Add 1 for next free
+        rows = _query(self.env, "SELECT max(number) FROM fullblog_comments "
+                                "WHERE name=%s", (self.post_name,))
+        if rows and rows[0][0]:
+            return rows[0][0] + 1 # Add 1 for next free
         # No item found - need to double-check to find out why
-        bp = BlogPost(self.env, self.post_name)
-        if bp.get_versions():
+        if _query(self.env, "SELECT name FROM fullblog_posts "
+                            "WHERE name=%s AND is_current=1",
+                            (self.post_name,)):
             return 1
         else:
             return 0
 
+def _deferred_field(field):
+    """ Returns a property for a BlogPost field that is only read from the
+    database when first used. """
+    attr = '_' + field
+    def get_field(self):
+        if not attr in self.__dict__:
+            self._load_deferred_fields()
+        return self.__dict__[attr]
+    def set_field(self, value):
+        self.__dict__[attr] = value
+    return property(get_field, set_field)
+
 class BlogPost(object):
     """ Model class representing a blog post with various methods
     to do CRUD and manipulation as needed by the plugin. """
@@ -404,18 +692,56 @@ class BlogPost(object):
     # Other data - fetched or computed
     category_list = []
     versions = []
+    _comment_count = None
+    # Large fields read on first use for posts loaded by name
+    _deferred_fields = ['body', 'version_comment']
+    body = _deferred_field('body')
+    version_comment = _deferred_field('version_comment')
     
     def __init__(self, env, name, version=0):
-        self.env = env
-        # Expand the default values as object properties
-        for prop in self._db_default_fields.keys():
-            if isinstance(self._db_default_fields[prop], datetime.datetime):
-                # Default will evaluate to initial loading of the class itself
-                setattr(self, prop, datetime.datetime.now(utc))
-            else:
-                setattr(self, prop, self._db_default_fields[prop])
-        self.name = name and name.strip() or name
+        self._init_fields(env, name)
         self._load_post(version)
+
+    @classmethod
+    def select(cls, env, names=None, category='', author='', from_dt=None,
+            to_dt=None, all_versions=False, limit=0, before=None):
+        """ Returns a list of fully populated BlogPost instances, using
+        a fixed number of queries regardless of the number of posts found.
+        Use `names` to fetch a given list of posts, and/or use the same
+        selection and paging criteria as for get_blog_posts(). The list is
+        ordered by publish_time (newest first).
+        If all_versions is requested, an instance for each matching
+        version is returned. """
+        columns = ['name', 'version', 'title', 'body', 'publish_time',
+                   'version_time', 'version_comment', 'version_author',
+                   'author', 'categories']
+        rows = _select_blog_posts(env, columns, category=category,
+                    author=author, from_dt=from_dt, to_dt=to_dt,
+                    all_versions=all_versions, names=names, limit=limit,
+                    before=before)
+        # Fetch all versions and comment counts for the posts found
+        names = set([row[0] for row in rows])
+        comment_counts = get_blog_comment_counts(env, names)
+        versions = {}
+        for chunk in _chunks(names):
+            sql = "SELECT name, version FROM fullblog_posts " \
+                  "WHERE name IN (%s)" % ", ".join(["%s"] * len(chunk))
+            for name, version in _query(env, sql, tuple(chunk)):
+                versions.setdefault(name, []).append(version)
+        blog_posts = []
+        for row in rows:
+            bp = cls.__new__(cls)
+            bp._init_fields(env, row[0])
+            fields = dict(zip(columns[1:], row[1:]))
+            fields['publish_time'] = to_datetime(fields['publish_time'], utc)
+            fields['version_time'] = to_datetime(fields['version_time'], utc)
+            fields['category_list'] = set(
+                                    _parse_categories(fields['categories']))
+            bp._set_fields(fields)
+            bp.versions = sorted(versions.get(row[0], []))
+            bp._comment_count = comment_counts[row[0]]
+            blog_posts.append(bp)
+        return blog_posts
         
     def save(self, version_author, version_comment=u'', verify_only=False):
         """ Saves the post as a new version in the database.
@@ -436,27 +762,34 @@ class BlogPost(object):
         if warnings or verify_only:
             return warnings
         version_time = to_timestamp(datetime.datetime.now(utc))
-        self.versions = sorted(self.get_versions())
-        version = 1
-        if self.versions:
-            version = self.versions[-1] + 1
-        self.env.log.debug("Saving new version %d of blog post %r "
-                "from author %r" % (version, self.name, version_author))
-        sql = "INSERT INTO fullblog_posts " \
-                "(name, version, title, body, publish_time, version_time, " \
-                "version_comment, version_author, author, categories) " \
-                "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
-        args = (self.name, version, self.title, self.body,
+        def do_save(cursor):
+            # Version from inside the transaction, retried if taken meanwhile
+            cursor.execute("SELECT max(version) FROM fullblog_posts "
+                           "WHERE name=%s", (self.name,))
+            version = (cursor.fetchone()[0] or 0) + 1
+            self.env.log.debug("Saving new version %d of blog post %r "
+                    "from author %r" % (version, self.name, version_author))
+            # The new version replaces any previous version as current
+            cursor.execute("UPDATE fullblog_posts SET is_current=0 "
+                           "WHERE name=%s AND is_current=1", (self.name,))
+            cursor.execute("INSERT INTO fullblog_posts "
+                "(name, version, title, body, publish_time, version_time, "
+                "version_comment, version_author, author, categories, "
+                "is_current) "
+                "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, 1)",
+                (self.name, version, self.title, self.body,
                 to_timestamp(self.publish_time), version_time,
-                version_comment, version_author, self.author, self.categories)
-        if hasattr(self.env, 'db_transaction'):
-            self.env.db_transaction(sql, args)
-        else:
-            db = self.env.get_db_cnx()
-            cursor = db.cursor()
-            cursor.execute(sql, args)
-            db.commit()
+                version_comment, version_author, self.author, self.categories))
+            _update_category_index(cursor, self.name, self.categories)
+            _bump_generation(self.env, cursor)
+            return version
+        body = self.body
+        version = _retry_transaction(self.env, do_save)
+        self._invalidate_cache()
         self._load_post(version)
+        # Just saved, so no need to read them again
+        self.body = body
+        self.version_comment = version_comment
         return warnings
     
     def update_fields(self, fields={}):
@@ -488,23 +821,37 @@ class BlogPost(object):
         else:
             sql = "DELETE FROM fullblog_posts WHERE name=%s"
             args = (self.name,)
-        if hasattr(self.env, 'db_transaction'):
-            self.env.db_transaction(sql, args)
-            db = None
-        else:
-            db = self.env.get_db_cnx()
-            cursor = db.cursor()
+        def do_delete(cursor):
             cursor.execute(sql, args)
-            db.commit()
-        if not len(self.get_versions()):
-            # Delete comments
-            for comment in self.get_comments():
-                comment.delete()
-            # Delete attachments
-            if db is not None:
-                Attachment.delete_all(self.env, 'blog', self.name, db)
+            # Make sure the most recent remaining version is current
+            cursor.execute("SELECT max(version) FROM fullblog_posts "
+                           "WHERE name=%s", (self.name,))
+            current = cursor.fetchone()[0]
+            categories = ''
+            if current:
+                cursor.execute("UPDATE fullblog_posts SET is_current=1 "
+                               "WHERE name=%s AND version=%s",
+                               (self.name, current))
+                cursor.execute("SELECT categories FROM fullblog_posts "
+                               "WHERE name=%s AND version=%s",
+                               (self.name, current))
+                categories = cursor.fetchone()[0]
             else:
+                # Delete comments
+                cursor.execute("DELETE FROM fullblog_comments WHERE name=%s",
+                               (self.name,))
+            _update_category_index(cursor, self.name, categories)
+            _bump_generation(self.env, cursor)
+            return current
+        current = _transaction(self.env, do_delete)
+        self._invalidate_cache()
+        if not current:
+            # Delete attachments
+            if hasattr(self.env, 'db_transaction'):
                 Attachment.delete_all(self.env, 'blog', self.name)
+            else:
+                Attachment.delete_all(self.env, 'blog', self.name,
+                                      self.env.get_db_cnx())
         return True
     
     def get_versions(self):
@@ -525,56 +872,116 @@ class BlogPost(object):
         """ Returns a list of used comment numbers attached to the post.
         It instantiates BlogComment objects for comments attached to the
         current BlogPost, and returns them in a list sorted by number. """
-        comments = sorted(get_blog_comments(self.env, post_name=self.name),
-                    key=itemgetter(1))
-        return [BlogComment(self.env, comment[0],
-                        comment[1]) for comment in comments]
+        return BlogComment.select(self.env, post_name=self.name)
+
+    def get_comment_count(self):
+        """ Returns the number of comments attached to the post, without
+        loading the comments. The count is prefetched by select(). """
+        if self._comment_count is None:
+            self._comment_count = get_blog_comment_counts(
+                                    self.env, [self.name])[self.name]
+        return self._comment_count
     
     # Internal methods
     
-    def _fetch_fields(self, version=0):
+    def _fetch_fields(self, version=0, deferred=True):
         """ Returns a dict with field/value combinations for the content
         of a specific version of a blog post, or last/current version if
         version is 0.
-        Returns emtpy dict if no such post or post/version exists. """
-        self.versions = self.get_versions()
+        Returns emtpy dict if no such post or post/version exists.
+        Use deferred=False to leave out the deferred fields (body and
+        version_comment). The other fields are kept in the post cache. """
+        post_cache = self.env[BlogPostCache]
+        versions = post_cache and post_cache.get_versions(self.name)
+        if versions is None:
+            versions = _fetch_versions(self.env, self.name)
+        self.versions = [v for v, version_time in versions]
         if not self.versions or (version and not version in self.versions):
             # No blog post with the name exists
             return {}
         version = version or self.versions[-1]
-        sql = "SELECT title, body, publish_time, version_time, " \
-              "version_comment, version_author, author, categories " \
-              "FROM fullblog_posts " \
-              "WHERE name=%s AND version=%s"
-        args = (self.name, version)
-        if hasattr(self.env, 'db_query'):
-            cursor = self.env.db_query(sql, args)
-        else:
-            db = self.env.get_db_cnx()
-            cursor = db.cursor()
-            cursor.execute(sql, args)
-        fields = {}
-        for row in cursor:
-            fields['version'] = version
-            fields['title'] = row[0]
-            fields['body'] = row[1]
-            fields['publish_time'] = to_datetime(row[2], utc)
-            fields['version_time'] = to_datetime(row[3], utc)
-            fields['version_comment'] = row[4]
-            fields['version_author'] = row[5]
-            fields['author'] = row[6]
-            fields['categories'] = row[7]
-            fields['category_list'] = set(_parse_categories(row[7]))
+        key = (self.name, version, dict(versions)[version])
+        fields = post_cache and post_cache.get_fields(key)
+        if fields is None:
+            sql = "SELECT title, publish_time, version_time, " \
+                  "version_author, author, categories " \
+                  "FROM fullblog_posts " \
+                  "WHERE name=%s AND version=%s"
+            fields = {}
+            for row in _query(self.env, sql, (self.name, version)):
+                fields['version'] = version
+                fields['title'] = row[0]
+                fields['publish_time'] = to_datetime(row[1], utc)
+                fields['version_time'] = to_datetime(row[2], utc)
+                fields['version_author'] = row[3]
+                fields['author'] = row[4]
+                fields['categories'] = row[5]
+            if fields and post_cache:
+                post_cache.set_fields(key, fields)
+        fields = dict(fields)
+        if fields:
+            fields['category_list'] = set(
+                                    _parse_categories(fields['categories']))
+        if fields and deferred:
+            fields.update(self._fetch_deferred_fields(version))
         return fields
 
+    def _invalidate_cache(self):
+        post_cache = self.env[BlogPostCache]
+        if post_cache:
+            post_cache.invalidate(self.name)
+
+    def _fetch_deferred_fields(self, version):
+        """ Returns a dict with the deferred fields of a version. """
+        rows = _query(self.env, "SELECT " + ", ".join(self._deferred_fields)
+                      + " FROM fullblog_posts WHERE name=%s AND version=%s",
+                      (self.name, version))
+        if rows:
+            return dict(zip(self._deferred_fields, rows[0]))
+        return dict([(field, self._db_default_fields[field])
+                     for field in self._deferred_fields])
+
+    def _load_deferred_fields(self):
+        """ Reads the deferred fields of the loaded version, keeping any
+        values already set on the object. """
+        if self.version:
+            values = self._fetch_deferred_fields(self.version)
+        else:
+            values = dict([(field, self._db_default_fields[field])
+                           for field in self._deferred_fields])
+        for field in self._deferred_fields:
+            if not '_' + field in self.__dict__:
+                setattr(self, field, values[field])
+
+    def _init_fields(self, env, name):
+        """ Sets the default values for all fields of the object. """
+        self.env = env
+        # Expand the default values as object properties
+        for prop in self._db_default_fields.keys():
+            if isinstance(self._db_default_fields[prop], datetime.datetime):
+                # Default will evaluate to initial loading of the class itself
+                setattr(self, prop, datetime.datetime.now(utc))
+            else:
+                setattr(self, prop, self._db_default_fields[prop])
+        self.name = name and name.strip() or name
+
+    def _set_fields(self, fields):
+        """ Updates the object from a dict of field values as returned
+        by _fetch_fields(). Also creates a Resource instance for the object."""
+        self.resource = Resource('blog', self.name)
+        for field in fields:
+            setattr(self, field, fields[field])
+
     def _load_post(self, version=0):
         """ Loads the record from the database into the object.
         Will load the most recent if none is specified.
         Also creates a Resource instance for the object."""
         self.resource = Resource('blog', self.name)
-        fields = self._fetch_fields(version)
+        fields = self._fetch_fields(version, deferred=False)
         if not fields:
             return False
-        for field in fields:
-            setattr(self, field, fields[field])
+        self._set_fields(fields)
+        for field in self._deferred_fields:
+            # Read on first use
+            self.__dict__.pop('_' + field, None)
         return True
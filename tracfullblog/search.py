@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+Optional full-text search index for blog posts and comments.
+
+License: BSD
+
+(c) 2007 ::: www.CodeResort.com - BV Network AS (simon-code@bvnetwork.no)
+"""
+
+import re
+
+from trac.core import *
+from trac.config import BoolOption
+from trac.util.compat import set
+from trac.util.datefmt import to_datetime, utc
+from trac.util.text import printout
+
+try:
+    from trac.admin.api import IAdminCommandProvider
+except ImportError:
+    # 0.11 compat - no trac-admin command extensions
+    IAdminCommandProvider = None
+
+from api import IBlogChangeListener
+from model import search_blog_comments, search_blog_posts, \
+        _chunks, _query, _transaction, _IN_CHUNK_SIZE
+
+__all__ = ['FullBlogSearchIndex']
+
+# Terms are words of at least two characters, stored in lower case
+_word_re = re.compile(r'\w+', re.UNICODE)
+_max_term_length = 40
+
+# Relative weight of the indexed fields when ranking results
+_title_weight = 5
+_meta_weight = 2
+
+
+def tokenize(text):
+    """ Returns the list of index terms found in `text`. """
+    return [word.lower()[:_max_term_length]
+            for word in _word_re.findall(text or '') if len(word) > 1]
+
+def _indexed(terms):
+    """ Returns True if the search terms can be looked up in the index -
+    that is, if they only consist of indexed words, and some terms are not
+    exclusions (which need all documents). """
+    for term in terms:
+        words = _word_re.findall(term.lstrip('-'))
+        if not words or [word for word in words if len(word) < 2]:
+            return False
+    return bool([term for term in terms if not term.startswith('-')])
+
+def _prefix_range(word):
+    """ Returns the (lower, upper) bounds of the terms starting with `word`,
+    for a range that can use the index (unlike LIKE). The upper bound has
+    the last character incremented, so it does not depend on how the
+    database sorts characters beyond the prefix. """
+    return word, word[:-1] + unichr(ord(word[-1]) + 1)
+
+def _term_weights(fields):
+    """ Returns a dict of term -> weight for a list of (text, weight). """
+    weights = {}
+    for text, weight in fields:
+        for term in tokenize(text):
+            weights[term] = weights.get(term, 0) + weight
+    return weights
+
+def _index_document(cursor, name, number, fields):
+    """ Replaces the indexed terms for a post (number 0) or comment. """
+    cursor.execute("DELETE FROM fullblog_search_terms "
+                   "WHERE name=%s AND number=%s", (name, number))
+    cursor.executemany("INSERT INTO fullblog_search_terms "
+                       "(term, name, number, weight) VALUES (%s, %s, %s, %s)",
+                       [(term, name, number, weight) for term, weight
+                        in _term_weights(fields).iteritems()])
+
+def _post_fields(title, body, author, categories):
+    return [(title, _title_weight), (body, 1),
+            (author, _meta_weight), (categories, _meta_weight)]
+
+def _comment_fields(comment, author):
+    return [(comment, 1), (author, _meta_weight)]
+
+
+class FullBlogSearchIndex(Component):
+    """ Maintains a full-text index of current blog posts and comments, and
+    uses it for ranked blog search results instead of scanning all posts.
+    The index is stored in plugin tables, so it works with any database.
+
+    After enabling `[fullblog] search_index`, build the index using:
+    {{{
+    trac-admin /path/to/env fullblog reindex
+    }}}
+
+    Words of one character are not indexed, so searches with such words
+    (or without any words, or with only exclusions) use the regular search
+    of all posts instead.
+    """
+
+    implements(IBlogChangeListener)
+    if IAdminCommandProvider:
+        implements(IAdminCommandProvider)
+
+    enabled = BoolOption('fullblog', 'search_index', False,
+        """Use the full-text index for searching blog posts and comments,
+        and keep it updated on changes. Run `trac-admin <env> fullblog
+        reindex` after enabling to index existing content.""")
+
+    # IBlogChangeListener methods
+
+    def blog_post_changed(self, postname, version):
+        if self.enabled:
+            self._index_post(postname)
+
+    def blog_post_deleted(self, postname, version, fields):
+        if self.enabled:
+            self._index_post(postname)
+
+    def blog_comment_added(self, postname, number):
+        if self.enabled:
+            self._index_comment(postname, number)
+
+    def blog_comment_deleted(self, postname, number, fields):
+        if not self.enabled:
+            return
+        if number:
+            self._index_comment(postname, number)
+        else:
+            _transaction(self.env, lambda cursor: cursor.execute(
+                    "DELETE FROM fullblog_search_terms "
+                    "WHERE name=%s AND number>0", (postname,)))
+
+    # IAdminCommandProvider methods
+
+    def get_admin_commands(self):
+        yield ('fullblog reindex', '',
+               'Rebuild the full-text search index for blog posts and '
+               'comments',
+               None, self._do_reindex)
+
+    def _do_reindex(self):
+        posts, comments = self.reindex()
+        printout("Indexed %d blog posts and %d comments." % (posts, comments))
+
+    # Public methods
+
+    def reindex(self):
+        """ Rebuilds the index for all current posts and their comments.
+        Returns the number of (posts, comments) indexed. """
+        def do_reindex(cursor):
+            cursor.execute("DELETE FROM fullblog_search_terms")
+            cursor.execute("SELECT name, title, body, author, categories "
+                           "FROM fullblog_posts WHERE is_current=1")
+            posts = list(cursor)
+            for name, title, body, author, categories in posts:
+                _index_document(cursor, name, 0,
+                                _post_fields(title, body, author, categories))
+            cursor.execute("SELECT name, number, comment, author "
+                           "FROM fullblog_comments")
+            comments = list(cursor)
+            for name, number, comment, author in comments:
+                _index_document(cursor, name, number,
+                                _comment_fields(comment, author))
+            return len(posts), len(comments)
+        return _transaction(self.env, do_reindex)
+
+    def search_blog_posts(self, terms):
+        """ Same as model.search_blog_posts(), but using the index and
+        returning the posts ordered by rank (best match first). """
+        if not _indexed(terms):
+            return search_blog_posts(self.env, terms)
+        hits = [name for name, number in self._search(terms) if not number]
+        rows = {}
+        for chunk in _chunks(hits):
+            for row in _query(self.env, "SELECT name, version, publish_time, "
+                    "author, title, body FROM fullblog_posts "
+                    "WHERE is_current=1 AND name IN (%s)"
+                    % ", ".join(["%s"] * len(chunk)), tuple(chunk)):
+                rows[row[0]] = (row[0], row[1], to_datetime(row[2], utc),
+                                row[3], row[4], row[5])
+        return [rows[name] for name in hits if name in rows]
+
+    def search_blog_comments(self, terms):
+        """ Same as model.search_blog_comments(), but using the index and
+        returning the comments ordered by rank (best match first). """
+        if not _indexed(terms):
+            return search_blog_comments(self.env, terms)
+        hits = [(name, number) for name, number in self._search(terms)
+                if number]
+        rows = {}
+        for chunk in _chunks(hits, _IN_CHUNK_SIZE // 2):
+            args = []
+            for hit in chunk:
+                args.extend(hit)
+            for row in _query(self.env, "SELECT name, number, comment, "
+                    "author, time FROM fullblog_comments WHERE "
+                    + " OR ".join(["(name=%s AND number=%s)"] * len(chunk)),
+                    tuple(args)):
+                rows[(row[0], row[1])] = (row[0], row[1], row[2], row[3],
+                                          to_datetime(row[4], utc))
+        return [rows[hit] for hit in hits if hit in rows]
+
+    # Internal methods
+
+    def _search(self, terms):
+        """ Returns a list of (name, number) for posts (number 0) and
+        comments matching all the search terms, ordered by rank. Words
+        match as prefixes of indexed terms, and terms starting with '-'
+        exclude documents with the same words. """
+        scores = None
+        excluded = set()
+        for term in terms:
+            if term.startswith('-'):
+                for word in tokenize(term[1:]):
+                    excluded.update(self._lookup(word, prefix=False))
+                continue
+            for word in tokenize(term):
+                matches = self._lookup(word)
+                if scores is None:
+                    scores = matches
+                else:
+                    scores = dict([(doc, scores[doc] + weight)
+                                   for doc, weight in matches.iteritems()
+                                   if doc in scores])
+        hits = [(-score, doc) for doc, score in (scores or {}).iteritems()
+                if not doc in excluded]
+        return [doc for score, doc in sorted(hits)]
+
+    def _lookup(self, word, prefix=True):
+        """ Returns a dict of (name, number) -> weight for documents with
+        indexed terms starting with `word`, or just `word` if not `prefix`.
+        """
+        if prefix:
+            sql, args = "term>=%s AND term<%s", _prefix_range(word)
+        else:
+            sql, args = "term=%s", (word,)
+        matches = {}
+        for name, number, weight in _query(self.env, "SELECT name, number, "
+                "weight FROM fullblog_search_terms WHERE " + sql, args):
+            matches[(name, number)] = matches.get((name, number), 0) + weight
+        return matches
+
+    def _index_post(self, name):
+        rows = _query(self.env, "SELECT title, body, author, categories "
+                      "FROM fullblog_posts WHERE name=%s AND is_current=1",
+                      (name,))
+        def do_index(cursor):
+            if rows:
+                _index_document(cursor, name, 0, _post_fields(*rows[0]))
+            else:
+                cursor.execute("DELETE FROM fullblog_search_terms "
+                               "WHERE name=%s", (name,))
+        _transaction(self.env, do_index)
+
+    def _index_comment(self, name, number):
+        rows = _query(self.env, "SELECT comment, author FROM fullblog_comments "
+                      "WHERE name=%s AND number=%s", (name, number))
+        def do_index(cursor):
+            if rows:
+                _index_document(cursor, name, number,
+                                _comment_fields(*rows[0]))
+            else:
+                cursor.execute("DELETE FROM fullblog_search_terms "
+                               "WHERE name=%s AND number=%s", (name, number))
+        _transaction(self.env, do_index)
@@ -13,7 +13,8 @@ from trac.util.compat import set
 from trac.resource import Resource, get_resource_description
 from trac.web.chrome import Chrome
 
-from model import BlogPost, _parse_categories
+from core import FullBlogCore
+from model import BlogPost
 
 
 class FullBlogTagSystem(Component):
@@ -27,22 +28,15 @@ class FullBlogTagSystem(Component):
         if 'TAGS_VIEW' not in req.perm or 'BLOG_VIEW' not in req.perm:
             return
 
-        args = []
-        constraints = []
-        sql = "SELECT bp1.name, bp1.categories, bp1.version " \
-               "FROM fullblog_posts bp1," \
-               "(SELECT name, max(version) AS ver " \
-               "FROM fullblog_posts GROUP BY name) bp2 " \
-               "WHERE bp1.version = bp2.ver AND bp1.name = bp2.name"
+        sql = "SELECT name, category FROM fullblog_post_categories"
+        args = None
         if tags:
-            constraints.append("(" + ' OR '.join(
-                            ["bp1.categories LIKE %s" for t in tags]) + ")")
-            args += ['%' + t + '%' for t in tags]
-        else:
-            constraints.append("bp1.categories != ''")
-        if constraints:
-            sql += " AND " + " AND ".join(constraints)
-        sql += " ORDER BY bp1.name"
+            tags = set(tags)
+            sql += " WHERE name IN (SELECT name FROM " \
+                   "fullblog_post_categories WHERE category IN (%s))" \
+                   % ", ".join(["%s"] * len(tags))
+            args = tuple(tags)
+        sql += " ORDER BY name"
 
         if hasattr(self.env, 'db_query'):
             cursor = self.env.db_query(sql, args)
@@ -51,13 +45,21 @@ class FullBlogTagSystem(Component):
             cursor = db.cursor()
             cursor.execute(sql, args)
 
-        for row in cursor:
-            post_name, categories = row[0], set(_parse_categories(row[1]))
-            if not tags or categories.intersection(tags):
-                resource = Resource('blog', post_name)
-                if 'BLOG_VIEW' in req.perm(resource) and \
-                        'TAGS_VIEW' in req.perm(resource):
-                    yield (resource, categories)
+        rows = list(cursor)
+        blog_core = FullBlogCore(self.env)
+        permitted = set(blog_core.filter_permitted(req.perm,
+                                    blog_core.filter_permitted(req.perm,
+                                        set([row[0] for row in rows])),
+                                    'TAGS_VIEW'))
+        post_name = None
+        categories = set()
+        for name, category in rows + [(None, None)]:
+            if name != post_name and post_name is not None:
+                if post_name in permitted:
+                    yield (Resource('blog', post_name), categories)
+                categories = set()
+            post_name = name
+            categories.add(category)
 
     def get_resource_tags(self, req, resource):
         req.perm(resource).require('BLOG_VIEW')
@@ -73,6 +75,7 @@ class FullBlogTagSystem(Component):
             req.perm(resource).require('BLOG_MODIFY_ALL')
         post.categories = " ".join(tags)
         post.save(req.authname, 'Blog post categories changed via Tags plugin.')
+        self._notify_changed(post)
 
     def remove_resource_tags(self, req, resource):
         req.perm(resource).require('TAGS_MODIFY')
@@ -83,6 +86,7 @@ class FullBlogTagSystem(Component):
             req.perm(resource).require('BLOG_MODIFY_ALL')
         post.categories = ""
         post.save(req.authname, 'Blog post categories removed via Tags plugin.')
+        self._notify_changed(post)
 
     def describe_tagged_resource(self, req, resource):
         # The plugin already uses the title as main description
@@ -90,3 +94,9 @@ class FullBlogTagSystem(Component):
         chrome = Chrome(self.env)
         return "'" + resource.id + "' by " \
                                     + chrome.format_author(req, post.author)
+
+    # Internal methods
+
+    def _notify_changed(self, post):
+        for listener in FullBlogCore(self.env).listeners:
+            listener.blog_post_changed(post.name, post.version)
@@ -1,4 +1,5 @@
 
+from thread import get_ident
 from unittest import TestCase, TestSuite, makeSuite
 
 from trac.perm import DefaultPermissionStore
@@ -9,8 +10,11 @@ from tracfullblog.db import FullBlogSetup
 
 class FullBlogTestCaseTemplate(TestCase):
 
+    # Components enabled in the test environment
+    components = ['trac.*', 'tracfullblog.*']
+
     def setUp(self):
-        self.env = EnvironmentStub(enable=['trac.*', 'tracfullblog.*'])
+        self.env = EnvironmentStub(enable=self.components)
         # tables
         if hasattr(self.env, 'db_transaction'):
             with self.env.db_transaction as db:
@@ -28,15 +32,88 @@ class FullBlogTestCaseTemplate(TestCase):
         del self.env
 
 
+class QueryCounter(object):
+    """ Records the SQL statements executed by the current thread through
+    Trac database cursors, while used as context manager:
+        with QueryCounter() as counter:
+            ...
+        print len(counter.queries)
+    Use `match` to only record statements containing the text, like
+    'fullblog' for the queries made by the plugin. """
+
+    def __init__(self, match=''):
+        self.match = match
+        self.queries = []
+
+    def __enter__(self):
+        from trac.db.util import IterableCursor
+        thread = get_ident()
+        self._methods = (IterableCursor.execute, IterableCursor.executemany)
+        execute, executemany = self._methods
+        def record(sql):
+            if get_ident() == thread and self.match in sql:
+                self.queries.append(sql)
+        def counting_execute(cursor, sql, args=None):
+            record(sql)
+            return execute(cursor, sql, args)
+        def counting_executemany(cursor, sql, args):
+            record(sql)
+            return executemany(cursor, sql, args)
+        IterableCursor.execute = counting_execute
+        IterableCursor.executemany = counting_executemany
+        return self
+
+    def __exit__(self, *exc_info):
+        from trac.db.util import IterableCursor
+        IterableCursor.execute, IterableCursor.executemany = self._methods
+        return False
+
+    def __len__(self):
+        return len(self.queries)
+
+
 def test_suite():
     suite = TestSuite()
+    import tracfullblog.tests.benchmark
+    suite.addTest(makeSuite(tracfullblog.tests.benchmark.BenchmarkTestCase))
+    import tracfullblog.tests.cache
+    suite.addTest(makeSuite(tracfullblog.tests.cache.LRUCacheTestCase))
+    suite.addTest(makeSuite(tracfullblog.tests.cache.FileCacheTestCase))
+    suite.addTest(makeSuite(tracfullblog.tests.cache.MemcachedCacheTestCase))
     import tracfullblog.tests.core
     suite.addTest(makeSuite(tracfullblog.tests.core.FullBlogCoreTestCase))
+    suite.addTest(makeSuite(tracfullblog.tests.core.FullBlogPermissionTestCase))
+    suite.addTest(makeSuite(tracfullblog.tests.core.FullBlogStatsTestCase))
+    suite.addTest(makeSuite(tracfullblog.tests.core.FullBlogGenerationTestCase))
+    suite.addTest(makeSuite(tracfullblog.tests.core.FullBlogPrevNextTestCase))
+    suite.addTest(makeSuite(tracfullblog.tests.core.FullBlogRenderCacheTestCase))
+    import tracfullblog.tests.draft
+    suite.addTest(makeSuite(tracfullblog.tests.draft.BlogDraftPluginTestCase))
+    import tracfullblog.tests.loadtest
+    suite.addTest(makeSuite(tracfullblog.tests.loadtest.LoadTestTestCase))
     import tracfullblog.tests.model
     suite.addTest(makeSuite(tracfullblog.tests.model.GroupPostsByMonthTestCase))
     suite.addTest(makeSuite(tracfullblog.tests.model.GetBlogPostsTestCase))
+    suite.addTest(makeSuite(tracfullblog.tests.model.BlogPostSelectTestCase))
+    suite.addTest(makeSuite(tracfullblog.tests.model.CurrentVersionTestCase))
+    suite.addTest(makeSuite(tracfullblog.tests.model.CategoryIndexTestCase))
+    suite.addTest(makeSuite(tracfullblog.tests.model.BlogCommentsTestCase))
+    suite.addTest(makeSuite(tracfullblog.tests.model.DeferredFieldsTestCase))
+    suite.addTest(makeSuite(tracfullblog.tests.model.PostCacheTestCase))
+    import tracfullblog.tests.memory
+    suite.addTest(makeSuite(tracfullblog.tests.memory.MemoryBudgetTestCase))
+    import tracfullblog.tests.queries
+    suite.addTest(makeSuite(tracfullblog.tests.queries.QueryCountTestCase))
+    import tracfullblog.tests.search
+    suite.addTest(makeSuite(tracfullblog.tests.search.FullBlogSearchIndexTestCase))
+    import tracfullblog.tests.stress
+    suite.addTest(makeSuite(tracfullblog.tests.stress.StressTestCase))
     import tracfullblog.tests.web_ui
     suite.addTest(makeSuite(tracfullblog.tests.web_ui.FullBlogListtingsTestCase))
     suite.addTest(makeSuite(tracfullblog.tests.web_ui.FullBlogRssTestCase))
+    suite.addTest(makeSuite(tracfullblog.tests.web_ui.FullBlogSearchTestCase))
+    suite.addTest(makeSuite(tracfullblog.tests.web_ui.FullBlogTimelineTestCase))
     suite.addTest(makeSuite(tracfullblog.tests.web_ui.FullBlogPostTestCase))
+    suite.addTest(makeSuite(tracfullblog.tests.web_ui.FullBlogPagingTestCase))
+    suite.addTest(makeSuite(tracfullblog.tests.web_ui.FullBlogArchiveTestCase))
     return suite
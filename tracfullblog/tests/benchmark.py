@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the main entry points of the plugin, using a temporary
+SQLite Trac environment filled with a synthetic blog.
+
+Usage (see --help for sizes of the generated blog):
+    python -m tracfullblog.tests.benchmark --posts 2000 --output run.json
+
+Results are written as JSON, with timings in milliseconds for each entry
+point: the first (cold cache) run, and min/median/max of all runs.
+
+License: BSD
+
+(c) 2007 ::: www.CodeResort.com - BV Network AS (simon-code@bvnetwork.no)
+"""
+
+import datetime
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import timeit
+from optparse import OptionParser
+from unittest import TestCase
+
+import trac
+from trac.env import Environment
+from trac.perm import PermissionSystem
+from trac.test import MockRequest
+from trac.util.datefmt import to_timestamp, utc
+from trac.web.chrome import Chrome
+from trac.wiki.formatter import Formatter
+
+try:
+    from trac.web.chrome import web_context
+except ImportError:
+    from trac.mimeview.api import Context
+    web_context = Context.from_request
+
+from tracfullblog.db import FullBlogSetup
+from tracfullblog.macros import BlogListMacro
+from tracfullblog.model import _transaction
+from tracfullblog.search import FullBlogSearchIndex
+from tracfullblog.web_ui import FullBlogModule
+
+try:
+    from tracfullblog.tags import FullBlogTagSystem
+except ImportError:
+    # TracTags not installed
+    FullBlogTagSystem = None
+
+__all__ = ['create_environment', 'generate_blog', 'platform_info',
+           'run_benchmarks']
+
+# Default sizes of the generated blog
+defaults = {'posts': 500, 'versions': 2, 'comments': 3, 'categories': 20,
+            'authors': 10, 'paragraphs': 5, 'days': 730}
+
+_paragraph = u"Lorem ipsum '''dolor''' sit amet, ''consectetur'' " \
+             u"adipiscing elit. See [wiki:WikiStart the wiki] and " \
+             u"CamelCase links.\n * Sed do eiusmod\n * tempor incididunt " \
+             u"ut labore\n{{{\nsome code\n}}}\n"
+
+
+def create_environment(path):
+    """ Creates a Trac environment at `path`, using a SQLite database
+    file, with the blog plugin enabled and its tables created. """
+    env = Environment(path, create=True,
+                      options=[('trac', 'database', 'sqlite:db/trac.db'),
+                               ('components', 'tracfullblog.*', 'enabled')])
+    if hasattr(env, 'db_transaction'):
+        with env.db_transaction as db:
+            FullBlogSetup(env).upgrade_environment(db)
+    else:
+        db = env.get_db_cnx()
+        FullBlogSetup(env).upgrade_environment(db)
+        db.commit()
+    return env
+
+def generate_blog(env, posts=500, versions=2, comments=3, categories=20,
+                  authors=10, paragraphs=5, days=730):
+    """ Fills the environment with a synthetic blog. Posts are published
+    evenly over the last `days` days, newest first. Each post gets 1-3 of
+    the categories, and a unique 'topicN' word in the title for searching
+    single posts. """
+    now = to_timestamp(datetime.datetime.now(utc))
+    interval = max(days * 86400 / max(posts, 1), 1)
+    post_rows = []
+    category_rows = []
+    comment_rows = []
+    for i in range(posts):
+        name = u'post%d' % i
+        publish_time = now - i * interval
+        author = u'author%d' % (i % authors)
+        post_categories = sorted(set([u'category%d' % ((i + j * 7) % categories)
+                                      for j in range(i % 3 + 1)]))
+        body = _paragraph * paragraphs
+        for version in range(1, versions + 1):
+            post_rows.append((name, version,
+                    u'Synthetic post %d about topic%d' % (i, i),
+                    body + u'Version %d.' % version, publish_time,
+                    publish_time + (version - 1) * 60,
+                    u'Version %d' % version, author, author,
+                    u' '.join(post_categories), int(version == versions)))
+        category_rows.extend([(name, category)
+                              for category in post_categories])
+        for number in range(1, comments + 1):
+            comment_rows.append((name, number,
+                    u"Comment %d with '''wiki''' markup." % number,
+                    u'author%d' % ((i + number) % authors),
+                    publish_time + number * 60))
+    def do_insert(cursor):
+        cursor.executemany("INSERT INTO fullblog_posts (name, version, "
+                "title, body, publish_time, version_time, version_comment, "
+                "version_author, author, categories, is_current) "
+                "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
+                post_rows)
+        cursor.executemany("INSERT INTO fullblog_post_categories "
+                "(name, category) VALUES (%s, %s)", category_rows)
+        cursor.executemany("INSERT INTO fullblog_comments (name, number, "
+                "comment, author, time) VALUES (%s, %s, %s, %s, %s)",
+                comment_rows)
+    _transaction(env, do_insert)
+
+def _timings(func, repeat):
+    """ Calls `func` `repeat` times, and returns the timings. """
+    times = []
+    for i in range(repeat):
+        start = timeit.default_timer()
+        func()
+        times.append((timeit.default_timer() - start) * 1000)
+    ordered = sorted(times)
+    return {'runs': repeat,
+            'first_ms': round(times[0], 3),
+            'min_ms': round(ordered[0], 3),
+            'median_ms': round(ordered[len(ordered) // 2], 3),
+            'max_ms': round(ordered[-1], 3)}
+
+def _entry_points(env, posts, username):
+    """ Returns a list of (name, callable) for the benchmarked entry points.
+    Page requests are rendered with their templates. """
+    module = FullBlogModule(env)
+    def request(path_info, **args):
+        def process():
+            req = MockRequest(env, path_info=path_info, args=args,
+                              authname=username)
+            assert module.match_request(req)
+            template, data, content_type = module.process_request(req)[:3]
+            Chrome(env).render_template(req, template, data, content_type)
+        return process
+    def search(*terms):
+        def do_search():
+            req = MockRequest(env, authname=username)
+            list(module.get_search_results(req, list(terms), ['blog']))
+        return do_search
+    def timeline():
+        req = MockRequest(env, authname=username)
+        stop = datetime.datetime.now(utc)
+        list(module.get_timeline_events(req,
+                stop - datetime.timedelta(days=30), stop, ['blog']))
+    def macro(content):
+        def expand():
+            req = MockRequest(env, authname=username)
+            formatter = Formatter(env, web_context(req))
+            unicode(BlogListMacro(env).expand_macro(formatter, 'BlogList',
+                                                    content))
+        return expand
+    def tags():
+        req = MockRequest(env, authname=username)
+        list(FullBlogTagSystem(env).get_tagged_resources(req,
+                                                         [u'category1']))
+    middle = 'post%d' % (posts // 2)
+    entry_points = [
+        ('front_page', request('/blog')),
+        ('archive', request('/blog/archive')),
+        ('listing_category', request('/blog/category/category1')),
+        ('listing_author', request('/blog/author/author1')),
+        ('listing_month', request('/blog/%d/%02d' % (
+                        datetime.datetime.now(utc).year,
+                        datetime.datetime.now(utc).month))),
+        ('post_view', request('/blog/' + middle)),
+        ('rss', request('/blog', format='rss')),
+        ('post_rss', request('/blog/' + middle, format='rss')),
+        ('search_common', search(u'lorem')),
+        ('search_single', search(u'topic%d' % (posts // 2))),
+        ('timeline', timeline),
+        ('macro_inline', macro(u'recent=20')),
+        ('macro_full', macro(u'format=full, recent=5, max_size=250')),
+    ]
+    if FullBlogTagSystem is not None:
+        entry_points.append(('tags', tags))
+    return entry_points
+
+def run_benchmarks(env, posts, repeat=5, username='user', only=None):
+    """ Times the entry points of the plugin, returning a dict of
+    name -> timings. Use `only` for a list of entry points to run. """
+    results = {}
+    for name, func in _entry_points(env, posts, username):
+        if only and not name in only:
+            continue
+        results[name] = _timings(func, repeat)
+    if FullBlogTagSystem is None and (not only or 'tags' in only):
+        results['tags'] = {'skipped': 'TracTags is not installed'}
+    return results
+
+def platform_info():
+    """ Returns the versions of the software used, for reports. """
+    return {'python': platform.python_version(),
+            'trac': trac.__version__,
+            'fullblog': __import__('tracfullblog', ['__version__']).__version__,
+            'system': platform.platform()}
+
+def main(args=None):
+    parser = OptionParser(usage="%prog [options]",
+            description="Benchmark the blog plugin using a synthetic blog "
+                        "in a temporary Trac environment.")
+    for name, value in sorted(defaults.items()):
+        parser.add_option('--' + name, type='int', default=value,
+                          help="default: %default")
+    parser.add_option('--repeat', type='int', default=5,
+                      help="runs for each entry point, default: %default")
+    parser.add_option('--only', action='append',
+                      help="only run the named entry point (repeatable)")
+    parser.add_option('--search-index', action='store_true',
+                      help="use the full-text search index")
+    parser.add_option('--option', action='append', default=[],
+                      metavar='SECTION:NAME=VALUE',
+                      help="set a trac.ini option (repeatable)")
+    parser.add_option('--output', help="write the JSON to a file")
+    parser.add_option('--keep', action='store_true',
+                      help="keep the temporary environment")
+    options, args = parser.parse_args(args)
+
+    path = tempfile.mkdtemp(prefix='fullblog-benchmark-')
+    try:
+        env = create_environment(os.path.join(path, 'env'))
+        PermissionSystem(env).grant_permission('user', 'BLOG_ADMIN')
+        if FullBlogTagSystem is not None:
+            PermissionSystem(env).grant_permission('user', 'TAGS_VIEW')
+        for option in options.option:
+            section, rest = option.split(':', 1)
+            name, value = rest.split('=', 1)
+            env.config.set(section, name, value)
+        sizes = dict([(name, getattr(options, name)) for name in defaults])
+        start = timeit.default_timer()
+        generate_blog(env, **sizes)
+        if options.search_index:
+            env.config.set('fullblog', 'search_index', 'true')
+            FullBlogSearchIndex(env).reindex()
+        generated = timeit.default_timer() - start
+        report = {
+            'config': dict(sizes, repeat=options.repeat,
+                           search_index=bool(options.search_index),
+                           options=options.option),
+            'platform': platform_info(),
+            'generate_ms': round(generated * 1000, 3),
+            'results': run_benchmarks(env, options.posts, options.repeat,
+                                      only=options.only)}
+        env.shutdown()
+    finally:
+        if options.keep:
+            sys.stderr.write("Environment kept in %s\n" % path)
+        else:
+            shutil.rmtree(path)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            f.write(output + '\n')
+        finally:
+            f.close()
+    else:
+        print output
+    return report
+
+
+class BenchmarkTestCase(TestCase):
+    """ Runs the benchmark with a tiny blog, to keep it working. """
+
+    def test_tiny_blog(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            report = main(['--posts', '4', '--versions', '2', '--repeat', '1',
+                           '--output', os.path.join(tempdir, 'run.json')])
+            f = open(os.path.join(tempdir, 'run.json'))
+            try:
+                self.assertEquals(report['results'],
+                                  json.load(f)['results'])
+            finally:
+                f.close()
+        finally:
+            shutil.rmtree(tempdir)
+        self.assertEquals(4, report['config']['posts'])
+        for name in ['front_page', 'archive', 'post_view', 'rss',
+                     'search_single', 'timeline', 'macro_inline', 'tags']:
+            self.assertTrue(name in report['results'])
+        self.assertEquals(1, report['results']['front_page']['runs'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+import shutil
+import tempfile
+
+from unittest import TestCase
+
+from trac.test import Mock
+
+from tracfullblog.cache import FileCache, LRUCache, MemcachedCache
+
+
+class LRUCacheTestCase(TestCase):
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEquals(1, cache.get('a'))
+        cache.set('c', 3)
+        self.assertEquals([1, None, 3],
+                          [cache.get(key) for key in ('a', 'b', 'c')])
+
+    def test_generation(self):
+        cache = LRUCache()
+        cache.set_for_generation('key', 'value', 'one')
+        self.assertEquals('value', cache.get_for_generation('key', 'one'))
+        self.assertEquals(None, cache.get_for_generation('key', 'two'))
+        self.assertEquals(None, cache.get_for_generation('key', None))
+
+
+class FileCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = self.tempdir + '/cache.db'
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_shared_by_instances(self):
+        cache = FileCache(self.path)
+        cache.set(('render', u'post\xe9'), {('post', 1): u'<p>\xe9</p>'})
+        cache.set_for_generation(('stats', None, None), [1, 2], 'one')
+        other = FileCache(self.path)
+        self.assertEquals({('post', 1): u'<p>\xe9</p>'},
+                          other.get(('render', u'post\xe9')))
+        self.assertEquals([1, 2], other.get_for_generation(
+                                        ('stats', None, None), 'one'))
+        other.delete(('render', u'post\xe9'))
+        self.assertEquals('missing', cache.get(('render', u'post\xe9'),
+                                               'missing'))
+        cache.clear()
+        self.assertEquals(0, len(other))
+
+    def test_prune(self):
+        cache = FileCache(self.path, size=3)
+        cache.prune_interval = 5
+        for i in range(4):
+            cache.set(i, i)
+        self.assertEquals(4, len(cache))
+        cache.set(4, 4)
+        self.assertEquals(3, len(cache))
+        self.assertEquals([None, None, 2, 3, 4],
+                          [cache.get(i) for i in range(5)])
+
+    def test_errors_are_misses(self):
+        cache = FileCache(self.tempdir + '/missing/cache.db')
+        cache.set('key', 'value')
+        self.assertEquals(None, cache.get('key'))
+
+
+class MemcachedCacheTestCase(TestCase):
+
+    class Client(dict):
+        def set(self, key, value):
+            self[key] = value
+            return True
+        def delete(self, key):
+            self.pop(key, None)
+
+    def test_prefixed_keys(self):
+        client = self.Client()
+        cache = MemcachedCache([], prefix='env1', client=client)
+        other = MemcachedCache([], prefix='env2', client=client)
+        cache.set(('render', u'post\xe9 name'), 'value')
+        self.assertEquals('value', cache.get(('render', u'post\xe9 name')))
+        self.assertEquals(None, other.get(('render', u'post\xe9 name')))
+        key = client.keys()[0]
+        self.assertTrue(key.startswith('env1:') and not ' ' in key)
+        cache.delete(('render', u'post\xe9 name'))
+        self.assertEquals({}, client)
+
+    def test_failed_set_logged(self):
+        class FullClient(self.Client):
+            def set(self, key, value):
+                return False
+        log = Mock(messages=[])
+        log.warning = lambda *args: log.messages.append(args)
+        cache = MemcachedCache([], client=FullClient(), log=log)
+        cache.set(('stats', None, None), 'value')
+        self.assertEquals(None, cache.get(('stats', None, None)))
+        self.assertEquals(1, len(log.messages))
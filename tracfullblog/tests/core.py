@@ -1,15 +1,32 @@
-from trac.core import TracError
-from trac.perm import PermissionCache, PermissionSystem, PermissionError
+import datetime
+import shutil
+import tempfile
+from collections import OrderedDict
+from time import time
+
+from trac.core import Component, TracError, implements
+from trac.perm import IPermissionPolicy, PermissionCache, PermissionSystem, \
+                      PermissionError
 from trac.resource import Resource
-from trac.test import Mock
+from trac.test import Mock, MockRequest
+from trac.util.datefmt import FixedOffset, utc
 from trac.util.html import Markup
 from trac.web.api import HTTPNotFound
 from trac.web.href import Href
 
+try:
+    from trac.web.chrome import web_context
+except ImportError:
+    from trac.mimeview.api import Context
+    web_context = Context.from_request
+
+from tracfullblog.api import IBlogPermissionPolicy
+from tracfullblog.cache import FileCache
 from tracfullblog.core import FullBlogCore
-from tracfullblog.model import BlogPost, get_blog_posts
+from tracfullblog.model import BlogComment, BlogPost, get_blog_posts
+from tracfullblog.model import _bump_generation, _transaction
 
-from tracfullblog.tests import FullBlogTestCaseTemplate
+from tracfullblog.tests import FullBlogTestCaseTemplate, QueryCounter
 
 
 class FullBlogCoreTestCase(FullBlogTestCaseTemplate):
@@ -39,3 +56,466 @@ class FullBlogCoreTestCase(FullBlogTestCaseTemplate):
         posts = get_blog_posts(self.env)
         self.assertEquals(1, len(posts))
         self.assertEquals('test_create_post', posts[0][4])
+
+    def test_resource_exists(self):
+        core = FullBlogCore(self.env)
+        bp = BlogPost(self.env, 'post')
+        bp.update_fields({'title': 'title', 'body': 'body', 'author': 'user'})
+        self.assertEquals([], bp.save('user'))
+        self.assertTrue(core.resource_exists(Resource('blog', 'post')))
+        self.assertTrue(core.resource_exists(Resource('blog', 'post', 1)))
+        self.assertFalse(core.resource_exists(Resource('blog', 'post', 2)))
+        self.assertFalse(core.resource_exists(Resource('blog', 'missing')))
+
+
+class SecretBlogPolicy(Component):
+    """ Denies access to the post named 'secret' for everyone but 'admin'. """
+
+    implements(IPermissionPolicy, IBlogPermissionPolicy)
+
+    def check_permission(self, action, username, resource, perm):
+        if resource and resource.realm == 'blog' and resource.id == 'secret' \
+                and username != 'admin':
+            return False
+
+    def get_restricted_blog_posts(self):
+        return ['secret']
+
+
+class OtherPolicy(Component):
+    """ Policy that the plugin does not know anything about. """
+
+    implements(IPermissionPolicy)
+
+    checked = []
+
+    def check_permission(self, action, username, resource, perm):
+        if resource and resource.realm == 'blog':
+            self.checked.append(resource.id)
+        return None
+
+
+class BulkBlogPolicy(Component):
+    """ Denies access to posts starting with 'hidden' for everyone,
+    checking many posts at once. """
+
+    implements(IPermissionPolicy, IBlogPermissionPolicy)
+
+    checked = []
+
+    def check_permission(self, action, username, resource, perm):
+        raise AssertionError("Posts should be checked in bulk")
+
+    def get_restricted_blog_posts(self):
+        return ['hidden1', 'hidden2']
+
+    def check_blog_permissions(self, action, username, names):
+        self.checked.append(sorted(names))
+        return dict([(name, False) for name in names])
+
+
+class FullBlogPermissionTestCase(FullBlogTestCaseTemplate):
+
+    def setUp(self):
+        FullBlogTestCaseTemplate.setUp(self)
+        PermissionSystem(self.env).grant_permission('user', 'BLOG_VIEW')
+        PermissionSystem(self.env).grant_permission('admin', 'BLOG_VIEW')
+        self.core = FullBlogCore(self.env)
+        BulkBlogPolicy.checked = []
+        OtherPolicy.checked = []
+        self.names = ['one', 'secret', 'hidden1', 'two', 'hidden2']
+
+    def test_default_policy(self):
+        self.assertEquals(self.names, self.core.filter_permitted(
+                    PermissionCache(self.env, 'user'), self.names))
+        self.assertEquals([], self.core.filter_permitted(
+                    PermissionCache(self.env, 'anonymous'), self.names))
+        self.assertEquals([], self.core.filter_permitted(
+                    PermissionCache(self.env, 'user'), self.names,
+                    'BLOG_DELETE'))
+
+    def test_blog_policies(self):
+        self.env.config.set('trac', 'permission_policies',
+                'SecretBlogPolicy, BulkBlogPolicy, DefaultPermissionPolicy')
+        req = Mock(perm=PermissionCache(self.env, 'user'))
+        self.core.pre_process_request(req, None)
+        self.assertEquals(['one', 'two'],
+                          self.core.filter_permitted(req.perm, self.names))
+        self.assertEquals(['one', 'secret', 'two'], self.core.filter_permitted(
+                    PermissionCache(self.env, 'admin'), self.names,
+                    'BLOG_VIEW'))
+        self.assertEquals([['hidden1', 'hidden2']] * 2, BulkBlogPolicy.checked)
+        # Decisions are remembered for the rest of the request
+        self.assertEquals(['one', 'two'],
+                          self.core.filter_permitted(req.perm, self.names))
+        self.assertEquals(2, len(BulkBlogPolicy.checked))
+        self.core.post_process_request(req, None, None, None)
+        self.assertEquals(['one', 'two'],
+                          self.core.filter_permitted(req.perm, self.names))
+        self.assertEquals(3, len(BulkBlogPolicy.checked))
+
+    def test_request_ending_early(self):
+        # Like a redirect or 304 response, without post_process_request()
+        self.env.config.set('trac', 'permission_policies',
+                            'BulkBlogPolicy, DefaultPermissionPolicy')
+        req = Mock(perm=PermissionCache(self.env, 'user'))
+        self.core.pre_process_request(req, None)
+        self.assertEquals(['one', 'secret', 'two'],
+                          self.core.filter_permitted(req.perm, self.names))
+        self.core.pre_process_request(req, None)
+        self.assertEquals(['one', 'secret', 'two'],
+                          self.core.filter_permitted(req.perm, self.names))
+        self.assertEquals(2, len(BulkBlogPolicy.checked))
+
+    def test_policy_order(self):
+        # Blog policies after a granting policy are not asked
+        self.env.config.set('trac', 'permission_policies',
+                'DefaultPermissionPolicy, BulkBlogPolicy, SecretBlogPolicy')
+        self.assertEquals(self.names, self.core.filter_permitted(
+                    PermissionCache(self.env, 'user'), self.names))
+        self.assertEquals([], BulkBlogPolicy.checked)
+
+    def test_unknown_policy(self):
+        self.env.config.set('trac', 'permission_policies',
+                'SecretBlogPolicy, OtherPolicy, DefaultPermissionPolicy')
+        self.assertEquals(['one', 'hidden1', 'two', 'hidden2'],
+                          self.core.filter_permitted(
+                                PermissionCache(self.env, 'user'), self.names))
+        # Asked about each post not denied before
+        self.assertEquals(['hidden1', 'hidden2', 'one', 'two'],
+                          sorted(OtherPolicy.checked))
+
+    def test_neutral_policy(self):
+        self.env.config.set('trac', 'permission_policies',
+                'SecretBlogPolicy, OtherPolicy, DefaultPermissionPolicy')
+        self.env.config.set('fullblog', 'neutral_permission_policies',
+                'OtherPolicy, DefaultPermissionPolicy')
+        self.assertEquals(['one', 'hidden1', 'two', 'hidden2'],
+                          self.core.filter_permitted(
+                                PermissionCache(self.env, 'user'), self.names))
+        self.assertEquals(1, len(OtherPolicy.checked))
+
+
+class FullBlogStatsTestCase(FullBlogTestCaseTemplate):
+
+    def setUp(self):
+        FullBlogTestCaseTemplate.setUp(self)
+        PermissionSystem(self.env).grant_permission('user', 'BLOG_ADMIN')
+        PermissionSystem(self.env).grant_permission('admin', 'BLOG_ADMIN')
+        self.core = FullBlogCore(self.env)
+        self.req = Mock(method='GET', base_path='', cgi_location='',
+                   path_info='/blog', href=Href('/trac'), args={}, chrome={},
+                   perm=PermissionCache(self.env, 'user'), authname='user')
+        for name, author, categories in [('one', 'user', 'a b'),
+                                         ('secret', 'admin', 'b c')]:
+            self._create_post(name, author, categories)
+
+    def _create_post(self, name, author, categories):
+        bp = BlogPost(self.env, name)
+        bp.update_fields({'title': name, 'body': 'body', 'author': author,
+                          'categories': categories})
+        self.assertEquals([], self.core.create_post(self.req, bp, 'user'))
+
+    def _stats(self, username):
+        return self.core.get_months_authors_categories(user=username,
+                                perm=PermissionCache(self.env, username))
+
+    def test_stats_cache_invalidated_on_changes(self):
+        months, authors, categories, total = self._stats('user')
+        self.assertEquals(2, total)
+        self.assertEquals([('admin', 1), ('user', 1)], authors)
+        self.assertEquals([('a', 1), ('b', 2), ('c', 1)], categories)
+        self.assertEquals(2, months[0][1])
+        self._create_post('two', 'user', 'c')
+        months, authors, categories, total = self._stats('user')
+        self.assertEquals(3, total)
+        self.assertEquals([('admin', 1), ('user', 2)], authors)
+        self.assertEquals([('a', 1), ('b', 2), ('c', 2)], categories)
+        self.core.delete_post(BlogPost(self.env, 'one'))
+        months, authors, categories, total = self._stats('user')
+        self.assertEquals(2, total)
+        self.assertEquals([('b', 1), ('c', 2)], categories)
+
+    def test_restricted_posts(self):
+        self.env.config.set('trac', 'permission_policies',
+                            'SecretBlogPolicy, DefaultPermissionPolicy')
+        self.assertEquals(set(['secret']), self.core._get_restricted_posts())
+        months, authors, categories, total = self._stats('user')
+        self.assertEquals(1, total)
+        self.assertEquals([('user', 1)], authors)
+        self.assertEquals([('a', 1), ('b', 1)], categories)
+        self.assertEquals([(months[0][0], 1)], months)
+        months, authors, categories, total = self._stats('admin')
+        self.assertEquals(2, total)
+        self.assertEquals([('a', 1), ('b', 2), ('c', 1)], categories)
+
+    def test_unknown_policy_checks_all_posts(self):
+        self.env.config.set('trac', 'permission_policies',
+                            'SecretBlogPolicy, OtherPolicy, '
+                            'DefaultPermissionPolicy')
+        self.assertEquals(None, self.core._get_restricted_posts())
+        months, authors, categories, total = self._stats('user')
+        self.assertEquals(1, total)
+        self.assertEquals([('a', 1), ('b', 1)], categories)
+
+    def test_shared_backend(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            self.env.config.set('fullblog', 'cache_backend', 'file')
+            self.env.config.set('fullblog', 'cache_file',
+                                tempdir + '/cache.db')
+            self.env.config.set('trac', 'permission_policies',
+                                'SecretBlogPolicy, DefaultPermissionPolicy')
+            for run in range(2):
+                self.assertEquals(1, self._stats('user')[3])
+                self.assertEquals(2, self._stats('admin')[3])
+            # Only the details of restricted posts are shared
+            cached = FileCache(tempdir + '/cache.db').get(
+                                    ('stats', (None, None)))[1]
+            self.assertEquals(2, cached[3])
+            self.assertEquals(['secret'], cached[4].keys())
+            self.assertEquals(set(['secret']), cached[5])
+            # Other posts restricted by a policy not known when cached
+            self.env.config.set('trac', 'permission_policies',
+                        'SecretBlogPolicy, OtherPolicy, '
+                        'DefaultPermissionPolicy')
+            OtherPolicy.checked = []
+            self.assertEquals(1, self._stats('user')[3])
+            self.assertEquals(['one'], OtherPolicy.checked)
+        finally:
+            shutil.rmtree(tempdir)
+
+
+class FullBlogGenerationTestCase(FullBlogTestCaseTemplate):
+
+    def setUp(self):
+        FullBlogTestCaseTemplate.setUp(self)
+        self.core = FullBlogCore(self.env)
+        self.req = MockRequest(self.env, authname='user')
+        bp = BlogPost(self.env, 'post')
+        bp.update_fields({'title': 'title', 'body': 'body', 'author': 'user',
+                          'categories': 'a'})
+        self.assertEquals([], bp.save('user'))
+
+    def _change_by_other_process(self):
+        _transaction(self.env,
+                     lambda cursor: _bump_generation(self.env, cursor))
+
+    def test_changes_bump_generation(self):
+        generations = [self.core.get_generation()]
+        bc = BlogComment(self.env, 'post')
+        self.assertEquals([], bc.create(comment='comment', author='user'))
+        generations.append(self.core.get_generation())
+        bc.delete()
+        generations.append(self.core.get_generation())
+        BlogPost(self.env, 'post').delete()
+        generations.append(self.core.get_generation())
+        first = int(generations[0])
+        self.assertEquals([first, first + 1, first + 2, first + 3],
+                          [int(generation) for generation in generations])
+
+    def test_generation_uses_connector_cast(self):
+        from trac.db.sqlite_backend import SQLiteConnection
+        cast = SQLiteConnection.cast
+        # Like the MySQL connector, which has no 'integer' type for casts
+        SQLiteConnection.cast = lambda db, column, type: \
+                'CAST(%s AS signed)' % column
+        try:
+            _transaction(self.env, lambda cursor: cursor.execute(
+                    "UPDATE system SET value='9' "
+                    "WHERE name='fullblog_generation'"))
+            with QueryCounter('fullblog_generation') as counter:
+                self._change_by_other_process()
+        finally:
+            SQLiteConnection.cast = cast
+        self.assertTrue('CAST(value AS signed)' in counter.queries[0])
+        self.assertEquals(10, int(self.core.get_generation()))
+
+    def test_read_once_per_request(self):
+        self.core.pre_process_request(self.req, None)
+        generation = self.core.get_generation()
+        self._change_by_other_process()
+        self.assertEquals(generation, self.core.get_generation())
+        self.core.post_process_request(self.req, None, None, None)
+        self.assertEquals(int(generation) + 1,
+                          int(self.core.get_generation()))
+
+    def test_last_modified_cached(self):
+        last_modified, generation = self.core.get_last_modified()
+        self.assertTrue(last_modified is not None)
+        with QueryCounter('fullblog_posts') as counter:
+            self.assertEquals((last_modified, generation),
+                              self.core.get_last_modified())
+        self.assertEquals(0, len(counter))
+        BlogComment(self.env, 'post').create(comment='comment', author='user')
+        self.assertNotEquals(generation, self.core.get_last_modified()[1])
+        self.assertEquals((None, self.core.get_generation()),
+                          self.core.get_last_modified('nosuchpost'))
+
+    def test_stats_follow_other_processes(self):
+        self.assertEquals(1, self.core.get_months_authors_categories()[3])
+        # Post added by another process
+        _transaction(self.env, lambda cursor: cursor.execute(
+                "INSERT INTO fullblog_posts (name, version, title, body, "
+                "publish_time, version_time, author, categories, is_current) "
+                "VALUES ('other', 1, 'other', 'body', 0, 0, 'user', '', 1)"))
+        self.assertEquals(1, self.core.get_months_authors_categories()[3])
+        self._change_by_other_process()
+        self.assertEquals(2, self.core.get_months_authors_categories()[3])
+
+
+class FullBlogPrevNextTestCase(FullBlogTestCaseTemplate):
+
+    def setUp(self):
+        FullBlogTestCaseTemplate.setUp(self)
+        PermissionSystem(self.env).grant_permission('user', 'BLOG_VIEW')
+        PermissionSystem(self.env).grant_permission('admin', 'BLOG_VIEW')
+        self.env.config.set('trac', 'permission_policies',
+                            'SecretBlogPolicy, DefaultPermissionPolicy')
+        self.core = FullBlogCore(self.env)
+        self.core.neighbour_posts = 2
+        # Newest first: p0, p1, secret, p2, and the rest with same time
+        now = datetime.datetime.now(utc)
+        for name, days in [('p0', 1), ('p1', 2), ('secret', 3), ('p2', 4),
+                           ('p4', 5), ('p3', 5)]:
+            bp = BlogPost(self.env, name)
+            bp.update_fields({'title': name, 'body': 'body', 'author': 'user',
+                    'publish_time': now - datetime.timedelta(days=days)})
+            self.assertEquals([], bp.save('user'))
+
+    def test_prev_next(self):
+        perm = PermissionCache(self.env, 'admin')
+        self.assertEquals(('p1', ''), self.core.get_prev_next_posts(perm, 'p0'))
+        self.assertEquals(('secret', 'p0'),
+                          self.core.get_prev_next_posts(perm, 'p1'))
+        self.assertEquals(('p3', 'secret'),
+                          self.core.get_prev_next_posts(perm, 'p2'))
+        self.assertEquals(('p4', 'p2'),
+                          self.core.get_prev_next_posts(perm, 'p3'))
+        self.assertEquals(('', 'p3'), self.core.get_prev_next_posts(perm, 'p4'))
+        self.assertEquals(('', ''),
+                          self.core.get_prev_next_posts(perm, 'missing'))
+
+    def test_prev_next_skips_restricted(self):
+        perm = PermissionCache(self.env, 'user')
+        self.assertEquals(('p2', 'p0'),
+                          self.core.get_prev_next_posts(perm, 'p1'))
+        self.assertEquals(('p3', 'p1'),
+                          self.core.get_prev_next_posts(perm, 'p2'))
+        # Neighbours beyond the first fetched are used if needed
+        self.core.neighbour_posts = 1
+        self.core._changed()
+        self.assertEquals(('p2', 'p0'),
+                          self.core.get_prev_next_posts(perm, 'p1'))
+        self.assertEquals(('p3', 'p1'),
+                          self.core.get_prev_next_posts(perm, 'p2'))
+
+    def test_prev_next_after_changes(self):
+        perm = PermissionCache(self.env, 'admin')
+        self.assertEquals(('p1', ''), self.core.get_prev_next_posts(perm, 'p0'))
+        bp = BlogPost(self.env, 'new')
+        bp.update_fields({'title': 'new', 'body': 'body', 'author': 'user'})
+        self.assertEquals([], self.core.create_post(Mock(args={}), bp, 'user'))
+        self.assertEquals(('p1', 'new'),
+                          self.core.get_prev_next_posts(perm, 'p0'))
+
+
+class FullBlogRenderCacheTestCase(FullBlogTestCaseTemplate):
+
+    def setUp(self):
+        FullBlogTestCaseTemplate.setUp(self)
+        self.core = FullBlogCore(self.env)
+        self.bp = BlogPost(self.env, 'post')
+        self.bp.update_fields({'title': 'post', 'body': "'''bold'''",
+                               'author': 'user'})
+        self.assertEquals([], self.bp.save('user'))
+        self.bc = BlogComment(self.env, 'post')
+        self.assertEquals([], self.bc.create("''comment''", 'user'))
+
+    def _context(self, username='user'):
+        req = MockRequest(self.env, authname=username)
+        return web_context(req, Resource('blog', 'post'))
+
+    def test_render_and_reuse(self):
+        html = self.core.render_wiki(self._context(), self.bp, self.bp.body)
+        self.assertTrue(isinstance(html, Markup))
+        self.assertTrue('<strong>bold</strong>' in html)
+        self.assertTrue('<em>comment</em>' in self.core.render_wiki(
+                                self._context(), self.bc, self.bc.comment))
+        # Cached renderings are used for the same post, text and context
+        keys = self.core._get_renderings('post').keys()
+        self.assertEquals(2, len(keys))
+        self.core._set_renderings('post', OrderedDict([(k, (time(), u'cached'))
+                                                       for k in keys]))
+        self.assertEquals(Markup(u'cached'), self.core.render_wiki(
+                                self._context(), self.bp, self.bp.body))
+        self.assertTrue('<strong>bold</strong>' in self.core.render_wiki(
+                                self._context('other'), self.bp, self.bp.body))
+        self.assertTrue('<strong>other</strong>' in self.core.render_wiki(
+                                self._context(), self.bp, "'''other'''"))
+        self.assertTrue('<strong>bold</strong>' in self.core.render_wiki(
+                        self._context(), self.bp, self.bp.body, 'oneliner'))
+
+    def test_locale_and_timezone(self):
+        self.core.render_wiki(self._context(), self.bp, self.bp.body)
+        context = self._context()
+        context.req.tz = FixedOffset(120, 'UTC+2')
+        self.core.render_wiki(context, self.bp, self.bp.body)
+        context = self._context()
+        context.req.locale = 'de_DE'
+        self.core.render_wiki(context, self.bp, self.bp.body)
+        self.assertEquals(3, len(self.core._get_renderings('post')))
+
+    def test_expired(self):
+        self.core.render_wiki(self._context(), self.bp, self.bp.body)
+        key, (rendered, html) = self.core._get_renderings('post').items()[0]
+        self.core._set_renderings('post', OrderedDict([(key,
+                    (rendered - self.core.render_cache_ttl - 1, u'old'))]))
+        self.assertTrue('<strong>bold</strong>' in self.core.render_wiki(
+                                self._context(), self.bp, self.bp.body))
+        self.assertTrue(self.core._get_renderings('post')[key][0] >= rendered)
+
+    def test_least_recently_used_evicted(self):
+        self.core.renderings_per_post = 4
+        for username in ['u1', 'u2', 'u3', 'u4']:
+            self.core.render_wiki(self._context(username), self.bp,
+                                  self.bp.body)
+        # Used again, so kept instead of older renderings
+        self.core.render_wiki(self._context('u1'), self.bp, self.bp.body)
+        for username in ['u5', 'u6']:
+            self.core.render_wiki(self._context(username), self.bp,
+                                  self.bp.body)
+        self.assertEquals(['u4', 'u1', 'u5', 'u6'],
+                          [key[7] for key in self.core._get_renderings('post')])
+
+    def test_previews_not_cached(self):
+        preview = BlogComment(self.env, 'post')
+        self.assertTrue('<em>new</em>' in self.core.render_wiki(
+                                self._context(), preview, "''new''"))
+        self.assertTrue('<em>edited</em>' in self.core.render_wiki(
+                    self._context(), self.bp, "''edited''", cache=False))
+        self.assertEquals({}, self.core._get_renderings('post'))
+
+    def test_invalidated_by_changes(self):
+        self.core.render_wiki(self._context(), self.bp, self.bp.body)
+        self.assertEquals(1, len(self.core._get_renderings('post')))
+        self.core.blog_comment_added('post', 2)
+        self.assertEquals({}, self.core._get_renderings('post'))
+
+    def test_file_backend(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            self.env.config.set('fullblog', 'cache_backend', 'file')
+            self.env.config.set('fullblog', 'cache_file',
+                                tempdir + '/cache.db')
+            self.core.render_wiki(self._context(), self.bp, self.bp.body)
+            # Renderings are seen by other processes using the file
+            other = FileCache(tempdir + '/cache.db')
+            self.assertEquals(1, len(other.get(('render', 'post'))))
+            self.core.blog_post_changed('post', 1)
+            self.assertEquals(None, other.get(('render', 'post')))
+            self.assertEquals(('', ''),
+                    self.core.get_prev_next_posts(self._context().perm, 'post'))
+            self.assertEquals(1, len(other))
+        finally:
+            shutil.rmtree(tempdir)
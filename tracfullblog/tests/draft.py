@@ -0,0 +1,83 @@
+import imp
+import os
+import sys
+
+from trac.perm import PermissionCache, PermissionSystem
+from trac.resource import Resource
+from trac.test import Mock
+
+from tracfullblog.core import FullBlogCore
+from tracfullblog.model import BlogPost, _bump_generation, _transaction
+
+from tracfullblog.tests import FullBlogTestCaseTemplate, QueryCounter
+
+_plugin_path = os.path.join(os.path.dirname(os.path.dirname(
+                    os.path.dirname(os.path.abspath(__file__)))),
+                    'sample-plugins', 'BlogDraftPlugin.py')
+
+def _load_plugin():
+    """ Returns the sample plugin module, loaded once as the components
+    are registered when it is loaded. """
+    if not 'BlogDraftPlugin' in sys.modules:
+        imp.load_source('BlogDraftPlugin', _plugin_path)
+    return sys.modules['BlogDraftPlugin']
+
+
+class BlogDraftPluginTestCase(FullBlogTestCaseTemplate):
+
+    components = FullBlogTestCaseTemplate.components + ['blogdraftplugin.*']
+
+    def setUp(self):
+        if not os.path.exists(_plugin_path):
+            self.skipTest("Sample plugins not available")
+        self.plugin = _load_plugin().BlogDraftPlugin
+        FullBlogTestCaseTemplate.setUp(self)
+        self.env.config.set('trac', 'permission_policies',
+                            'BlogDraftPlugin, DefaultPermissionPolicy')
+        PermissionSystem(self.env).grant_permission('user', 'BLOG_VIEW')
+        PermissionSystem(self.env).grant_permission('other', 'BLOG_VIEW')
+        self.req = Mock(authname='user')
+        self._post('public', 'news')
+        self._post('draft', 'draft news')
+
+    def _post(self, name, categories):
+        bp = BlogPost(self.env, name)
+        bp.update_fields({'title': name, 'body': 'body', 'author': 'user',
+                          'categories': categories})
+        self.assertEquals([], FullBlogCore(self.env).create_post(self.req, bp,
+                                                                 'user'))
+
+    def test_restricted_posts(self):
+        plugin = self.plugin(self.env)
+        self.assertEquals(['draft'], list(plugin.get_restricted_blog_posts()))
+        self.assertEquals({'draft': False}, plugin.check_blog_permissions(
+                                    'BLOG_VIEW', 'other', ['draft']))
+        self.assertEquals({'draft': None}, plugin.check_blog_permissions(
+                                    'BLOG_VIEW', 'user', ['draft']))
+        core = FullBlogCore(self.env)
+        self.assertEquals(['public'], core.filter_permitted(
+                    PermissionCache(self.env, 'other'), ['public', 'draft']))
+        self.assertEquals(['public', 'draft'], core.filter_permitted(
+                    PermissionCache(self.env, 'user'), ['public', 'draft']))
+        # Earlier versions are checked as they were
+        self.assertEquals(None, plugin.check_permission('BLOG_VIEW', 'other',
+                    Resource('blog', 'public', 1), None))
+        self.assertEquals(False, plugin.check_permission('BLOG_VIEW', 'other',
+                    Resource('blog', 'draft', 1), None))
+
+    def test_drafts_follow_generation(self):
+        plugin = self.plugin(self.env)
+        self.assertEquals(['draft'], list(plugin.get_restricted_blog_posts()))
+        with QueryCounter('fullblog_post_categories') as counter:
+            plugin.get_restricted_blog_posts()
+        self.assertEquals(0, len(counter))
+        # Published by the plugin in this process
+        self._post('draft', 'news')
+        self.assertEquals([], list(plugin.get_restricted_blog_posts()))
+        # Made a draft by another process
+        def do_change(cursor):
+            cursor.execute("INSERT INTO fullblog_post_categories "
+                           "(name, category) VALUES ('public', 'draft')")
+            _bump_generation(self.env, cursor)
+        _transaction(self.env, do_change)
+        self.assertEquals(['public'], list(plugin.get_restricted_blog_posts()))
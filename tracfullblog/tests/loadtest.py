@@ -0,0 +1,390 @@
+# -*- coding: utf-8 -*-
+"""
+Load test for the blog, sending requests through the Trac WSGI application
+from many threads like a multi-threaded web server does.
+
+Usage (see --help for more options):
+    python -m tracfullblog.tests.loadtest --threads 8 --requests 2000
+    python -m tracfullblog.tests.loadtest --env /path/to/env \\
+            --replay access.log --prefix /trac
+
+Without --env, a temporary environment with a synthetic blog is used (see
+benchmark.py). The requests are a generated mix of the blog pages, or read
+from a file with --replay. The file has a request on each line, either as
+a path (like '/blog/archive') or as a line of an access log in Common or
+Combined Log Format, where only GET requests are used.
+
+Results are written as JSON, with the throughput (requests per second) and
+the latency percentiles in milliseconds for all requests and each route.
+
+License: BSD
+
+(c) 2007 ::: www.CodeResort.com - BV Network AS (simon-code@bvnetwork.no)
+"""
+
+import datetime
+import json
+import math
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+import timeit
+import urllib
+from optparse import OptionParser
+from Queue import Empty, Queue
+from StringIO import StringIO
+from unittest import TestCase
+from wsgiref.util import setup_testing_defaults
+
+from trac.env import env_cache, env_cache_lock, open_environment
+from trac.perm import PermissionSystem
+from trac.util.datefmt import utc
+from trac.web.main import dispatch_request
+
+from tracfullblog.tests.benchmark import create_environment, defaults, \
+                            generate_blog, platform_info
+
+__all__ = ['generate_requests', 'read_requests', 'route_of', 'run_load']
+
+# Relative weights of the routes in the generated request mix
+mix = [('front_page', 25), ('post_view', 35), ('archive', 5),
+       ('listing_category', 6), ('listing_author', 4), ('listing_month', 4),
+       ('rss', 10), ('post_rss', 3), ('search', 4), ('timeline', 4)]
+
+_log_re = re.compile(r'"(?:GET|HEAD) (\S+)[^"]*"')
+
+
+def generate_requests(count, posts, categories=20, authors=10, seed=0):
+    """ Returns a list of `count` paths for a random mix of requests to a
+    blog generated by benchmark.generate_blog(). Recent posts are viewed
+    more often than old ones. """
+    rand = random.Random(seed)
+    now = datetime.datetime.now(utc)
+    def post():
+        return 'post%d' % int(max(posts, 1) * rand.random() ** 3)
+    paths = {
+        'front_page': lambda: '/blog',
+        'post_view': lambda: '/blog/' + post(),
+        'archive': lambda: '/blog/archive',
+        'listing_category': lambda: '/blog/category/category%d'
+                                    % rand.randrange(categories),
+        'listing_author': lambda: '/blog/author/author%d'
+                                  % rand.randrange(authors),
+        'listing_month': lambda: '/blog/%d/%02d' % (now.year, now.month),
+        'rss': lambda: '/blog?format=rss',
+        'post_rss': lambda: '/blog/%s?format=rss' % post(),
+        'search': lambda: '/search?q=%s&blog=on' % rand.choice(
+                            ['lorem', 'topic%d' % rand.randrange(posts or 1)]),
+        'timeline': lambda: '/timeline?blog=on&daysback=30',
+    }
+    routes = [route for route, weight in mix for i in range(weight)]
+    return [paths[rand.choice(routes)]() for i in range(count)]
+
+def read_requests(lines, prefix=''):
+    """ Returns the list of paths (with query strings) to request, from
+    lines of paths or access log lines. The `prefix` (the base path of
+    Trac in the log) is removed, and requests outside it are skipped, as
+    are other request methods and lines not understood. """
+    paths = []
+    for line in lines:
+        line = line.strip()
+        match = _log_re.search(line)
+        if match:
+            path = match.group(1)
+        elif line.startswith('/'):
+            path = line.split()[0]
+        else:
+            continue
+        if prefix:
+            if not (path + '/').startswith(prefix.rstrip('/') + '/'):
+                continue
+            path = path[len(prefix.rstrip('/')):] or '/'
+        paths.append(path)
+    return paths
+
+def route_of(path):
+    """ Returns the name of the route for a path, for grouping results. """
+    path_info, query = (path.split('?', 1) + [''])[:2]
+    parts = path_info.strip('/').split('/')
+    if parts[0] == 'blog':
+        if len(parts) == 1 or not parts[1]:
+            route = 'front_page'
+        elif parts[1] == 'archive':
+            route = 'archive'
+        elif parts[1] in ('category', 'author'):
+            route = 'listing_' + parts[1]
+        elif parts[1].isdigit():
+            route = 'listing_month'
+        elif parts[1] in ('create', 'edit', 'delete'):
+            route = parts[1]
+        else:
+            route = 'post_view'
+        if re.search(r'(^|&)format=rss(&|$)', query):
+            route = {'front_page': 'rss', 'post_view': 'post_rss'}.get(
+                        route, route + '_rss')
+        return route
+    elif parts[0] in ('search', 'timeline'):
+        return parts[0]
+    return 'other'
+
+def _request(env_path, path, username):
+    """ Sends a GET request through the WSGI application, and returns the
+    status code after reading the response. """
+    path_info, query = (path.split('?', 1) + [''])[:2]
+    environ = {'PATH_INFO': urllib.unquote(path_info),
+               'QUERY_STRING': query,
+               'SCRIPT_NAME': '',
+               'wsgi.errors': StringIO(),
+               'wsgi.multithread': True,
+               'trac.env_path': env_path}
+    if username != 'anonymous':
+        environ['REMOTE_USER'] = username
+    setup_testing_defaults(environ)
+    status = []
+    def start_response(status_line, headers, exc_info=None):
+        status.append(int(status_line.split()[0]))
+        return lambda data: None
+    response = dispatch_request(environ, start_response)
+    try:
+        for chunk in response:
+            pass
+    finally:
+        if hasattr(response, 'close'):
+            response.close()
+    return status[0]
+
+def _percentile(ordered, percent):
+    """ Returns the nearest-rank percentile of a sorted list. """
+    index = int(math.ceil(percent / 100.0 * len(ordered))) - 1
+    return ordered[max(index, 0)]
+
+def _summary(results, elapsed):
+    """ Returns the statistics for a list of (status, milliseconds). """
+    times = sorted([ms for status, ms in results])
+    return {'requests': len(results),
+            'errors': len([status for status, ms in results
+                           if status is None or status >= 400]),
+            'throughput_rps': round(len(results) / elapsed, 3),
+            'mean_ms': round(sum(times) / len(times), 3),
+            'p50_ms': round(_percentile(times, 50), 3),
+            'p95_ms': round(_percentile(times, 95), 3),
+            'p99_ms': round(_percentile(times, 99), 3),
+            'max_ms': round(times[-1], 3)}
+
+def run_load(env_path, paths, threads=8, username='anonymous', warmup=True):
+    """ Requests the paths from `threads` threads, and returns a dict with
+    the statistics for all requests ('total') and for each route
+    ('routes'). With `warmup`, each route is first requested once without
+    being measured, so that loading the environment and templates is not
+    included. Requests that fail are reported as errors. """
+    env = open_environment(env_path, use_cache=True)
+    if warmup:
+        first = {}
+        for path in paths:
+            first.setdefault(route_of(path), path)
+        for path in first.values():
+            _request(env.path, path, username)
+    pending = Queue()
+    for path in paths:
+        pending.put(path)
+    results = []
+    def worker():
+        while True:
+            try:
+                path = pending.get_nowait()
+            except Empty:
+                return
+            start = timeit.default_timer()
+            try:
+                status = _request(env.path, path, username)
+            except Exception, e:
+                env.log.error("Load test request %s failed: %s", path, e)
+                status = None
+            results.append((route_of(path), status,
+                            (timeit.default_timer() - start) * 1000))
+    workers = [threading.Thread(target=worker) for i in range(threads)]
+    start = timeit.default_timer()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = timeit.default_timer() - start
+    routes = {}
+    for route, status, ms in results:
+        routes.setdefault(route, []).append((status, ms))
+    return {'elapsed_ms': round(elapsed * 1000, 3),
+            'total': _summary([(status, ms) for route, status, ms in results],
+                              elapsed),
+            'routes': dict([(route, _summary(route_results, elapsed))
+                            for route, route_results in routes.items()])}
+
+def _close_environment(env_path):
+    """ Shuts down the environment opened by the WSGI application. """
+    env = open_environment(env_path, use_cache=True)
+    env_cache_lock.acquire()
+    try:
+        for key, value in env_cache.items():
+            if value is env:
+                del env_cache[key]
+    finally:
+        env_cache_lock.release()
+    env.shutdown()
+
+def main(args=None):
+    parser = OptionParser(usage="%prog [options]",
+            description="Load test the blog plugin through the Trac WSGI "
+                        "application, using a synthetic blog in a temporary "
+                        "Trac environment or an existing environment.")
+    parser.add_option('--env', help="use an existing Trac environment")
+    parser.add_option('--replay', metavar='FILE',
+                      help="request the paths or access log lines in FILE")
+    parser.add_option('--prefix', default='',
+                      help="base path of Trac in the replayed log")
+    parser.add_option('--requests', type='int', default=1000,
+                      help="generated requests, default: %default")
+    parser.add_option('--threads', type='int', default=8,
+                      help="concurrent threads, default: %default")
+    parser.add_option('--user', default='anonymous',
+                      help="user for the requests, default: %default")
+    parser.add_option('--seed', type='int', default=0,
+                      help="seed for the generated mix, default: %default")
+    parser.add_option('--no-warmup', dest='warmup', action='store_false',
+                      default=True, help="also measure the first requests")
+    for name, value in sorted(defaults.items()):
+        parser.add_option('--' + name, type='int', default=value,
+                          help="for the generated blog, default: %default")
+    parser.add_option('--output', help="write the JSON to a file")
+    options, args = parser.parse_args(args)
+
+    path = None
+    env_path = options.env
+    if not env_path:
+        path = tempfile.mkdtemp(prefix='fullblog-loadtest-')
+        env_path = os.path.join(path, 'env')
+    try:
+        sizes = dict([(name, getattr(options, name)) for name in defaults])
+        if path:
+            env = create_environment(env_path)
+            PermissionSystem(env).grant_permission(options.user, 'BLOG_VIEW')
+            generate_blog(env, **sizes)
+            env.shutdown()
+        if options.replay:
+            f = open(options.replay)
+            try:
+                paths = read_requests(f, options.prefix)
+            finally:
+                f.close()
+        else:
+            paths = generate_requests(options.requests, options.posts,
+                                      options.categories, options.authors,
+                                      options.seed)
+        if not paths:
+            parser.error("No requests to send")
+        try:
+            results = run_load(env_path, paths, options.threads,
+                               options.user, options.warmup)
+        finally:
+            _close_environment(env_path)
+        report = dict(results,
+            config={'env': options.env, 'replay': options.replay,
+                    'requests': len(paths), 'threads': options.threads,
+                    'user': options.user, 'warmup': options.warmup,
+                    'blog': not options.env and sizes or None},
+            platform=platform_info())
+    finally:
+        if path:
+            shutil.rmtree(path)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            f.write(output + '\n')
+        finally:
+            f.close()
+    else:
+        print output
+    return report
+
+
+class LoadTestTestCase(TestCase):
+    """ Runs the load test with a tiny blog, to keep it working. """
+
+    def test_route_of(self):
+        for path, route in [('/blog', 'front_page'),
+                            ('/blog/', 'front_page'),
+                            ('/blog?format=rss', 'rss'),
+                            ('/blog/archive', 'archive'),
+                            ('/blog/archive?period=2010/05', 'archive'),
+                            ('/blog/category/news', 'listing_category'),
+                            ('/blog/author/joe?format=rss',
+                             'listing_author_rss'),
+                            ('/blog/2010/05', 'listing_month'),
+                            ('/blog/my_post', 'post_view'),
+                            ('/blog/my_post?format=rss', 'post_rss'),
+                            ('/blog/edit/my_post', 'edit'),
+                            ('/search?q=blog', 'search'),
+                            ('/timeline', 'timeline'),
+                            ('/wiki/WikiStart', 'other')]:
+            self.assertEquals(route, route_of(path))
+
+    def test_read_requests(self):
+        lines = [
+            '/blog/archive\n',
+            '127.0.0.1 - - [10/Oct/2010:13:55:36 -0700] '
+                '"GET /trac/blog/post1?format=rss HTTP/1.1" 200 2326\n',
+            '127.0.0.1 - joe [10/Oct/2010:13:55:37 -0700] '
+                '"POST /trac/blog/post1 HTTP/1.1" 303 0 "-" "Mozilla/5.0"\n',
+            '127.0.0.1 - - [10/Oct/2010:13:55:38 -0700] '
+                '"GET /other/blog HTTP/1.1" 200 100\n',
+            '127.0.0.1 - - [10/Oct/2010:13:55:39 -0700] '
+                '"GET /trac HTTP/1.1" 200 100\n',
+            '# comment\n']
+        self.assertEquals(['/blog/post1?format=rss', '/'],
+                          read_requests(lines[1:], '/trac/'))
+        self.assertEquals(['/blog/archive', '/trac/blog/post1?format=rss',
+                           '/other/blog', '/trac'], read_requests(lines))
+
+    def test_generate_requests(self):
+        paths = generate_requests(200, posts=10)
+        self.assertEquals(paths, generate_requests(200, posts=10))
+        self.assertEquals(set([route for route, weight in mix]),
+                          set([route_of(path) for path in paths]))
+
+    def test_tiny_blog(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            log = os.path.join(tempdir, 'access.log')
+            f = open(log, 'w')
+            try:
+                f.write('/blog\n/blog/post1\n/blog/post2\n/blog/nosuchpost\n'
+                        '/search?q=lorem&blog=on\n')
+            finally:
+                f.close()
+            report = main(['--posts', '4', '--replay', log, '--threads', '2',
+                           '--output', os.path.join(tempdir, 'run.json')])
+            f = open(os.path.join(tempdir, 'run.json'))
+            try:
+                self.assertEquals(report['routes'], json.load(f)['routes'])
+            finally:
+                f.close()
+            generated = main(['--posts', '4', '--requests', '40',
+                              '--threads', '4', '--output',
+                              os.path.join(tempdir, 'generated.json')])
+        finally:
+            shutil.rmtree(tempdir)
+        self.assertEquals(5, report['total']['requests'])
+        self.assertEquals(1, report['total']['errors'])
+        self.assertEquals(3, report['routes']['post_view']['requests'])
+        self.assertEquals(1, report['routes']['post_view']['errors'])
+        self.assertEquals(0, report['routes']['search']['errors'])
+        self.assertEquals(40, generated['total']['requests'])
+        self.assertEquals(0, generated['total']['errors'])
+        for name in ['throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms']:
+            self.assertTrue(generated['total'][name] > 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+import datetime
+import gc
+import os
+import shutil
+import sys
+import tempfile
+from subprocess import PIPE, Popen
+
+from unittest import TestCase
+
+from trac.env import Environment
+from trac.perm import PermissionCache, PermissionSystem
+from trac.test import MockRequest
+from trac.util.datefmt import utc
+from trac.web.chrome import Chrome
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python < 3.4
+    tracemalloc = None
+
+from tracfullblog.core import FullBlogCore
+from tracfullblog.model import _query
+from tracfullblog.web_ui import FullBlogModule
+
+from tracfullblog.tests.benchmark import create_environment, generate_blog
+
+
+def _render_page(env, path_info, **args):
+    req = MockRequest(env, path_info=path_info, args=args, authname='user')
+    module = FullBlogModule(env)
+    assert module.match_request(req)
+    template, data, content_type = module.process_request(req)[:3]
+    Chrome(env).render_template(req, template, data, content_type)
+
+def _render_sidebar(env):
+    FullBlogCore(env).get_months_authors_categories(user='user',
+                                    perm=PermissionCache(env, 'user'))
+
+def _peak_rss():
+    """ Returns the peak resident size in bytes of the process on Linux,
+    or None if not available. """
+    try:
+        f = open('/proc/self/status')
+    except IOError:
+        return None
+    try:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) * 1024
+    finally:
+        f.close()
+
+def _reset_peak_rss():
+    """ Resets the peak resident size to the current size (Linux 4.0+). """
+    try:
+        f = open('/proc/self/clear_refs', 'w')
+    except IOError:
+        return False
+    try:
+        f.write('5')
+    finally:
+        f.close()
+    return True
+
+def _measure(func):
+    """ Returns the peak memory in bytes allocated while calling func, or
+    None if it can not be measured. Without tracemalloc, the growth of the
+    peak resident size is used, which only works in a new process. """
+    gc.collect()
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            func()
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    if _reset_peak_rss():
+        start = _peak_rss()
+        if start is not None:
+            func()
+            return _peak_rss() - start
+    return None
+
+def peak_memory(env_path, path_info=None, **args):
+    """ Returns the peak memory in bytes for rendering a blog page (or the
+    sidebar statistics if no path_info) in the environment, or None if it
+    can not be measured. It is measured in a new process, so that it is
+    not affected by memory already used or cached. """
+    command = [sys.executable, '-m', 'tracfullblog.tests.memory', env_path]
+    if path_info:
+        command.append(path_info)
+        command.extend(['%s=%s' % item for item in args.items()])
+    process = Popen(command, stdout=PIPE,
+                    env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+    output = process.communicate()[0].strip()
+    if process.returncode:
+        raise AssertionError("Measuring %r failed" % command)
+    if output != 'None':
+        return int(output)
+
+def main(args):
+    """ Prints the peak memory for rendering a page in an environment.
+    Arguments: <env path> [<path info> [name=value ...]] """
+    env = Environment(args[0])
+    # Fill the database page cache first, as it is bounded by the database
+    _query(env, "SELECT COUNT(*) FROM fullblog_posts WHERE LENGTH(body) >= 0")
+    _query(env, "SELECT COUNT(*) FROM fullblog_comments "
+                "WHERE LENGTH(comment) >= 0")
+    if len(args) > 1:
+        # The sidebar statistics are cached until the blog changes, and
+        # measured by themselves
+        _render_sidebar(env)
+        page_args = dict([arg.split('=', 1) for arg in args[2:]])
+        func = lambda: _render_page(env, args[1], **page_args)
+    else:
+        func = lambda: _render_sidebar(env)
+    print(repr(_measure(func)))
+
+
+class MemoryBudgetTestCase(TestCase):
+    """ Checks that the peak memory of pages showing a limited number of
+    posts does not grow with the total size of the blog. Only the sidebar
+    statistics (computed once until the blog changes, so measured apart
+    from the pages) and the full archive listing get a budget for each
+    post. Post bodies are made large, so that reading them for all posts
+    exceeds the budgets.
+
+    The default blog sizes keep the test fast. Set FULLBLOG_MEMORY_LARGE=1
+    to use blogs of 1000, 10000 and 100000 posts (generating them takes
+    long and needs a few GB of disk), or set the sizes using a
+    comma-separated list of numbers of posts in FULLBLOG_MEMORY_POSTS. """
+
+    if os.environ.get('FULLBLOG_MEMORY_POSTS'):
+        sizes = [int(posts) for posts
+                 in os.environ['FULLBLOG_MEMORY_POSTS'].split(',')]
+    elif os.environ.get('FULLBLOG_MEMORY_LARGE'):
+        sizes = [1000, 10000, 100000]
+    else:
+        sizes = [50, 500]
+
+    # Max. growth of peak memory for pages showing a fixed number of posts,
+    # from the smallest to the largest blog - for differences in heap layout
+    page_bytes = 150000
+
+    # Max. growth for each post in the blog, on top of page_bytes: The
+    # sidebar statistics keep the month, author and categories of each post
+    # (about 1100 bytes), and the archive lists each post
+    sidebar_bytes_per_post = 1500
+    archive_bytes_per_post = 6000
+
+    # Posts shown on listing pages, which should be full for all sizes
+    num_items = 5
+
+    @classmethod
+    def setUpClass(cls):
+        # Environments with database files, as test environments share
+        # one in-memory database
+        cls.tempdir = tempfile.mkdtemp()
+        cls.blogs = []
+        for posts in cls.sizes:
+            env = create_environment(os.path.join(cls.tempdir, str(posts)))
+            PermissionSystem(env).grant_permission('user', 'BLOG_VIEW')
+            env.config.set('fullblog', 'num_items_front', cls.num_items)
+            env.config.save()
+            # A post every other day (at least), so the last month has a
+            # full listing, and at most two years of months for all sizes
+            generate_blog(env, posts=posts, versions=1, comments=1,
+                          categories=10, authors=5, paragraphs=50,
+                          days=min(posts * 2, 730))
+            cls.blogs.append((posts, env))
+
+    @classmethod
+    def tearDownClass(cls):
+        for posts, env in cls.blogs:
+            env.shutdown()
+        shutil.rmtree(cls.tempdir)
+
+    def _assert_budget(self, path_info=None, bytes_per_post=0, **args):
+        """ Measures a page (or the sidebar) for each blog size, failing
+        if the peak memory grows by more than `page_bytes` and the budget
+        per post between sizes. """
+        peaks = [(posts, peak_memory(env.path, path_info, **args))
+                 for posts, env in self.blogs]
+        if None in [peak for posts, peak in peaks]:
+            self.skipTest("Memory use can not be measured on this platform")
+        for (posts, peak), (more_posts, more_peak) in zip(peaks, peaks[1:]):
+            budget = self.page_bytes + (more_posts - posts) * bytes_per_post
+            self.assertTrue(more_peak - peak <= budget,
+                "Peak memory grew %d bytes (budget %d) from %d to %d "
+                "posts: %r" % (more_peak - peak, budget, posts, more_posts,
+                               peaks))
+
+    def test_front_page(self):
+        self._assert_budget('/blog')
+
+    def test_listings(self):
+        last_month = datetime.datetime.now(utc).replace(day=1) \
+                        - datetime.timedelta(days=1)
+        self._assert_budget('/blog/category/category1')
+        self._assert_budget('/blog/author/author1')
+        self._assert_budget('/blog/%d/%02d' % (last_month.year,
+                                               last_month.month))
+
+    def test_feed(self):
+        self._assert_budget('/blog', format='rss')
+
+    def test_archive(self):
+        self._assert_budget('/blog/archive', self.archive_bytes_per_post)
+
+    def test_lazy_archive(self):
+        for posts, env in self.blogs:
+            env.config.set('fullblog', 'lazy_archive', 'true')
+            env.config.save()
+        try:
+            self._assert_budget('/blog/archive')
+        finally:
+            for posts, env in self.blogs:
+                env.config.remove('fullblog', 'lazy_archive')
+                env.config.save()
+
+    def test_sidebar(self):
+        self._assert_budget(None, self.sidebar_bytes_per_post)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -3,6 +3,8 @@ import datetime
 
 from tracfullblog.tests import FullBlogTestCaseTemplate
 from tracfullblog.model import *
+from tracfullblog.model import _bump_generation, _query, _retry_transaction, \
+                               _transaction
 
 
 class GroupPostsByMonthTestCase(FullBlogTestCaseTemplate):
@@ -33,6 +35,7 @@ class GroupPostsByMonthTestCase(FullBlogTestCaseTemplate):
         grouped = group_posts_by_month(get_blog_posts(self.env))
         self.assertEquals([], grouped)
 
+
 class GetBlogPostsTestCase(FullBlogTestCaseTemplate):
 
     def test_get_by_category(self):
@@ -50,3 +53,281 @@ class GetBlogPostsTestCase(FullBlogTestCaseTemplate):
         self.assertEquals('one', posts[0][0])
         self.assertEquals(get_blog_posts(self.env, category='about'),
                           get_blog_posts(self.env, category='stuff'))
+
+    def test_get_page(self):
+        for name, categories in [('one', 'stuff'), ('two', 'stuffing'),
+                                 ('three', 'stuffing'), ('four', 'stuff')]:
+            bp = BlogPost(self.env, name)
+            bp.update_fields({'title': name, 'body': 'body', 'author': 'user',
+                              'categories': categories})
+            self.assertEquals([], bp.save('user'))
+        # Same publish_time, so ordered by name
+        posts = get_blog_posts(self.env, limit=3)
+        self.assertEquals(['four', 'one', 'three'], [p[0] for p in posts])
+        posts = get_blog_posts(self.env, limit=3,
+                               before=(posts[-1][2], posts[-1][0]))
+        self.assertEquals(['two'], [p[0] for p in posts])
+        # Almost-matches for category does not shorten the page
+        posts = get_blog_posts(self.env, category='stuff', limit=1,
+                               before=(posts[0][2], 'four'))
+        self.assertEquals(['one'], [p[0] for p in posts])
+
+
+class BlogPostSelectTestCase(FullBlogTestCaseTemplate):
+
+    def _create_post(self, name, categories='', versions=1):
+        bp = BlogPost(self.env, name)
+        for i in range(versions):
+            bp.update_fields({'title': '%s v%d' % (name, i + 1),
+                              'body': 'body', 'author': 'user',
+                              'categories': categories})
+            self.assertEquals([], bp.save('user'))
+        return bp
+
+    def test_select_all(self):
+        self._create_post('one', 'about stuff', versions=2)
+        self._create_post('two')
+        posts = BlogPost.select(self.env)
+        self.assertEquals(2, len(posts))
+        by_name = dict([(bp.name, bp) for bp in posts])
+        for name in ['one', 'two']:
+            bp = BlogPost(self.env, name)
+            for field in ['version', 'title', 'body', 'publish_time',
+                          'version_time', 'author', 'categories',
+                          'category_list', 'versions']:
+                self.assertEquals(getattr(bp, field),
+                                  getattr(by_name[name], field))
+            self.assertEquals(bp.resource, by_name[name].resource)
+
+    def test_select_names_and_criteria(self):
+        self._create_post('one', 'about stuff')
+        self._create_post('two', 'stuffing')
+        self._create_post('three', 'stuff')
+        posts = BlogPost.select(self.env, names=['one', 'two'])
+        self.assertEquals(set(['one', 'two']),
+                          set([bp.name for bp in posts]))
+        posts = BlogPost.select(self.env, category='stuff')
+        self.assertEquals(set(['one', 'three']),
+                          set([bp.name for bp in posts]))
+        posts = BlogPost.select(self.env, names=['two', 'three'],
+                                category='stuff')
+        self.assertEquals(['three'], [bp.name for bp in posts])
+        self.assertEquals([], BlogPost.select(self.env, names=[]))
+
+    def test_select_all_versions(self):
+        self._create_post('one', versions=3)
+        posts = BlogPost.select(self.env, all_versions=True)
+        self.assertEquals([1, 2, 3], sorted([bp.version for bp in posts]))
+        self.assertEquals(['one v1', 'one v2', 'one v3'],
+                          sorted([bp.title for bp in posts]))
+        for bp in posts:
+            self.assertEquals([1, 2, 3], bp.versions)
+
+
+class CurrentVersionTestCase(FullBlogTestCaseTemplate):
+
+    def _current_versions(self):
+        return _query(self.env, "SELECT name, version FROM fullblog_posts "
+                                "WHERE is_current=1 ORDER BY name")
+
+    def test_save_and_delete_versions(self):
+        bp = BlogPost(self.env, 'one')
+        for i in range(3):
+            bp.update_fields({'title': 'v%d' % i, 'body': 'body',
+                              'author': 'user'})
+            self.assertEquals([], bp.save('user'))
+        self.assertEquals([('one', 3)], self._current_versions())
+        self.assertEquals('v2', get_blog_posts(self.env)[0][4])
+        bp.delete(version=3)
+        self.assertEquals([('one', 2)], self._current_versions())
+        self.assertEquals('v1', get_blog_posts(self.env)[0][4])
+        bp.delete(version=1)
+        self.assertEquals([('one', 2)], self._current_versions())
+        bp.delete()
+        self.assertEquals([], self._current_versions())
+        self.assertEquals([], get_blog_posts(self.env))
+
+
+class CategoryIndexTestCase(FullBlogTestCaseTemplate):
+
+    def test_index_follows_current_version(self):
+        bp = BlogPost(self.env, 'one')
+        bp.update_fields({'title': 'one', 'body': 'body', 'author': 'user',
+                          'categories': 'a, b b'})
+        self.assertEquals([], bp.save('user'))
+        self.assertEquals([('one', 'a'), ('one', 'b')],
+                          sorted(get_blog_categories(self.env)))
+        bp.update_fields({'categories': 'c'})
+        self.assertEquals([], bp.save('user'))
+        self.assertEquals([('one', 'c')], get_blog_categories(self.env))
+        self.assertEquals([], get_blog_posts(self.env, category='a'))
+        self.assertEquals('one', get_blog_posts(self.env, category='c')[0][0])
+        bp.delete(version=2)
+        self.assertEquals([('one', 'a'), ('one', 'b')],
+                          sorted(get_blog_categories(self.env, ['one'])))
+        bp.delete()
+        self.assertEquals([], get_blog_categories(self.env))
+
+
+class BlogCommentsTestCase(FullBlogTestCaseTemplate):
+
+    def setUp(self):
+        FullBlogTestCaseTemplate.setUp(self)
+        for name, num_comments in [('one', 3), ('two', 0)]:
+            bp = BlogPost(self.env, name)
+            bp.update_fields({'title': name, 'body': 'body',
+                              'author': 'user'})
+            self.assertEquals([], bp.save('user'))
+            for i in range(num_comments):
+                bc = BlogComment(self.env, name)
+                self.assertEquals([], bc.create('comment %d' % i, 'user'))
+
+    def test_get_comments(self):
+        comments = BlogPost(self.env, 'one').get_comments()
+        self.assertEquals([1, 2, 3], [bc.number for bc in comments])
+        for bc in comments:
+            loaded = BlogComment(self.env, 'one', bc.number)
+            self.assertEquals((loaded.post_name, loaded.comment,
+                               loaded.author, loaded.time),
+                              (bc.post_name, bc.comment, bc.author, bc.time))
+        self.assertEquals([], BlogPost(self.env, 'two').get_comments())
+
+    def test_comment_counts(self):
+        self.assertEquals({'one': 3, 'two': 0, 'three': 0},
+                get_blog_comment_counts(self.env, ['one', 'two', 'three']))
+        self.assertEquals(3, BlogPost(self.env, 'one').get_comment_count())
+        counts = dict([(bp.name, bp.get_comment_count())
+                       for bp in BlogPost.select(self.env)])
+        self.assertEquals({'one': 3, 'two': 0}, counts)
+
+    def test_delete_post_deletes_comments(self):
+        BlogPost(self.env, 'one').delete()
+        self.assertEquals([], get_blog_comments(self.env))
+
+    def test_comment_numbering(self):
+        self.assertEquals(4, BlogComment(self.env, 'one')._next_comment_number())
+        self.assertEquals(1, BlogComment(self.env, 'two')._next_comment_number())
+        self.assertEquals(0, BlogComment(self.env, 'nope')._next_comment_number())
+        BlogComment(self.env, 'one', 2).delete()
+        bc = BlogComment(self.env, 'one')
+        self.assertEquals([], bc.create('comment 4', 'user'))
+        self.assertEquals(4, bc.number)
+        loaded = BlogComment(self.env, 'one', 4)
+        self.assertEquals((bc.comment, bc.author, bc.time),
+                          (loaded.comment, loaded.author, loaded.time))
+        self.assertEquals([1, 3, 4],
+                          [c.number for c in BlogPost(self.env, 'one').get_comments()])
+
+    def test_retry_transaction(self):
+        attempts = []
+        def do_insert(cursor):
+            attempts.append(1)
+            number = len(attempts) < 3 and 1 or 10
+            cursor.execute("INSERT INTO fullblog_comments "
+                           "(name, number, comment, author, time) "
+                           "VALUES ('one', %s, 'retried', 'user', 0)",
+                           (number,))
+            return number
+        self.assertEquals(10, _retry_transaction(self.env, do_insert))
+        self.assertEquals(3, len(attempts))
+        self.assertEquals('retried', BlogComment(self.env, 'one', 10).comment)
+        del attempts[:]
+        self.assertRaises(self.env.db_exc.IntegrityError,
+                          _retry_transaction, self.env, do_insert, retries=2)
+        self.assertEquals(2, len(attempts))
+
+    def test_post_titles(self):
+        self.assertEquals({'one': 'one', 'two': 'two'},
+                get_blog_post_titles(self.env, ['one', 'two', 'three']))
+        self.assertEquals({}, get_blog_post_titles(self.env, []))
+
+
+class DeferredFieldsTestCase(FullBlogTestCaseTemplate):
+
+    def setUp(self):
+        FullBlogTestCaseTemplate.setUp(self)
+        bp = BlogPost(self.env, 'post')
+        bp.update_fields({'title': 'title', 'body': 'body 1',
+                          'author': 'user'})
+        self.assertEquals([], bp.save('user', 'first'))
+        self.assertEquals('body 1', bp.body)
+        self.assertEquals('first', bp.version_comment)
+        bp.update_fields({'body': 'body 2'})
+        self.assertEquals([], bp.save('user', 'second'))
+
+    def test_body_loaded_on_use(self):
+        bp = BlogPost(self.env, 'post')
+        self.assertEquals('title', bp.title)
+        self.assertFalse('_body' in bp.__dict__)
+        self.assertEquals('body 2', bp.body)
+        self.assertEquals('second', bp.version_comment)
+        bp = BlogPost(self.env, 'post', 1)
+        self.assertEquals(('body 1', 'first'), (bp.body, bp.version_comment))
+
+    def test_update_fields(self):
+        bp = BlogPost(self.env, 'post')
+        self.assertFalse(bp.update_fields({'body': 'body 2'}))
+        bp = BlogPost(self.env, 'post')
+        bp.body = 'body 3'
+        self.assertEquals(('body 3', 'second'), (bp.body, bp.version_comment))
+        self.assertEquals(u'', BlogPost(self.env, 'missing').body)
+
+
+class PostCacheTestCase(FullBlogTestCaseTemplate):
+
+    def setUp(self):
+        FullBlogTestCaseTemplate.setUp(self)
+        bp = BlogPost(self.env, 'post')
+        bp.update_fields({'title': 'title 1', 'body': 'body',
+                          'author': 'user', 'categories': 'a b'})
+        self.assertEquals([], bp.save('user'))
+
+    def test_fields_cached(self):
+        cache = BlogPostCache(self.env)
+        bp = BlogPost(self.env, 'post')
+        self.assertEquals(1, len(cache.fields))
+        bp.category_list.add('c')
+        # Cached fields are the same, but not shared
+        self.assertEquals(set(['a', 'b']), BlogPost(self.env, 'post').category_list)
+        self.assertEquals(1, len(cache.fields))
+        fields = bp._fetch_fields()
+        self.assertEquals(('title 1', 'body'), (fields['title'], fields['body']))
+
+    def test_save_and_delete(self):
+        bp = BlogPost(self.env, 'post')
+        bp.update_fields({'title': 'title 2'})
+        self.assertEquals([], bp.save('user'))
+        self.assertEquals('title 2', BlogPost(self.env, 'post').title)
+        self.assertEquals('title 1', BlogPost(self.env, 'post', 1).title)
+        bp.delete(version=2)
+        self.assertEquals('title 1', BlogPost(self.env, 'post').title)
+        bp.delete()
+        self.assertEquals([], BlogPost(self.env, 'post').versions)
+
+    def test_change_by_other_process(self):
+        self.assertEquals('title 1', BlogPost(self.env, 'post').title)
+        def do_change(cursor):
+            cursor.execute("UPDATE fullblog_posts SET is_current=0")
+            cursor.execute("INSERT INTO fullblog_posts (name, version, "
+                "title, body, publish_time, version_time, author, "
+                "categories, is_current) "
+                "VALUES ('post', 2, 'title 2', 'body', 0, 0, 'user', '', 1)")
+            _bump_generation(self.env, cursor)
+        _transaction(self.env, do_change)
+        bp = BlogPost(self.env, 'post')
+        self.assertEquals([1, 2], bp.versions)
+        self.assertEquals('title 2', bp.title)
+
+    def test_version_saved_again(self):
+        bp = BlogPost(self.env, 'post')
+        bp.update_fields({'title': 'title 2', 'categories': 'c'})
+        self.assertEquals([], bp.save('user'))
+        self.assertEquals('title 2', BlogPost(self.env, 'post').title)
+        # Version 2 saved again within the same second
+        bp.delete(version=2)
+        bp = BlogPost(self.env, 'post')
+        bp.update_fields({'title': 'title 3', 'categories': 'd'})
+        self.assertEquals([], bp.save('user'))
+        bp = BlogPost(self.env, 'post')
+        self.assertEquals((2, 'title 3', set(['d'])),
+                          (bp.version, bp.title, bp.category_list))
@@ -0,0 +1,142 @@
+import datetime
+
+from trac.perm import PermissionSystem
+from trac.test import MockRequest
+from trac.util.datefmt import utc
+from trac.web.chrome import Chrome
+from trac.wiki.formatter import Formatter
+
+try:
+    from trac.web.chrome import web_context
+except ImportError:
+    from trac.mimeview.api import Context
+    web_context = Context.from_request
+
+from tracfullblog.core import FullBlogCore
+from tracfullblog.macros import BlogListMacro
+from tracfullblog.web_ui import FullBlogModule
+
+from tracfullblog.tests import FullBlogTestCaseTemplate, QueryCounter
+from tracfullblog.tests.benchmark import generate_blog
+
+
+class QueryCountTestCase(FullBlogTestCaseTemplate):
+    """ Guards against queries per post (N+1 patterns) by running each entry
+    point on blogs of different sizes, and asserting that the number of
+    statements executed is the same for all sizes. The statements include
+    the queries made by Trac (like for permissions or wiki links), so the
+    enabled components are fixed. The plugin queries also have an upper
+    bound. """
+
+    components = ['trac.*', 'tracfullblog.*']
+
+    # Number of posts in the blogs compared
+    sizes = [3, 40]
+
+    def setUp(self):
+        # A blog of each size is created by _assert_queries(), with these
+        # (section, name, value) options set
+        self.options = []
+
+    def tearDown(self):
+        pass
+
+    def _create_blog(self, posts):
+        FullBlogTestCaseTemplate.setUp(self)
+        for section, name, value in self.options:
+            self.env.config.set(section, name, value)
+        PermissionSystem(self.env).grant_permission('user', 'BLOG_ADMIN')
+        generate_blog(self.env, posts=posts, versions=2, comments=3,
+                      categories=3, authors=2, paragraphs=1, days=10)
+        self.module = FullBlogModule(self.env)
+
+    def _assert_queries(self, bound, func):
+        """ Calls func twice (with empty and filled caches) for each blog
+        size, checking that neither time executes more than `bound` plugin
+        queries, and that the number of statements does not depend on the
+        size of the blog. """
+        runs = {}
+        for posts in self.sizes:
+            self._create_blog(posts)
+            try:
+                for run in ('first', 'second'):
+                    with QueryCounter() as counter:
+                        func()
+                    plugin = [sql for sql in counter.queries
+                              if 'fullblog' in sql]
+                    self.assertTrue(len(plugin) <= bound,
+                        "%d queries (max %d) in %s run with %d posts:\n%s"
+                        % (len(plugin), bound, run, posts, "\n".join(plugin)))
+                    runs.setdefault(run, []).append((posts, counter.queries))
+            finally:
+                FullBlogTestCaseTemplate.tearDown(self)
+        for run, counts in runs.iteritems():
+            (posts, queries), (more_posts, more_queries) = counts[0], counts[-1]
+            self.assertEquals(len(queries), len(more_queries),
+                "%d statements with %d posts, %d with %d posts in %s run:"
+                "\n%s\n\nvs.\n\n%s" % (len(queries), posts,
+                    len(more_queries), more_posts, run, "\n".join(queries),
+                    "\n".join(more_queries)))
+
+    def _request(self, bound, path_info, **args):
+        def process():
+            core = FullBlogCore(self.env)
+            req = MockRequest(self.env, path_info=path_info, args=args,
+                              authname='user')
+            self.assertTrue(self.module.match_request(req))
+            core.pre_process_request(req, self.module)
+            try:
+                template, data, content_type = \
+                        self.module.process_request(req)[:3]
+                Chrome(self.env).render_template(req, template, data,
+                                                 content_type)
+            finally:
+                core.post_process_request(req, None, None, None)
+        self._assert_queries(bound, process)
+
+    def test_front_page(self):
+        self._request(8, '/blog')
+
+    def test_archive(self):
+        self._request(6, '/blog/archive')
+
+    def test_lazy_archive(self):
+        self.options.append(('fullblog', 'lazy_archive', 'true'))
+        self._request(5, '/blog/archive')
+
+    def test_listings(self):
+        now = datetime.datetime.now(utc)
+        self._request(8, '/blog/category/category1')
+        self._request(8, '/blog/author/author1')
+        self._request(8, '/blog/%d/%02d' % (now.year, now.month))
+
+    def test_post_view(self):
+        self._request(12, '/blog/post1')
+
+    def test_feeds(self):
+        self._request(8, '/blog', format='rss')
+        self._request(9, '/blog/post1', format='rss')
+
+    def test_search(self):
+        def search():
+            req = MockRequest(self.env, authname='user')
+            list(self.module.get_search_results(req, ['lorem'], ['blog']))
+        self._assert_queries(2, search)
+
+    def test_timeline(self):
+        def timeline():
+            req = MockRequest(self.env, authname='user')
+            stop = datetime.datetime.now(utc)
+            list(self.module.get_timeline_events(req,
+                    stop - datetime.timedelta(days=30), stop, ['blog']))
+        self._assert_queries(3, timeline)
+
+    def test_macro(self):
+        for content in ('', 'format=full, recent=5', 'format=float'):
+            def expand():
+                req = MockRequest(self.env, authname='user')
+                formatter = Formatter(self.env, web_context(req))
+                unicode(BlogListMacro(self.env).expand_macro(formatter,
+                                                    'BlogList', content))
+            self._assert_queries(3, expand)
+
@@ -0,0 +1,124 @@
+from trac.test import Mock
+
+from tracfullblog.core import FullBlogCore
+from tracfullblog.model import BlogComment, BlogPost, search_blog_comments, \
+                               search_blog_posts
+from tracfullblog.search import FullBlogSearchIndex, tokenize, _prefix_range
+
+from tracfullblog.tests import FullBlogTestCaseTemplate, QueryCounter
+
+
+class FullBlogSearchIndexTestCase(FullBlogTestCaseTemplate):
+
+    def setUp(self):
+        FullBlogTestCaseTemplate.setUp(self)
+        self.env.config.set('fullblog', 'search_index', 'true')
+        self.core = FullBlogCore(self.env)
+        self.index = FullBlogSearchIndex(self.env)
+        self.req = Mock(args={})
+        self._post('first', 'Trac plugins', 'Writing a plugin for Trac.')
+        self._post('second', 'Other things', 'Plugins plugins plugins.')
+        self._post('third', 'Nothing', 'Nothing to see here.')
+
+    def _post(self, name, title, body):
+        bp = BlogPost(self.env, name)
+        bp.update_fields({'title': title, 'body': body, 'author': 'user'})
+        self.assertEquals([], self.core.create_post(self.req, bp, 'user'))
+        return bp
+
+    def _comment(self, name, comment):
+        bc = BlogComment(self.env, name)
+        bc.comment = comment
+        bc.author = 'user'
+        self.assertEquals([], self.core.create_comment(self.req, bc))
+        return bc
+
+    def _names(self, results):
+        return [row[0] for row in results]
+
+    def test_tokenize(self):
+        self.assertEquals([u'trac', u'blog', u'plugin'],
+                          tokenize(u'Trac - a blog plugin!'))
+
+    def test_ranked_results(self):
+        # Title matches weigh more than repeated matches in the body
+        self.assertEquals(['first', 'second'],
+                self._names(self.index.search_blog_posts(['plugin'])))
+        self.assertEquals(['first'],
+                self._names(self.index.search_blog_posts(['plugin', 'trac'])))
+        self.assertEquals(['second'],
+                self._names(self.index.search_blog_posts(['plugin', '-trac'])))
+        # Exclusions are not prefixes
+        self.assertEquals(['first', 'second'],
+                self._names(self.index.search_blog_posts(['plugin', '-plug'])))
+        self.assertEquals([],
+                self._names(self.index.search_blog_posts(['missing'])))
+
+    def test_updated_on_changes(self):
+        self._post('third', 'Something', 'A new plugin.')
+        self.assertEquals(['first', 'second', 'third'],
+                self._names(self.index.search_blog_posts(['plugin'])))
+        self.assertEquals([], self.index.search_blog_posts(['nothing']))
+        self._comment('third', 'Nice plugin')
+        self._comment('third', 'Thanks')
+        self.assertEquals([('third', 1)], [row[:2] for row in
+                self.index.search_blog_comments(['nice'])])
+        self.core.delete_comment(BlogComment(self.env, 'third', 1))
+        self.assertEquals([], self.index.search_blog_comments(['nice']))
+        self.core.delete_post(BlogPost(self.env, 'third'))
+        self.assertEquals([], self.index.search_blog_posts(['something']))
+        self.assertEquals([], self.index.search_blog_comments(['thanks']))
+
+    def test_reindex(self):
+        bp = BlogPost(self.env, 'unindexed')
+        bp.update_fields({'title': 'Unindexed', 'body': 'plugin',
+                          'author': 'user'})
+        self.assertEquals([], bp.save('user'))
+        self.assertEquals([], self.index.search_blog_posts(['unindexed']))
+        self.assertEquals((4, 0), self.index.reindex())
+        self.assertEquals(['unindexed'],
+                self._names(self.index.search_blog_posts(['unindexed'])))
+
+    def test_prefix_uses_index(self):
+        with QueryCounter('fullblog_search_terms') as counter:
+            self.assertEquals(['first', 'second'],
+                    self._names(self.index.search_blog_posts(['plug'])))
+        self.assertEquals(1, len(counter))
+        self.assertTrue('LIKE' not in counter.queries[0].upper())
+        self.assertEquals([],
+                self._names(self.index.search_blog_posts(['plugins_'])))
+
+    def test_short_terms(self):
+        # One-character words are not indexed, so the regular search is used
+        self._post('fourth', 'C', 'A post about C.')
+        self._comment('fourth', 'Use C++')
+        self.assertEquals(['fourth'],
+                self._names(self.index.search_blog_posts(['c', 'post'])))
+        self.assertEquals(['fourth'],
+                self._names(self.index.search_blog_comments(['c++'])))
+
+    def test_comments_of_hits_only(self):
+        self._comment('first', 'Nice plugin')
+        for i in range(5):
+            self._comment('first', 'Thanks %d' % i)
+        with QueryCounter('FROM fullblog_comments') as counter:
+            self.assertEquals([('first', 1)], [row[:2] for row in
+                    self.index.search_blog_comments(['nice'])])
+        self.assertEquals(1, len(counter))
+        self.assertTrue('number=' in counter.queries[0])
+
+    def test_only_exclusions(self):
+        # Needs all documents, so the regular search is used
+        with QueryCounter('fullblog_search_terms') as counter:
+            self.assertEquals(search_blog_posts(self.env, ['-other']),
+                              self.index.search_blog_posts(['-other']))
+            self.assertEquals(search_blog_comments(self.env, ['-other']),
+                              self.index.search_blog_comments(['-other']))
+        self.assertEquals(0, len(counter))
+
+    def test_prefix_range(self):
+        self.assertEquals((u'plug', u'pluh'), _prefix_range(u'plug'))
+        self.assertEquals((u'caf\xe9', u'caf\xea'), _prefix_range(u'caf\xe9'))
+        self._post('fourth', u'Caf\xe9', u'Caf\xe9s and caff\xe8 latte.')
+        self.assertEquals(['fourth'],
+                self._names(self.index.search_blog_posts([u'caf\xe9'])))
@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+"""
+Stress test for concurrent writes: many writers saving new versions of
+the same posts and adding comments to them at the same time, through
+FullBlogCore.create_post() and create_comment(), from threads in one or
+more processes.
+
+Usage (see --help for more options):
+    python -m tracfullblog.tests.stress --processes 4 --threads 4 \\
+            --writes 50 --posts 2
+
+Without --env, a temporary environment with a SQLite database file is
+used. Afterwards the database is checked, and the JSON report has:
+ * the successful writes per second, and the failed writes by reason;
+ * the primary key conflicts, both retried by the plugin and failed;
+ * lost writes - writes reported successful that are not stored;
+ * stale edits - versions saved on top of a version the writer had not
+   seen, silently replacing the changes of another writer;
+ * consistency errors - posts without exactly one current version (the
+   latest), or with categories not matching the current version.
+
+License: BSD
+
+(c) 2007 ::: www.CodeResort.com - BV Network AS (simon-code@bvnetwork.no)
+"""
+
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import threading
+import timeit
+from optparse import OptionParser
+from unittest import TestCase
+
+from trac.env import Environment
+from trac.test import MockRequest
+from trac.util.datefmt import utc
+
+from tracfullblog.core import FullBlogCore
+from tracfullblog.model import BlogComment, BlogPost, _parse_categories, \
+                               _query
+from tracfullblog.tests.benchmark import create_environment, platform_info
+
+__all__ = ['check_writes', 'create_posts', 'run_stress']
+
+_counters = ['posts_saved', 'comments_created', 'warnings', 'conflicts',
+             'locked', 'errors', 'stale_edits', 'retries']
+
+
+class _RetryCounter(logging.Handler):
+    """ Counts the transactions retried by the plugin after a primary key
+    conflict, as logged by model._retry_transaction(). """
+
+    def __init__(self):
+        logging.Handler.__init__(self, logging.DEBUG)
+        self.count = 0
+
+    def emit(self, record):
+        # Called with the lock of the handler held
+        if 'Retrying transaction after integrity error' in \
+                                                    record.getMessage():
+            self.count += 1
+
+
+def create_posts(env, count, author='writer'):
+    """ Creates the posts that the writers will change, and returns their
+    names. """
+    names = []
+    for i in range(count):
+        bp = BlogPost(env, u'stress%d' % i)
+        bp.update_fields({'title': u'Stress test post %d' % i,
+                          'body': u'Initial version.', 'author': author,
+                          'categories': u'initial'})
+        bp.save(author, u'Initial version')
+        names.append(bp.name)
+    return names
+
+def _write(env, req, names, rand, token, comment_ratio, stats, written):
+    """ Makes one change: a new version of a post, or a comment. """
+    name = rand.choice(names)
+    if rand.random() < comment_ratio:
+        bc = BlogComment(env, name)
+        bc.comment = u'Comment %s' % token
+        bc.author = req.authname
+        bc.time = datetime.datetime.now(utc)
+        warnings = FullBlogCore(env).create_comment(req, bc)
+        if not warnings:
+            stats['comments_created'] += 1
+            written['comments'].append((name, bc.comment))
+    else:
+        bp = BlogPost(env, name)
+        seen = bp.version
+        bp.update_fields({'body': u'Edit %s' % token,
+                          'categories': u'edit-%s' % token})
+        warnings = FullBlogCore(env).create_post(req, bp, req.authname,
+                                                 u'Edit %s' % token)
+        if not warnings:
+            stats['posts_saved'] += 1
+            written['versions'].append((name, bp.body))
+            if bp.version != seen + 1:
+                stats['stale_edits'] += 1
+    if warnings:
+        stats['warnings'] += 1
+
+def _run_writer(env, names, writer_id, writes, comment_ratio, stats,
+                written, lock):
+    """ Makes `writes` changes, and adds the counts to stats. """
+    rand = random.Random(writer_id)
+    req = MockRequest(env, authname='writer')
+    own = dict([(counter, 0) for counter in _counters])
+    own_written = {'versions': [], 'comments': []}
+    if hasattr(env, 'db_exc'):
+        integrity_error = env.db_exc.IntegrityError
+        operational_error = env.db_exc.OperationalError
+    else:
+        integrity_error = operational_error = ()
+    for i in range(writes):
+        try:
+            _write(env, req, names, rand, '%s-%d' % (writer_id, i),
+                   comment_ratio, own, own_written)
+        except integrity_error:
+            own['conflicts'] += 1
+        except operational_error, e:
+            # Like 'database is locked' for SQLite
+            own['locked'] += 1
+            env.log.debug("Stress test write failed: %s", e)
+        except Exception, e:
+            own['errors'] += 1
+            env.log.error("Stress test write failed: %s", e, exc_info=True)
+    lock.acquire()
+    try:
+        for counter in _counters:
+            stats[counter] += own[counter]
+        for kind in written:
+            written[kind].extend(own_written[kind])
+    finally:
+        lock.release()
+
+def _run_process(env_path, names, process_id, threads, writes,
+                 comment_ratio, results=None):
+    """ Runs the writer threads in this process, using a new environment.
+    Returns (stats, written), or puts them on the `results` queue. """
+    env = Environment(env_path)
+    counter = _RetryCounter()
+    env.log.addHandler(counter)
+    env.log.setLevel(logging.DEBUG)
+    stats = dict([(name, 0) for name in _counters])
+    written = {'versions': [], 'comments': []}
+    lock = threading.Lock()
+    workers = [threading.Thread(target=_run_writer,
+                    args=(env, names, '%d-%d' % (process_id, i), writes,
+                          comment_ratio, stats, written, lock))
+               for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    env.log.removeHandler(counter)
+    stats['retries'] = counter.count
+    env.shutdown()
+    if results is None:
+        return stats, written
+    results.put((stats, written))
+
+def check_writes(env, names, written):
+    """ Checks the stored posts and comments against the writes reported
+    successful. Returns a dict with the number of lost writes, and of
+    posts with inconsistent current version or category index. """
+    versions = {}
+    latest = {}
+    current = {}
+    for name, version, body, is_current, categories in _query(env,
+            "SELECT name, version, body, is_current, categories "
+            "FROM fullblog_posts"):
+        versions.setdefault(name, set()).add(body)
+        latest[name] = max(version, latest.get(name, 0))
+        if is_current:
+            current.setdefault(name, []).append((version, categories))
+    comments = set(_query(env, "SELECT name, comment FROM fullblog_comments"))
+    indexed = {}
+    for name, category in _query(env, "SELECT name, category "
+                                 "FROM fullblog_post_categories"):
+        indexed.setdefault(name, set()).add(category)
+    lost_versions = [(name, body) for name, body in written['versions']
+                     if not body in versions.get(name, ())]
+    lost_comments = [comment for comment in written['comments']
+                     if not comment in comments]
+    current_errors = 0
+    index_errors = 0
+    for name in names:
+        rows = current.get(name, [])
+        if len(rows) != 1 or rows[0][0] != latest[name]:
+            current_errors += 1
+        elif set(_parse_categories(rows[0][1])) != indexed.get(name, set()):
+            index_errors += 1
+    return {'lost_versions': len(lost_versions),
+            'lost_comments': len(lost_comments),
+            'current_errors': current_errors,
+            'index_errors': index_errors}
+
+def run_stress(env_path, names, processes=1, threads=4, writes=20,
+               comment_ratio=0.5):
+    """ Runs `threads` writers in each of `processes` processes (in this
+    process if 1), each making `writes` changes to the posts in `names`.
+    Returns a dict with the counts and throughput. """
+    start = timeit.default_timer()
+    if processes == 1:
+        outcomes = [_run_process(env_path, names, 0, threads, writes,
+                                 comment_ratio)]
+    else:
+        results = multiprocessing.Queue()
+        children = [multiprocessing.Process(target=_run_process,
+                        args=(env_path, names, i, threads, writes,
+                              comment_ratio, results))
+                    for i in range(processes)]
+        for child in children:
+            child.start()
+        outcomes = [results.get() for child in children]
+        for child in children:
+            child.join()
+    elapsed = timeit.default_timer() - start
+    stats = dict([(name, 0) for name in _counters])
+    written = {'versions': [], 'comments': []}
+    for child_stats, child_written in outcomes:
+        for counter in _counters:
+            stats[counter] += child_stats[counter]
+        for kind in written:
+            written[kind].extend(child_written[kind])
+    successful = stats['posts_saved'] + stats['comments_created']
+    stats.update({'attempted': processes * threads * writes,
+                  'successful': successful,
+                  'elapsed_ms': round(elapsed * 1000, 3),
+                  'writes_per_second': round(successful / elapsed, 3)})
+    env = Environment(env_path)
+    try:
+        stats.update(check_writes(env, names, written))
+    finally:
+        env.shutdown()
+    return stats
+
+def main(args=None):
+    parser = OptionParser(usage="%prog [options]",
+            description="Stress test concurrent writes of blog posts and "
+                        "comments, in a temporary Trac environment or an "
+                        "existing environment.")
+    parser.add_option('--env', help="use an existing Trac environment "
+                      "(posts named 'stressN' are created)")
+    parser.add_option('--posts', type='int', default=2,
+                      help="posts to change, default: %default")
+    parser.add_option('--processes', type='int', default=2,
+                      help="writer processes, default: %default")
+    parser.add_option('--threads', type='int', default=4,
+                      help="writer threads in each process, "
+                           "default: %default")
+    parser.add_option('--writes', type='int', default=25,
+                      help="writes by each thread, default: %default")
+    parser.add_option('--comments', type='float', default=0.5,
+                      help="share of writes that are comments, "
+                           "default: %default")
+    parser.add_option('--output', help="write the JSON to a file")
+    options, args = parser.parse_args(args)
+
+    path = None
+    env_path = options.env
+    if not env_path:
+        path = tempfile.mkdtemp(prefix='fullblog-stress-')
+        env_path = os.path.join(path, 'env')
+    try:
+        if path:
+            env = create_environment(env_path)
+        else:
+            env = Environment(env_path)
+        names = create_posts(env, options.posts)
+        env.shutdown()
+        report = {
+            'config': {'env': options.env, 'posts': options.posts,
+                       'processes': options.processes,
+                       'threads': options.threads, 'writes': options.writes,
+                       'comments': options.comments},
+            'platform': platform_info(),
+            'results': run_stress(env_path, names, options.processes,
+                                  options.threads, options.writes,
+                                  options.comments)}
+    finally:
+        if path:
+            shutil.rmtree(path)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            f.write(output + '\n')
+        finally:
+            f.close()
+    else:
+        print output
+    return report
+
+
+class StressTestCase(TestCase):
+    """ Runs the stress test with a few writers, checking that no writes
+    reported successful are lost and that the posts stay consistent. """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        env = create_environment(os.path.join(self.tempdir, 'env'))
+        self.env_path = env.path
+        self.names = create_posts(env, 2)
+        env.shutdown()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _assert_consistent(self, stats):
+        self.assertEquals(stats['attempted'], stats['successful']
+                          + stats['warnings'] + stats['conflicts']
+                          + stats['locked'] + stats['errors'])
+        self.assertEquals(0, stats['errors'])
+        self.assertEquals(0, stats['lost_versions'])
+        self.assertEquals(0, stats['lost_comments'])
+        self.assertEquals(0, stats['current_errors'])
+        self.assertEquals(0, stats['index_errors'])
+        self.assertTrue(stats['successful'] > 0)
+
+    def test_threads(self):
+        stats = run_stress(self.env_path, self.names, processes=1,
+                           threads=4, writes=10)
+        self._assert_consistent(stats)
+        self.assertEquals(40, stats['attempted'])
+
+    def test_processes(self):
+        stats = run_stress(self.env_path, self.names, processes=2,
+                           threads=2, writes=10)
+        self._assert_consistent(stats)
+        self.assertEquals(40, stats['attempted'])
+
+    def test_main(self):
+        output = os.path.join(self.tempdir, 'run.json')
+        report = main(['--processes', '1', '--threads', '2', '--writes', '3',
+                       '--output', output])
+        f = open(output)
+        try:
+            self.assertEquals(report['results'], json.load(f)['results'])
+        finally:
+            f.close()
+        self.assertEquals(6, report['results']['attempted'])
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,24 @@
 
+import datetime
+
 from trac.core import TracError
 from trac.perm import PermissionCache, PermissionSystem, PermissionError
 from trac.resource import Resource
-from trac.test import Mock
+from trac.test import Mock, MockRequest
+from trac.util.datefmt import utc
 from trac.util.html import Markup
+from trac.util.text import unicode_unquote
 from trac.web.api import HTTPNotFound, RequestDone
 from trac.web.href import Href
 
-from tracfullblog.model import BlogPost, get_blog_posts
+try:
+    from trac.web.chrome import web_context
+except ImportError:
+    from trac.mimeview.api import Context
+    web_context = Context.from_request
+
+from tracfullblog.model import BlogComment, BlogPost, _transaction, \
+                               get_blog_posts
 from tracfullblog.web_ui import FullBlogModule
 
 from tracfullblog.tests import FullBlogTestCaseTemplate
@@ -70,6 +81,140 @@ class FullBlogRssTestCase(FullBlogTestCaseTemplate):
 
         self.assertEquals('fullblog.rss', template)
 
+    def _feed_req(self, path_info='/blog', **args):
+        checked = []
+        args['format'] = 'rss'
+        req = Mock(method='GET', base_path='', cgi_location='',
+                   path_info=path_info, href=Href('/trac'),
+                   abs_href=Href('http://domain/trac'),
+                   args=args, chrome={}, headers=[],
+                   perm=PermissionCache(self.env, 'user'), authname='user',
+                   send_header=lambda name, value: req.headers.append(name),
+                   check_modified=lambda dt, extra: checked.append(
+                                                        (dt, extra)))
+        return req, checked
+
+    def test_rss_conditional_get(self):
+        PermissionSystem(self.env).grant_permission('user', 'BLOG_VIEW')
+        module = FullBlogModule(self.env)
+        for name in ['one', 'two']:
+            bp = BlogPost(self.env, name)
+            bp.update_fields({'title': name, 'body': 'body',
+                              'author': 'user'})
+            self.assertEquals([], bp.save('user'))
+        req, checked = self._feed_req()
+        assert module.match_request(req)
+        template, data, _ = module.process_request(req)
+        self.assertEquals('fullblog.rss', template)
+        self.assertEquals(['Last-Modified'], req.headers)
+        self.assertEquals(['one', 'two'],
+                          [bp.name for bp in data['blog_post_list']])
+        # The feed tag changes when posts are removed
+        BlogPost(self.env, 'one').delete()
+        req, checked_after = self._feed_req()
+        assert module.match_request(req)
+        module.process_request(req)
+        self.assertNotEquals(checked, checked_after)
+
+    def test_rss_post_conditional_get(self):
+        PermissionSystem(self.env).grant_permission('user', 'BLOG_VIEW')
+        module = FullBlogModule(self.env)
+        bp = BlogPost(self.env, 'one')
+        bp.update_fields({'title': 'one', 'body': 'body', 'author': 'user'})
+        self.assertEquals([], bp.save('user'))
+        req, checked = self._feed_req('/blog/one')
+        assert module.match_request(req)
+        template, data, _ = module.process_request(req)
+        self.assertEquals('fullblog_post.rss', template)
+        # The feed tag changes with new comments
+        BlogComment(self.env, 'one').create('comment', 'user')
+        req, checked_after = self._feed_req('/blog/one')
+        assert module.match_request(req)
+        module.process_request(req)
+        self.assertNotEquals(checked, checked_after)
+
+
+class FullBlogSearchTestCase(FullBlogTestCaseTemplate):
+
+    def test_search_comments(self):
+        PermissionSystem(self.env).grant_permission('user', 'BLOG_VIEW')
+        for name in ['one', 'two']:
+            bp = BlogPost(self.env, name)
+            bp.update_fields({'title': 'Title ' + name,
+                              'body': name == 'one' and 'match' or 'body',
+                              'author': 'user'})
+            self.assertEquals([], bp.save('user'))
+            for i in range(2):
+                self.assertEquals([], BlogComment(self.env, name).create(
+                                            'match %d' % i, 'user'))
+        req = Mock(href=Href('/trac'), perm=PermissionCache(self.env, 'user'))
+        results = FullBlogModule(self.env).get_search_results(req,
+                                                    ['match'], ['blog'])
+        self.assertEquals([u'Blog: Title one',
+                           u'Blog: Title one (Comment 1)',
+                           u'Blog: Title one (Comment 2)',
+                           u'Blog: Title two (Comment 1)',
+                           u'Blog: Title two (Comment 2)'],
+                          sorted([result[1] for result in results]))
+
+
+class FullBlogTimelineTestCase(FullBlogTestCaseTemplate):
+
+    def test_timeline_events(self):
+        PermissionSystem(self.env).grant_permission('user', 'BLOG_VIEW')
+        bp = BlogPost(self.env, 'one')
+        bp.update_fields({'title': 'Title one', 'body': 'body',
+                          'author': 'user'})
+        self.assertEquals([], bp.save('user', 'Created'))
+        self.assertEquals([], bp.save('user', 'Edited'))
+        self.assertEquals([], BlogComment(self.env, 'one').create(
+                                                    "'''comment'''", 'user'))
+        module = FullBlogModule(self.env)
+        req = MockRequest(self.env, authname='user')
+        now = datetime.datetime.now(utc)
+        events = [event for event in module.get_timeline_events(req,
+                        now - datetime.timedelta(days=1),
+                        now + datetime.timedelta(days=1), ['blog'])
+                  if event[0] == 'blog']
+        context = web_context(req)
+        rendered = sorted([(unicode(module.render_timeline_event(
+                                    context, 'title', event)),
+                            unicode(module.render_timeline_event(
+                                    context, 'description', event)))
+                           for event in events])
+        self.assertEquals(3, len(rendered))
+        self.assertEquals(u'Blog: <em>Title one</em> comment added',
+                          rendered[0][0])
+        self.assertTrue(u'<strong>comment</strong>' in rendered[0][1])
+        self.assertEquals([u'Blog: <em>Title one</em> created',
+                           u'Blog: <em>Title one</em> edited'],
+                          [title for title, description in rendered[1:]])
+        self.assertTrue(u'Created' in rendered[1][1])
+        self.assertTrue(u'Edited' in rendered[2][1])
+
+    def test_timeline_comment_without_title(self):
+        PermissionSystem(self.env).grant_permission('user', 'BLOG_VIEW')
+        bp = BlogPost(self.env, 'one')
+        bp.update_fields({'title': 'Title one', 'body': 'body',
+                          'author': 'user'})
+        self.assertEquals([], bp.save('user', 'Created'))
+        self.assertEquals([], BlogComment(self.env, 'one').create(
+                                                    'comment', 'user'))
+        def do_delete(cursor):
+            cursor.execute("DELETE FROM fullblog_posts WHERE name='one'")
+        _transaction(self.env, do_delete)
+        module = FullBlogModule(self.env)
+        req = MockRequest(self.env, authname='user')
+        now = datetime.datetime.now(utc)
+        events = [event for event in module.get_timeline_events(req,
+                        now - datetime.timedelta(days=1),
+                        now + datetime.timedelta(days=1), ['blog'])
+                  if event[0] == 'blog']
+        self.assertEquals(1, len(events))
+        self.assertEquals(u'Blog: <em>one</em> comment added',
+                          unicode(module.render_timeline_event(
+                                web_context(req), 'title', events[0])))
+
 
 class FullBlogPostTestCase(FullBlogTestCaseTemplate):
 
@@ -97,3 +242,139 @@ class FullBlogPostTestCase(FullBlogTestCaseTemplate):
         posts = get_blog_posts(self.env)
         self.assertEquals(1, len(posts))
         self.assertEquals('New post', posts[0][4])
+
+
+class FullBlogPagingTestCase(FullBlogTestCaseTemplate):
+
+    def setUp(self):
+        FullBlogTestCaseTemplate.setUp(self)
+        PermissionSystem(self.env).grant_permission('user', 'BLOG_VIEW')
+        self.env.config.set('fullblog', 'num_items_front', 2)
+        for i in range(5):
+            bp = BlogPost(self.env, 'post%d' % i)
+            bp.update_fields({'title': 'Post %d' % i, 'author': 'user',
+                'body': 'Body', 'categories': i % 2 and 'odd' or 'even',
+                'publish_time': bp.publish_time \
+                                - datetime.timedelta(days=i)})
+            self.assertEquals([], bp.save('user'))
+
+    def _process(self, path_info, **args):
+        req = Mock(method='GET', base_path='', cgi_location='',
+                   path_info=path_info, href=Href('/trac'), args=args,
+                   chrome={'links': {}}, perm=PermissionCache(self.env, 'user'),
+                   authname='user')
+        module = FullBlogModule(self.env)
+        assert module.match_request(req)
+        return module.process_request(req)[1]
+
+    def test_front_page_pages(self):
+        data = self._process('/blog')
+        self.assertEquals(['post0', 'post1'],
+                          [bp.name for bp in data['blog_post_list']])
+        self.assertEquals('/trac/blog?page=2', data['blog_older_href'])
+        self.assertFalse(data['blog_newer_href'])
+        data = self._process('/blog', page='3')
+        self.assertEquals(['post4'],
+                          [bp.name for bp in data['blog_post_list']])
+        self.assertFalse(data['blog_older_href'])
+        self.assertEquals('/trac/blog?page=2', data['blog_newer_href'])
+
+    def test_listing_cursor(self):
+        data = self._process('/blog/category/even')
+        self.assertEquals(['post0', 'post2'],
+                          [bp.name for bp in data['blog_post_list']])
+        older = data['blog_older_href']
+        self.assertTrue(older.startswith('/trac/blog/category/even?before='))
+        data = self._process('/blog/category/even',
+                             before=unicode_unquote(older.split('=', 1)[1]))
+        self.assertEquals(['post4'],
+                          [bp.name for bp in data['blog_post_list']])
+        self.assertFalse(data['blog_older_href'])
+        self.assertEquals('/trac/blog/category/even', data['blog_newer_href'])
+
+    def _cursor(self, href):
+        return unicode_unquote(href.split('before=', 1)[1])
+
+    def test_listing_newer_page(self):
+        pages = []
+        data = self._process('/blog/author/user')
+        while True:
+            pages.append([bp.name for bp in data['blog_post_list']])
+            if not data['blog_older_href']:
+                break
+            data = self._process('/blog/author/user',
+                                 before=self._cursor(data['blog_older_href']))
+        self.assertEquals([['post0', 'post1'], ['post2', 'post3'], ['post4']],
+                          pages)
+        # Newer posts link to the previous page, not the first
+        data = self._process('/blog/author/user',
+                             before=self._cursor(data['blog_newer_href']))
+        self.assertEquals(['post2', 'post3'],
+                          [bp.name for bp in data['blog_post_list']])
+        self.assertEquals('/trac/blog/author/user', data['blog_newer_href'])
+
+    def test_front_page_skips_pages(self):
+        data = self._process('/blog', page='2')
+        self.assertEquals(['post2', 'post3'],
+                          [bp.name for bp in data['blog_post_list']])
+        data = self._process('/blog', page='9')
+        self.assertEquals([], data['blog_post_list'])
+        self.assertFalse(data['blog_older_href'])
+
+    def test_invalid_cursor(self):
+        for before in [['post1', '2:post2'], '99999999999999999999:post1',
+                       'post1', '']:
+            data = self._process('/blog/category/even', before=before)
+            self.assertEquals(['post0', 'post2'],
+                              [bp.name for bp in data['blog_post_list']])
+
+
+class FullBlogArchiveTestCase(FullBlogTestCaseTemplate):
+
+    def setUp(self):
+        FullBlogTestCaseTemplate.setUp(self)
+        PermissionSystem(self.env).grant_permission('user', 'BLOG_VIEW')
+        for name, month in [('jan', 1), ('feb1', 2), ('feb2', 2)]:
+            bp = BlogPost(self.env, name)
+            bp.update_fields({'title': name, 'author': 'user', 'body': 'Body',
+                'publish_time': datetime.datetime(2010, month, 10,
+                                                  tzinfo=utc)})
+            self.assertEquals([], bp.save('user'))
+
+    def _process(self, xhr=False, **args):
+        req = MockRequest(self.env, authname='user', path_info='/blog/archive',
+                          args=args)
+        if xhr:
+            req.environ['HTTP_X_REQUESTED_WITH'] = 'XMLHttpRequest'
+        module = FullBlogModule(self.env)
+        assert module.match_request(req)
+        return module.process_request(req)
+
+    def test_archive(self):
+        template, data, _ = self._process()
+        self.assertEquals('fullblog_archive.html', template)
+        self.assertFalse(data['blog_archive_lazy'])
+        self.assertEquals([(2, ['feb1', 'feb2']), (1, ['jan'])],
+                          [(period.month, sorted([p[0] for p in posts]))
+                           for period, posts in data['blog_archive']])
+        # Only the metadata is read
+        self.assertEquals([None, None], [p[5] for p in
+                                         data['blog_archive'][0][1]])
+
+    def test_lazy_archive(self):
+        self.env.config.set('fullblog', 'lazy_archive', 'true')
+        template, data, _ = self._process()
+        self.assertTrue(data['blog_archive_lazy'])
+        self.assertEquals([], data['blog_archive'])
+        self.assertEquals([((2010, 2), 2), ((2010, 1), 1)],
+                          data['blog_months'])
+        # Posts of a month are loaded when expanded
+        template, data, _ = self._process(xhr=True, period='2010/01')
+        self.assertEquals('fullblog_macro_monthlist.html', template)
+        self.assertEquals(['jan'], [p[0] for p in data['posts']])
+        # ... or shown as an archive page for the month without scripts
+        template, data, _ = self._process(period='2010/02')
+        self.assertEquals('fullblog_archive.html', template)
+        self.assertFalse(data['blog_archive_lazy'])
+        self.assertEquals([2], [period.month for period, posts
+                                in data['blog_archive']])
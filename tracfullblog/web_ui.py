@@ -11,6 +11,7 @@ License: BSD
 # Imports from standard lib
 import datetime
 import re
+from functools import partial
 from pkg_resources import resource_filename
 
 # Trac and Genshi imports
@@ -22,13 +23,13 @@ from trac.resource import Resource
 from trac.search.api import ISearchSource, shorten_result
 from trac.timeline.api import ITimelineEventProvider
 from trac.util import arity
-from trac.util.datefmt import utc
+from trac.util.datefmt import http_date, to_datetime, to_timestamp, utc
 from trac.util.text import shorten_line
 from trac.util.translation import _
 from trac.web.api import IRequestHandler, HTTPNotFound
 from trac.web.chrome import INavigationContributor, ITemplateProvider, \
-        add_stylesheet, add_link, add_warning, add_notice, add_ctxtnav, prevnext_nav
-from trac.wiki.formatter import format_to
+        add_stylesheet, add_link, add_warning, add_notice, add_ctxtnav, \
+        add_script, prevnext_nav
 
 try:
     from trac.web.chrome import web_context          # Trac ~+1.3
@@ -45,12 +46,37 @@ except ImportError:
 
 # Imports from same package
 from model import *
+from model import _select_blog_posts
 from core import FullBlogCore
+from search import FullBlogSearchIndex
 from util import map_month_names, parse_period
 
 __all__ = ['FullBlogModule']
 
 
+class TimelinePost(object):
+    """ Lightweight post version record for timeline events, holding the
+    fields needed for rendering the event instead of a full BlogPost. """
+    __slots__ = ['name', 'version', 'title', 'version_comment']
+
+    def __init__(self, name, version, title, version_comment):
+        self.name = name
+        self.version = version
+        self.title = title
+        self.version_comment = version_comment
+
+
+class TimelineComment(object):
+    """ Lightweight comment record for timeline events, instead of a full
+    BlogComment. """
+    __slots__ = ['post_name', 'number', 'comment']
+
+    def __init__(self, post_name, number, comment):
+        self.post_name = post_name
+        self.number = number
+        self.comment = comment
+
+
 class FullBlogModule(Component):
     
     implements(IRequestHandler, INavigationContributor,
@@ -80,6 +106,10 @@ class FullBlogModule(Component):
     all_rss_icons = BoolOption('fullblog', 'all_rss_icons', False,
         """Controls whether or not to display rss icons more than once""")
 
+    lazy_archive = BoolOption('fullblog', 'lazy_archive', False,
+        """Show the archive as a list of collapsed months, where the posts
+        of a month are loaded when expanded. Useful for large blogs.""")
+
     # INavigationContributor methods
     
     def get_active_navigation_item(self, req):
@@ -127,6 +157,7 @@ class FullBlogModule(Component):
 
         data = {}
         template = 'fullblog_view.html'
+        data['blog_wiki_to_html'] = blog_core.render_wiki
         data['blog_about'] = BlogPost(self.env, 'about')
         data['blog_infotext'] = blog_core.get_bloginfotext()
         blog_month_names = map_month_names(
@@ -136,44 +167,75 @@ class FullBlogModule(Component):
             "Blog debug: command=%r, pagename=%r, path_items=%r" % (
                 command, pagename, path_items))
 
+        if format == 'rss' and (not command or command.startswith('listing-')):
+            # Feeds are streamed, and only rendered if changed since last poll
+            return self._render_feed(req, data,
+                                     **self._get_listing_criteria(listing_data))
+
         if not command:
             # Request for just root (display latest)
-            data['blog_post_list'] = []
-            count = 0
             maxcount = self.num_items
-            blog_posts = get_blog_posts(self.env)
-            for post in blog_posts:
-                bp = BlogPost(self.env, post[0], post[1])
-                if 'BLOG_VIEW' in req.perm(bp.resource):
-                    data['blog_post_list'].append(bp)
-                    count += 1
-                if maxcount and count == maxcount:
-                    # Only display a certain number on front page (from config)
-                    break
+            try:
+                page = max(int(req.args.get('page', 1)), 1)
+            except ValueError:
+                page = 1
+            # Only display a certain number on front page (from config),
+            # and skip any preceding pages requested using only metadata
+            before = self._parse_page_cursor(req)
+            if maxcount and page > 1:
+                before = blog_core.get_page_cursor(req.perm,
+                                        maxcount * (page - 1), before)
+            blog_posts, more = [], False
+            if before or page == 1 or not maxcount:
+                blog_posts, more = blog_core.get_visible_posts(req.perm,
+                                        limit=maxcount, before=before)
+            data['blog_post_list'] = blog_posts
             data['blog_list_title'] = "Recent posts" + \
-                    (len(blog_posts) > maxcount and \
+                    (more and page == 1 and \
                         " (max %d) - Browse or Archive for more" % (maxcount,) \
-                    or '')
+                    or '') + (page > 1 and " (page %d)" % page or '')
+            self._add_page_links(req, data,
+                    more and req.href.blog(page=page+1),
+                    page > 1 and req.href.blog(page=page-1))
             add_link(req, 'alternate', req.href.blog(format='rss'), 'RSS Feed',
                      'application/rss+xml', 'rss')
 
         elif command == 'archive':
-            # Requesting the archive page
+            # Requesting the archive page, or a month of it
             template = 'fullblog_archive.html'
+            from_dt, to_dt = parse_period(
+                        req.args.get('period', '').split('/'))
+            data['blog_archive_lazy'] = self.lazy_archive and not from_dt
             data['blog_archive'] = []
-            for period, period_posts in group_posts_by_month(get_blog_posts(self.env)):
-                allowed_posts = []
-                for post in period_posts:
-                    bp = BlogPost(self.env, post[0], post[1])
-                    if 'BLOG_VIEW' in req.perm(bp.resource):
-                        allowed_posts.append(post)
-                if allowed_posts:
-                    data['blog_archive'].append((period, allowed_posts))
+            if not data['blog_archive_lazy']:
+                blog_posts = get_blog_posts(self.env, from_dt=from_dt,
+                                            to_dt=to_dt, with_body=False)
+                permitted = set(blog_core.filter_permitted(req.perm,
+                                        [post[0] for post in blog_posts]))
+                for period, period_posts in group_posts_by_month(blog_posts):
+                    allowed_posts = [post for post in period_posts
+                                     if post[0] in permitted]
+                    if allowed_posts:
+                        data['blog_archive'].append((period, allowed_posts))
+            if from_dt and req.get_header('X-Requested-With') \
+                                                    == 'XMLHttpRequest':
+                # Posts of a month, as loaded by the lazy archive
+                data.update({'execute_blog_macro': True, 'heading': None,
+                    'posts': data['blog_archive'] and \
+                             data['blog_archive'][0][1] or [],
+                    'blog_personal_blog': self.env.config.getbool('fullblog',
+                                                'personal_blog')})
+                return 'fullblog_macro_monthlist.html', data, None
+            if data['blog_archive_lazy']:
+                add_script(req, 'tracfullblog/js/fullblog_archive.js')
             add_link(req, 'alternate', req.href.blog(format='rss'), 'RSS Feed',
                      'application/rss+xml', 'rss')
 
         elif command == 'view' and pagename:
             # Requesting a specific blog post
+            if format == 'rss' and req.method == 'GET':
+                req.perm(Resource('blog', pagename)).require('BLOG_VIEW')
+                self._check_feed_modified(req, [version], pagename)
             the_post = BlogPost(self.env, pagename, version)
             req.perm(the_post.resource).require('BLOG_VIEW')
             if not the_post.version:
@@ -296,6 +358,9 @@ class FullBlogModule(Component):
                 else:
                     add_warning(req, reason)
             data['blog_edit'] = the_post
+            # Previews are not cached, as the text may never be saved
+            data['blog_wiki_to_html'] = partial(blog_core.render_wiki,
+                                                cache=False)
 
         elif command == 'delete':
             bp = BlogPost(self.env, pagename)
@@ -352,46 +417,39 @@ class FullBlogModule(Component):
 
         elif command.startswith('listing-'):
             # 2007/10 or category/something or author/theuser
-            title = category = author = ''
-            from_dt = to_dt = None
+            title = ''
+            criteria = self._get_listing_criteria(listing_data)
+            category, author, from_dt, to_dt = criteria['category'], \
+                    criteria['author'], criteria['from_dt'], criteria['to_dt']
             if command == 'listing-month':
-                from_dt = listing_data['from_dt']
-                to_dt = listing_data['to_dt']
                 title = "Posts for the month of %s %d" % (
                         blog_month_names[from_dt.month -1], from_dt.year)
                 add_link(req, 'alternate', req.href.blog(format='rss'), 'RSS Feed',
                         'application/rss+xml', 'rss')
 
             elif command == 'listing-category':
-                category = listing_data['category']
                 if category:
                     title = "Posts in category %s" % category
                     add_link(req, 'alternate', req.href.blog('category', category,
                         format='rss'), 'RSS Feed', 'application/rss+xml', 'rss')
             elif command == 'listing-author':
-                author = listing_data['author']
                 if author:
                     title = "Posts by author %s" % author
                     add_link(req, 'alternate', req.href.blog('author', author,
                         format='rss'), 'RSS Feed', 'application/rss+xml', 'rss')
-            if not (author or category or (from_dt and to_dt)):
-                raise HTTPNotFound("Not a valid path for viewing blog posts.")
-            blog_posts = []
-            for post in get_blog_posts(self.env, category=category,
-                        author=author, from_dt=from_dt, to_dt=to_dt):
-                bp = BlogPost(self.env, post[0], post[1])
-                if 'BLOG_VIEW' in req.perm(bp.resource):
-                    blog_posts.append(bp)
+            blog_posts, more = blog_core.get_visible_posts(req.perm,
+                    limit=self.num_items,
+                    before=self._parse_page_cursor(req), **criteria)
             data['blog_post_list'] = blog_posts
             data['blog_list_title'] = title
+            self._add_page_links(req, data, more and req.href.blog(
+                    req.args.get('blog_path'),
+                    before=self._format_page_cursor(blog_posts[-1])),
+                blog_posts and self._get_newer_href(req, blog_posts[0],
+                                                    criteria))
         else:
             raise HTTPNotFound("Not a valid blog path.")
 
-        if (not command or command.startswith('listing-')) and format == 'rss':
-            data['context'] = web_context(req, absurls=True)
-            data['blog_num_items'] = self.num_items
-            return 'fullblog.rss', data, 'application/rss+xml'
-
         data['blog_months'], data['blog_authors'], data['blog_categories'], \
                 data['blog_total'] = \
                     blog_core.get_months_authors_categories(
@@ -434,24 +492,39 @@ class FullBlogModule(Component):
         if not 'BLOG_VIEW' in req.perm(blog_realm):
             return
         if 'blog' in filters:
+            # Use the full-text index if enabled, with results ranked
+            search_index = self.env[FullBlogSearchIndex]
+            if search_index and search_index.enabled:
+                search_posts = search_index.search_blog_posts
+                search_comments = search_index.search_blog_comments
+            else:
+                search_posts = partial(search_blog_posts, self.env)
+                search_comments = partial(search_blog_comments, self.env)
+            blog_core = FullBlogCore(self.env)
             # Blog posts
-            results = search_blog_posts(self.env, terms)
+            titles = {}
+            results = search_posts(terms)
+            permitted = set(blog_core.filter_permitted(req.perm,
+                                    [row[0] for row in results]))
             for name, version, publish_time, author, title, body in results:
-                bp_resource = blog_realm(id=name, version=version)
-                if 'BLOG_VIEW' in req.perm(bp_resource):
+                titles[name] = title
+                if name in permitted:
                     yield (req.href.blog(name), 'Blog: '+title,
                         publish_time, author, shorten_result(
                                 text=body, keywords=terms))
-            # Blog comments
-            results = search_blog_comments(self.env, terms)
+            # Blog comments - with titles of posts not found above
+            results = search_comments(terms)
+            titles.update(get_blog_post_titles(self.env, set(
+                    [row[0] for row in results if not row[0] in titles])))
+            permitted = set(blog_core.filter_permitted(req.perm,
+                                    [row[0] for row in results]))
             for post_name, comment_number, comment, comment_author, \
                     comment_time in results:
-                bp_resource = blog_realm(id=post_name, version=None)
-                if 'BLOG_VIEW' in req.perm(bp_resource):
-                    bp = BlogPost(self.env, post_name)
+                if post_name in permitted:
                     yield (req.href.blog(
                             post_name)+'#comment-'+str(comment_number),
-                        'Blog: '+bp.title+' (Comment '+str(comment_number)+')',
+                        'Blog: '+titles.get(post_name, '')+' (Comment '+
+                                str(comment_number)+')',
                         comment_time, comment_author,
                         shorten_result(text=comment, keywords=terms))
     
@@ -468,15 +541,17 @@ class FullBlogModule(Component):
                 return
             add_stylesheet(req, 'tracfullblog/css/fullblog.css')
             # Blog posts
-            blog_posts = get_blog_posts(self.env, from_dt=start, to_dt=stop,
-                                        all_versions=True)
-            for name, version, time, author, title, body, category_list \
-                    in blog_posts:
+            blog_posts = _select_blog_posts(self.env, ['name', 'version',
+                    'title', 'version_time', 'version_author',
+                    'version_comment'], from_dt=start, to_dt=stop,
+                    all_versions=True)
+            for name, version, title, version_time, version_author, \
+                    version_comment in blog_posts:
                 bp_resource = blog_realm(id=name, version=version)
                 if 'BLOG_VIEW' not in req.perm(bp_resource):
                     continue
-                bp = BlogPost(self.env, name, version=version)
-                yield ('blog', bp.version_time, bp.version_author,
+                bp = TimelinePost(name, version, title, version_comment)
+                yield ('blog', to_datetime(version_time, utc), version_author,
                             (bp_resource, bp, None))
             # Attachments (will be rendered by attachment module)
             for event in AttachmentModule(self.env).get_timeline_events(
@@ -485,12 +560,17 @@ class FullBlogModule(Component):
             # Blog comments
             blog_comments = get_blog_comments(self.env, from_dt=start, to_dt=stop)
             blog_comments = sorted(blog_comments, key=itemgetter(4), reverse=True)
+            post_names = set([c[0] for c in blog_comments])
+            titles = get_blog_post_titles(self.env, post_names)
+            permitted = set(FullBlogCore(self.env).filter_permitted(req.perm,
+                                    post_names))
             for post_name, number, comment, author, time in blog_comments:
-                bp_resource = blog_realm(id=post_name)
-                if 'BLOG_VIEW' not in req.perm(bp_resource):
+                if post_name not in permitted:
                     continue
-                bp = BlogPost(self.env, post_name)
-                bc = BlogComment(self.env, post_name, number=number)
+                bp_resource = blog_realm(id=post_name)
+                bp = TimelinePost(post_name, None,
+                                  titles.get(post_name) or post_name, None)
+                bc = TimelineComment(post_name, number, comment)
                 yield ('blog', time, author, (bp_resource, bp, bc))
 
     def render_timeline_event(self, context, field, event):
@@ -506,8 +586,9 @@ class FullBlogModule(Component):
             elif field == 'description':
                 comment = compat_format_0_11_2 and shorten_line(bc.comment) \
                             or bc.comment
-                return format_to(self.env, compat_format_0_11_2,
-                            context(resource=bp_resource), comment)
+                return FullBlogCore(self.env).render_wiki(
+                            context(resource=bp_resource), bc, comment,
+                            compat_format_0_11_2)
         else: # A blog post
             if field == 'url':
                 return context.href.blog(bp.name)
@@ -517,8 +598,9 @@ class FullBlogModule(Component):
             elif field == 'description':
                 comment = compat_format_0_11_2 and shorten_line(bp.version_comment) \
                             or bp.version_comment
-                return format_to(self.env, compat_format_0_11_2,
-                        context(resource=bp_resource), comment)
+                return FullBlogCore(self.env).render_wiki(
+                        context(resource=bp_resource), bp, comment,
+                        compat_format_0_11_2)
 
     # ITemplateProvider methods
 
@@ -532,6 +614,96 @@ class FullBlogModule(Component):
 
     # Internal methods
 
+    def _format_page_cursor(self, bp):
+        """ Returns the 'before' argument for listing the posts following
+        the given post, or (publish_time, name) cursor. """
+        if isinstance(bp, tuple):
+            publish_time, name = bp
+        else:
+            publish_time, name = bp.publish_time, bp.name
+        return '%d:%s' % (to_timestamp(publish_time), name)
+
+    def _parse_page_cursor(self, req):
+        """ Returns the (publish_time, name) cursor from the 'before'
+        request argument, or None if missing or invalid. """
+        before = req.args.get('before', '')
+        if isinstance(before, list):
+            # Repeated argument
+            before = before and before[0] or ''
+        try:
+            timestamp, name = before.split(':', 1)
+            return (to_datetime(int(timestamp), utc), name)
+        except (AttributeError, TypeError, ValueError, OverflowError):
+            return None
+
+    def _get_newer_href(self, req, first_post, criteria):
+        """ Returns the link to the page of newer posts for a listing page
+        starting with `first_post`, or None if it is the first page. """
+        if self._parse_page_cursor(req) is None:
+            return None
+        cursor = FullBlogCore(self.env).get_page_cursor(req.perm,
+                    self.num_items + 1,
+                    (first_post.publish_time, first_post.name), newer=True,
+                    **criteria)
+        if cursor:
+            return req.href.blog(req.args.get('blog_path'),
+                                 before=self._format_page_cursor(cursor))
+        return req.href.blog(req.args.get('blog_path'))
+
+    def _add_page_links(self, req, data, older_href, newer_href):
+        """ Adds navigation between pages of a post listing. """
+        data['blog_older_href'] = older_href
+        data['blog_newer_href'] = newer_href
+        if older_href:
+            add_link(req, 'next', older_href, 'Older Posts')
+        if newer_href:
+            add_link(req, 'prev', newer_href, 'Newer Posts')
+        if older_href or newer_href:
+            if arity(prevnext_nav) == 4:
+                # 0.12 compat following trac:changeset:8597
+                prevnext_nav(req, 'Newer Posts', 'Older Posts')
+            else:
+                prevnext_nav(req, 'Page')
+
+    def _get_listing_criteria(self, listing_data):
+        """ Returns the selection criteria for a listing as keyword arguments
+        for get_visible_posts(). An empty listing_data means all posts. """
+        criteria = {'category': listing_data.get('category', ''),
+                    'author': listing_data.get('author', ''),
+                    'from_dt': listing_data.get('from_dt'),
+                    'to_dt': listing_data.get('to_dt')}
+        if listing_data and not (criteria['category'] or criteria['author'] \
+                    or (criteria['from_dt'] and criteria['to_dt'])):
+            raise HTTPNotFound("Not a valid path for viewing blog posts.")
+        return criteria
+
+    def _render_feed(self, req, data, **criteria):
+        """ Returns the RSS feed of the most recent posts matching criteria.
+        Posts are loaded in chunks while the feed is rendered, and a
+        '304 Not Modified' response is sent instead if the feed has not
+        changed since the client last fetched it. """
+        before = self._parse_page_cursor(req)
+        self._check_feed_modified(req, [sorted(criteria.items()), before,
+                                        self.num_items])
+        data['blog_post_list'] = FullBlogCore(self.env).iter_visible_posts(
+                req.perm, limit=self.num_items, before=before, **criteria)
+        data['context'] = web_context(req, absurls=True)
+        data['blog_num_items'] = self.num_items
+        return 'fullblog.rss', data, 'application/rss+xml'
+
+    def _check_feed_modified(self, req, extra, post_name=''):
+        """ Sends a '304 Not Modified' response if the client already has
+        the current version of a feed, based on the time of the latest
+        change and the blog generation. Otherwise adds Last-Modified and
+        ETag headers to the response. Only the ETag is used for checking,
+        as deletions do not move the time of the latest change. """
+        last_modified, generation = FullBlogCore(self.env).get_last_modified(
+                    post_name, comments=bool(post_name))
+        if last_modified is None:
+            return
+        req.send_header('Last-Modified', http_date(last_modified))
+        req.check_modified(last_modified, [generation] + extra)
+
     def _parse_path(self, req):
         """ Parses the request path for the blog and returns a
         ('command', 'pagename', 'path_items', 'listing_data') tuple. """